@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy as np
+from pathlib import Path
+from benchmarks import synthetic_features
+from bin import create_edge
+from bin import edge_to_json_matroid
+from bin import feature_store
+from bin import pairwise_edge_matrix
+from bin import results_store
+from bin import solver
+
+# Times each stage of MS1Connect on synthetic cohorts (see
+# synthetic_features) for every combination of cohort size, topN and mzTol and
+# writes the results as JSON. Runs offline: the native greedy solver stands in
+# for coopraiz. Run from the repository root:
+#
+#   python -m benchmarks.run_benchmarks --output results.json
+#   python -m benchmarks.run_benchmarks --output new.json --compare old.json
+#
+# Result layout
+#   {"info": {"commit", "python", "numpy", "platform", "cpuCount", "time"},
+#    "results": [{"cohortSize", "topN", "mzTol", "ticTol", "stage",
+#                 "seconds" (best repeat), "repeats" (every repeat),
+#                 "numEdges", "numEntries"}]}
+
+binFolder = str(Path(__file__).resolve().parent.parent / "bin")
+
+stageList = ["loadFeatures", "createEdge", "createJsonMatroid", "fillInMatrix",
+			 "csrBuild", "solver", "createRunSimMatrix"]
+
+# hyperparameters used by every benchmark (ms1connect.py defaults)
+lambdas = (0.0, 0.1, 0.0, 0.9)
+alphas = (0.0, 0.00001, 1.0)
+
+
+###############################################################################
+def getInfo():
+	"""
+	Machine and commit the benchmark was run on
+	"""
+	try:
+		commit = subprocess.run(["git", "rev-parse", "HEAD"],
+								cwd=binFolder, capture_output=True,
+								text=True).stdout.strip() or None
+	except OSError:
+		commit = None
+	return({"commit":commit, "python":platform.python_version(),
+			"numpy":np.__version__, "platform":platform.platform(),
+			"cpuCount":os.cpu_count(),
+			"time":time.strftime("%Y-%m-%dT%H:%M:%S")})
+
+
+def runCohort(workFolder, stages, ticTol, mzTol, edgeBackend):
+	"""
+	Run every stage once on the cohort in workFolder/ms1
+	Output1: dict of stage to seconds
+	Output2: number of edges and number of matrix entries over every pair
+	"""
+	ms1Folder = workFolder + "/ms1"
+	folderDic = {}
+	for name in ["edge", "matroid", "sim", "output"]:
+		folderDic[name] = workFolder + "/" + name
+		shutil.rmtree(folderDic[name], ignore_errors=True)
+		Path(folderDic[name]).mkdir()
+	for binaryFile in Path(ms1Folder).glob("*" + feature_store.binaryExt):
+		binaryFile.unlink()
+	feature_store._storeCache.clear()
+	create_edge._indexCache.clear()
+
+	seconds = {stage:0.0 for stage in stages}
+	def timeStage(stage, func, *args):
+		start = time.perf_counter()
+		output = func(*args)
+		if stage in seconds:
+			seconds[stage] += time.perf_counter() - start
+		return(output)
+
+	pairList = create_edge.getPairList(ms1Folder)
+	featureDic = {}
+	for fileName in sorted(set(f for pair in pairList for f in pair)):
+		featureDic[fileName] = timeStage("loadFeatures",
+			lambda x: feature_store.featureMatrix(
+				feature_store.loadFeatures(x)), fileName)
+
+	numEdges = 0
+	numEntries = 0
+	rowList = []
+	resultsFile = workFolder + "/results.sqlite"
+	if Path(resultsFile).is_file():
+		Path(resultsFile).unlink()
+	for leftFile, rightFile in pairList:
+		edgeFile = create_edge.getEdgeFileName(leftFile, rightFile,
+											   folderDic["edge"])
+		if edgeBackend == "createEdge":
+			timeStage("createEdge", create_edge.createEdge,
+					  feature_store.getBinaryFileName(leftFile),
+					  feature_store.getBinaryFileName(rightFile), edgeFile,
+					  binFolder + "/createEdge", mzTol, ticTol)
+			edges = create_edge.loadEdges(edgeFile)
+		else:
+			edges = timeStage("createEdge", create_edge.createEdgeInProcess,
+							  leftFile, rightFile, edgeFile, mzTol, ticTol)
+		nRow = edges.shape[0]
+		numEdges += nRow
+
+		matroid = timeStage("createJsonMatroid",
+							edge_to_json_matroid.createJsonMatroid,
+							Path(edgeFile), folderDic["matroid"], edges)
+
+		if nRow == 0:
+			continue
+		sparseMat, postNormVal, nnz = timeStage("fillInMatrix",
+			pairwise_edge_matrix.fillInMatrix, edges, featureDic[leftFile],
+			featureDic[rightFile], nRow, *(lambdas + alphas))
+		numEntries += nnz
+		timeStage("csrBuild", pairwise_edge_matrix.saveEdgeSimMatrix,
+				  sparseMat, edgeFile, folderDic["sim"])
+
+		npzFile = folderDic["sim"] + "/" + Path(edgeFile).stem + \
+				  "___pairwise.npz"
+		solverResult = timeStage("solver", solver.solveGreedy, npzFile, None,
+								 matroid)
+		rowList.append(results_store.pairRow(Path(edgeFile).stem, nRow, nnz,
+											 postNormVal, solverResult))
+	conn = results_store.openResultsStore(resultsFile)
+	results_store.writePairResults(conn, rowList)
+	conn.close()
+
+	if "createRunSimMatrix" in seconds:
+		# plotting dependencies are only needed for this stage
+		from bin import plots
+		timeStage("createRunSimMatrix", plots.createRunSimMatrix, ms1Folder,
+				  workFolder + "/ms1/metadata.txt", resultsFile,
+				  folderDic["output"])
+	return(seconds, numEdges, numEntries)
+
+
+def runBenchmarks(cohortSizeList, topNList, mzTolList, ticTol, stages,
+				  repeat, overlap, seed, edgeBackend, workFolder=None):
+	"""
+	Time every stage for each combination of cohort size, topN and mzTol.
+	The best of repeat runs is reported.
+	Output: list of result dicts (see top of file)
+	"""
+	cleanUp = workFolder is None
+	if workFolder is None:
+		workFolder = tempfile.mkdtemp(prefix="ms1connect_bench_")
+
+	# compile the numba kernels before anything is timed
+	synthetic_features.generateCohort(workFolder + "/ms1", 2, 200,
+									  overlap=overlap, seed=seed)
+	runCohort(workFolder, [], ticTol, mzTolList[0], edgeBackend)
+
+	resultList = []
+	try:
+		for cohortSize in cohortSizeList:
+			for topN in topNList:
+				shutil.rmtree(workFolder + "/ms1", ignore_errors=True)
+				synthetic_features.generateCohort(workFolder + "/ms1",
+					cohortSize, topN, overlap=overlap, seed=seed)
+				for mzTol in mzTolList:
+					repeatList = []
+					for i in range(repeat):
+						seconds, numEdges, numEntries = runCohort(workFolder,
+							stages, ticTol, mzTol, edgeBackend)
+						repeatList.append(seconds)
+					for stage in stages:
+						times = [seconds[stage] for seconds in repeatList]
+						resultList.append({"cohortSize":cohortSize,
+										   "topN":topN, "mzTol":mzTol,
+										   "ticTol":ticTol, "stage":stage,
+										   "seconds":min(times),
+										   "repeats":times,
+										   "numEdges":numEdges,
+										   "numEntries":numEntries})
+						print(cohortSize, topN, mzTol, stage,
+							  "%.4f" % min(times), sep='\t', flush=True)
+	finally:
+		if cleanUp:
+			shutil.rmtree(workFolder, ignore_errors=True)
+	return(resultList)
+
+
+###############################################################################
+def resultKey(result):
+	return((result["cohortSize"], result["topN"], result["mzTol"],
+			result["ticTol"], result["stage"]))
+
+
+def compareResults(baseline, current, threshold):
+	"""
+	Print the ratio of current to baseline seconds for every benchmark in
+	both. Ratios above 1 + threshold are marked as regressions.
+	Output: number of regressions
+	"""
+	baselineDic = {resultKey(x):x for x in baseline["results"]}
+	numRegression = 0
+	print("cohortSize\ttopN\tmzTol\tstage\tbaseline\tcurrent\tratio")
+	for result in current["results"]:
+		key = resultKey(result)
+		if key not in baselineDic or baselineDic[key]["seconds"] == 0:
+			continue
+		ratio = result["seconds"] / baselineDic[key]["seconds"]
+		flag = ""
+		if ratio > 1 + threshold:
+			flag = "\tREGRESSION"
+			numRegression += 1
+		print(key[0], key[1], key[2], key[4],
+			  "%.4f" % baselineDic[key]["seconds"], "%.4f" % result["seconds"],
+			  "%.2f" % ratio + flag, sep='\t')
+	return(numRegression)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Times each MS1Connect stage \
+on synthetic cohorts and writes the results as JSON.")
+	parser.add_argument("--output", help="JSON file for the results.\
+	Default=benchmark_results.json", default="benchmark_results.json")
+	parser.add_argument("--cohortSize", help="Numbers of runs. Default=4",
+						nargs="+", type=int, default=[4])
+	parser.add_argument("--topN", help="Numbers of MS1 features per run.\
+	Default=1000 4000", nargs="+", type=int, default=[1000, 4000])
+	parser.add_argument("--mzTol", help="m/z tolerances in ppm. Default=4 10",
+						nargs="+", type=float, default=[4.0, 10.0])
+	parser.add_argument("--ticTol", help="TIC tolerance. Default=1",
+						type=float, default=1.0)
+	parser.add_argument("--stages", help="Stages to time. Default=all",
+						nargs="+", choices=stageList, default=stageList)
+	parser.add_argument("--repeat", help="Repeats of each benchmark.\
+	Default=3", type=int, default=3)
+	parser.add_argument("--overlap", help="Fraction of features shared within\
+	a group of runs. Default=0.5", type=float, default=0.5)
+	parser.add_argument("--seed", help="Random seed. Default=0", type=int,
+						default=0)
+	parser.add_argument("--edgeBackend", help="Edge generation backend.\
+	Default=numpy", default="numpy", choices=["numpy","createEdge"])
+	parser.add_argument("--workFolder", help="Folder for intermediate files.\
+	Default=temporary folder")
+	parser.add_argument("--compare", help="Baseline JSON results to compare\
+	against")
+	parser.add_argument("--threshold", help="Slowdown reported as a\
+	regression when comparing. Default=0.1", type=float, default=0.1)
+	args = parser.parse_args()
+
+	current = {"info":getInfo(),
+			   "results":runBenchmarks(args.cohortSize, args.topN, args.mzTol,
+									   args.ticTol, args.stages, args.repeat,
+									   args.overlap, args.seed,
+									   args.edgeBackend, args.workFolder)}
+	with open(args.output, 'w') as newFile:
+		json.dump(current, newFile, indent=1)
+
+	if args.compare is not None:
+		with open(args.compare, 'r') as file1:
+			baseline = json.load(file1)
+		compareResults(baseline, current, args.threshold)
@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from benchmarks import synthetic_features
+
+# Startup cost of a scoring-only process (such as 'ms1connect.py worker'):
+# import ms1connect and score one pair of existing MS1 feature files in a new
+# Python process. The first repeat runs with an empty numba cache (cold) and
+# the others load the cached kernels (warm). Checks that the warm startup is
+# within a budget and that pyOpenMS and the plotting dependencies are not
+# imported. Run from the repository root:
+#
+#   python -m benchmarks.startup
+#   python -m benchmarks.startup --budget 1.5 --output startup.json
+
+repoFolder = str(Path(__file__).resolve().parent.parent)
+
+# modules a scoring-only process must not import
+heavyModules = ["pyopenms", "seaborn", "matplotlib", "sklearn", "pandas"]
+
+# run in a new process for each repeat. Prints the import time, the time to
+# score the pair and the heavy modules that were imported as JSON
+childCode = """
+import json, sys, time
+start = time.perf_counter()
+import ms1connect
+from bin import artifact_cache, pipeline
+importSeconds = time.perf_counter() - start
+start = time.perf_counter()
+pipeline.runPair(sys.argv[1], sys.argv[2], json.loads(sys.argv[3]),
+				 artifact_cache.emptyManifest())
+print(json.dumps({"import":importSeconds,
+				  "firstPair":time.perf_counter() - start,
+				  "heavyModules":[name for name in json.loads(sys.argv[4])
+								  if name in sys.modules]}))
+"""
+
+
+###############################################################################
+def runChild(workFolder, leftFile, rightFile, cacheFolder):
+	"""
+	Score one pair in a new process
+	Output: dict of import, firstPair and total (process wall time) seconds
+			and the heavy modules imported
+	"""
+	config = {"ms1_folder":workFolder + "/ms1",
+			  "edge_folder":workFolder + "/edge",
+			  "matroid_folder":workFolder + "/matroid",
+			  "edge_sim_folder":workFolder + "/sim", "mz_tol":4.0,
+			  "tic_tol":1.0, "lambda1":0.0, "lambda2":0.1, "lambda3":0.0,
+			  "lambda4":0.9, "alpha":0.0, "beta":0.00001, "gamma":1.0,
+			  "edge_backend":"numpy", "solver":"greedy", "edge_format":"txt",
+			  "term_cache":False, "superset_tol":None, "trace_file":None,
+			  "profile_stages":[], "profile_folder":workFolder + "/profile",
+			  "pairwise_memory_mb":None}
+	for name in ["edge_folder", "matroid_folder", "edge_sim_folder"]:
+		shutil.rmtree(config[name], ignore_errors=True)
+		Path(config[name]).mkdir()
+	env = dict(os.environ, NUMBA_CACHE_DIR=cacheFolder)
+	start = time.perf_counter()
+	output = subprocess.run([sys.executable, "-c", childCode, leftFile,
+							 rightFile, json.dumps(config),
+							 json.dumps(heavyModules)], cwd=repoFolder,
+							env=env, capture_output=True, text=True,
+							check=True).stdout
+	result = json.loads(output.strip().splitlines()[-1])
+	result["total"] = time.perf_counter() - start
+	return(result)
+
+
+def measureStartup(repeat, numFeatures, seed, workFolder=None):
+	"""
+	Startup of repeat new processes. The first one starts with an empty
+	numba cache.
+	Output: list of runChild results
+	"""
+	cleanUp = workFolder is None
+	if workFolder is None:
+		workFolder = tempfile.mkdtemp(prefix="ms1connect_startup_")
+	try:
+		synthetic_features.generateCohort(workFolder + "/ms1", 2, numFeatures,
+										  seed=seed)
+		leftFile, rightFile = sorted(str(f) for f in
+			Path(workFolder + "/ms1").glob("*_ms1Peak.txt"))
+		cacheFolder = workFolder + "/numba_cache"
+		shutil.rmtree(cacheFolder, ignore_errors=True)
+		resultList = []
+		for i in range(repeat):
+			result = runChild(workFolder, leftFile, rightFile, cacheFolder)
+			result["cache"] = "cold" if i == 0 else "warm"
+			resultList.append(result)
+			print(result["cache"], "%.3f" % result["import"],
+				  "%.3f" % result["firstPair"], "%.3f" % result["total"],
+				  ",".join(result["heavyModules"]), sep='\t', flush=True)
+	finally:
+		if cleanUp:
+			shutil.rmtree(workFolder, ignore_errors=True)
+	return(resultList)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Measures the startup of a \
+scoring-only MS1Connect process (import and first pair) with a cold and a \
+warm numba cache.")
+	parser.add_argument("--repeat", help="Number of processes (the first has\
+	a cold cache). Default=3", type=int, default=3)
+	parser.add_argument("--topN", help="Number of MS1 features per run.\
+	Default=1000", type=int, default=1000)
+	parser.add_argument("--budget", help="Seconds a warm process may take to\
+	start and score the pair. Default=2", type=float, default=2.0)
+	parser.add_argument("--seed", help="Random seed. Default=0", type=int,
+						default=0)
+	parser.add_argument("--workFolder", help="Folder for intermediate files.\
+	Default=temporary folder")
+	parser.add_argument("--output", help="JSON file for the results")
+	args = parser.parse_args()
+
+	print("cache", "import", "firstPair", "total", "heavyModules", sep='\t')
+	resultList = measureStartup(max(2, args.repeat), args.topN, args.seed,
+								args.workFolder)
+	if args.output is not None:
+		with open(args.output, 'w') as newFile:
+			json.dump({"budget":args.budget, "results":resultList}, newFile,
+					  indent=1)
+
+	warm = min(x["total"] for x in resultList if x["cache"] == "warm")
+	heavy = sorted(set(name for x in resultList for name in x["heavyModules"]))
+	print("warm startup %.3f s (budget %.3f s)" % (warm, args.budget))
+	if len(heavy) > 0:
+		print("scoring imported " + ", ".join(heavy))
+	if warm > args.budget or len(heavy) > 0:
+		sys.exit(1)
@@ -0,0 +1,150 @@
+import argparse
+import numpy as np
+from pathlib import Path
+
+# Synthetic MS1 feature files for benchmarking. Each run is a mix of features
+# drawn from the peptide pool of its group (shared with the other runs of the
+# group), features drawn from a pool shared by every group and features that
+# only exist in that run.
+
+# feature detection keeps features in this pTIC range (see
+# ms1_feature_detection)
+min_pTIC = .05
+max_pTIC = .95
+
+# length of the LC gradient in seconds
+gradientLength = 7200.0
+
+# charge state distribution of peptide features
+chargeList = [1, 2, 3, 4]
+chargeProb = [0.05, 0.60, 0.28, 0.07]
+
+# m/z jitter of a shared feature between runs (ppm) and pTIC noise
+mzJitterPpm = 1.5
+pticShiftSd = 0.01
+pticNoiseSd = 0.005
+
+
+###############################################################################
+def makePool(rng, size):
+	"""
+	Peptide pool. Mass is log-normal around 1500 Da and the m/z follows from
+	the charge (MS1 feature m/z mostly between 400 and 1600).
+	Output: dict of numpy arrays (mz, logIntensity, pTIC, charge)
+	"""
+	charge = rng.choice(chargeList, size=size, p=chargeProb)
+	mass = np.clip(rng.lognormal(np.log(1500.0), 0.35, size), 500.0, 6000.0)
+	mz = mass / charge + 1.00728
+	return({"mz":mz, "logIntensity":rng.normal(12.0, 1.5, size),
+			"pTIC":rng.uniform(min_pTIC, max_pTIC, size), "charge":charge})
+
+
+def sampleRun(rng, groupPool, sharedPool, numFeatures, overlap, crossOverlap):
+	"""
+	MS1 features of one run. overlap of the features are from the group pool
+	and crossOverlap from the pool shared by every group. The rest are unique
+	to the run.
+	Output: numpy array with the columns of a MS1 feature file sorted by m/z
+	"""
+	numGroup = min(int(round(overlap * numFeatures)), groupPool["mz"].size)
+	numShared = min(int(round(crossOverlap * numFeatures)),
+					sharedPool["mz"].size, numFeatures - numGroup)
+	numUnique = numFeatures - numGroup - numShared
+	uniquePool = makePool(rng, numUnique)
+
+	columns = {name:[] for name in ["mz", "logIntensity", "pTIC", "charge"]}
+	for pool, size in [(groupPool, numGroup), (sharedPool, numShared),
+					   (uniquePool, numUnique)]:
+		index = rng.choice(pool["mz"].size, size=size, replace=False)
+		for name in columns:
+			columns[name].append(pool[name][index])
+	columns = {name:np.concatenate(value) for name, value in columns.items()}
+
+	# the same peptide is measured slightly differently in every run
+	mz = columns["mz"] * (1 + rng.normal(0, mzJitterPpm * 1e-6, numFeatures))
+	intensity = np.exp(columns["logIntensity"] +
+					   rng.normal(0, 0.5, numFeatures))
+	pTIC = columns["pTIC"] + rng.normal(0, pticShiftSd) + \
+		   rng.normal(0, pticNoiseSd, numFeatures)
+	pTIC = np.clip(pTIC, min_pTIC, max_pTIC)
+	RT = gradientLength * pTIC ** 0.9
+
+	features = np.column_stack((np.round(mz, 4), np.round(intensity, 1),
+								np.round(RT, 4), np.round(pTIC, 4),
+								columns["charge"]))
+	return(features[np.argsort(features[:,0], kind='stable')])
+
+
+def writeFeatureFile(features, fileName):
+	"""
+	Write MS1 features in the same format as ms1_feature_detection.peakPick
+	"""
+	np.savetxt(fileName, features, fmt=['%s','%s','%s','%s','%d'],
+			   delimiter='\t', header="mz\tintensity\tRT\tpTIC\tcharge",
+			   comments='')
+
+
+def generateCohort(outputFolder, numRuns, numFeatures, numGroups=2,
+				   overlap=0.5, crossOverlap=0.1, seed=0):
+	"""
+	Write a cohort of synthetic MS1 feature files and a metadata file
+
+	Parameters
+	----------
+	outputFolder : str, path
+		Folder for the _ms1Peak.txt files and metadata.txt
+	numRuns : int
+		Number of runs
+	numFeatures : int
+		Number of MS1 features per run (top N)
+	numGroups : int
+		Number of groups (metadata label). Runs are assigned round robin.
+	overlap : float
+		Fraction of the features of a run drawn from the pool of its group
+	crossOverlap : float
+		Fraction of the features of a run drawn from the pool of every group
+	seed : int
+		Seed of the random number generator
+
+	Returns
+	-------
+	metadataFileName : str
+	"""
+	rng = np.random.default_rng(seed)
+	Path(outputFolder).mkdir(parents=True, exist_ok=True)
+	sharedPool = makePool(rng, 2 * numFeatures)
+	groupPoolList = [makePool(rng, 2 * numFeatures) for i in range(numGroups)]
+
+	metadataFileName = str(outputFolder) + "/metadata.txt"
+	with open(metadataFileName, 'w') as newFile:
+		newFile.write("fileName\tmetadataLabel\n")
+		for run in range(numRuns):
+			group = run % numGroups
+			features = sampleRun(rng, groupPoolList[group], sharedPool,
+								 numFeatures, overlap, crossOverlap)
+			runName = "run" + str(run).zfill(4)
+			writeFeatureFile(features, str(outputFolder) + "/" + runName +
+							 "_ms1Peak.txt")
+			newFile.write(runName + ".mzML\tgroup" + str(group) + "\n")
+	return(metadataFileName)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Writes a cohort of synthetic \
+MS1 feature files.")
+	parser.add_argument("output", help="Folder to place MS1 feature files")
+	parser.add_argument("--runs", help="Number of runs. Default=4", type=int,
+						default=4)
+	parser.add_argument("--topN", help="Number of MS1 features per run.\
+	Default=4000", type=int, default=4000)
+	parser.add_argument("--groups", help="Number of groups. Default=2",
+						type=int, default=2)
+	parser.add_argument("--overlap", help="Fraction of features shared within\
+	a group. Default=0.5", type=float, default=0.5)
+	parser.add_argument("--crossOverlap", help="Fraction of features shared by\
+	every group. Default=0.1", type=float, default=0.1)
+	parser.add_argument("--seed", help="Random seed. Default=0", type=int,
+						default=0)
+	args = parser.parse_args()
+	generateCohort(args.output, args.runs, args.topN, args.groups, args.overlap,
+				   args.crossOverlap, args.seed)
@@ -0,0 +1,157 @@
+import argparse
+import itertools
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from benchmarks import synthetic_features
+from bin import artifact_cache
+from bin import create_edge
+from bin import pairwise_edge_matrix
+
+# Hyperparameter sweep of the edge similarity matrix on a synthetic cohort (see
+# synthetic_features). Each setting of the beta x gamma grid is written to its
+# own folder (___pairwise.npz files and pairwise-edge.log.txt) twice: once
+# with createEdgeSimMatrix, which scans the edge band for every setting, and
+# once with sweepEdgeSimMatrix, which builds the term cache once and reweights
+# it. Reports both times and the largest relative difference of the post
+# normalization values. Run from the repository root:
+#
+#   python -m benchmarks.term_sweep
+#   python -m benchmarks.term_sweep --beta 0 0.00001 0.001 --output sweep.json
+
+# lambda1-4 and alpha used by every setting (ms1connect.py defaults)
+lambdas = (0.0, 0.1, 0.0, 0.9)
+alpha = 0.0
+
+
+###############################################################################
+def getSettingFolder(workFolder, method, i):
+	return(workFolder + "/" + method + "/" + str(i))
+
+
+def writeLogs(folderList, resultList):
+	"""
+	Write the pairwise-edge.log.txt of each setting
+	Input1: output folder of each setting
+	Input2: for each edge file the createEdgeSimMatrix output of each setting
+	"""
+	for i, folderName in enumerate(folderList):
+		with open(folderName + "/pairwise-edge.log.txt", 'w') as logFile:
+			for results in resultList:
+				logFile.write(pairwise_edge_matrix.formatLogLine(*results[i]))
+
+
+def runSweep(workFolder, settingList, mzTol, ticTol):
+	"""
+	Edge similarity matrices of every pair in workFolder/ms1 for every
+	setting, without and with the term cache
+	Output: dict of direct and sweep seconds and the largest relative
+			difference of the post normalization values
+	"""
+	ms1Folder = workFolder + "/ms1"
+	edgeFolder = workFolder + "/edge"
+	termFolder = workFolder + "/terms"
+	folderDic = {}
+	for method in ["direct", "sweep"]:
+		folderDic[method] = [getSettingFolder(workFolder, method, i)
+							 for i in range(len(settingList))]
+	for folderName in [edgeFolder, termFolder] + folderDic["direct"] + \
+					  folderDic["sweep"]:
+		shutil.rmtree(folderName, ignore_errors=True)
+		Path(folderName).mkdir(parents=True)
+
+	edgeFileList = []
+	for leftFile, rightFile in create_edge.getPairList(ms1Folder):
+		edgeFile = create_edge.getEdgeFileName(leftFile, rightFile, edgeFolder)
+		create_edge.createEdgeInProcess(leftFile, rightFile, edgeFile, mzTol,
+										ticTol)
+		edgeFileList.append(edgeFile)
+
+	start = time.perf_counter()
+	directList = [[pairwise_edge_matrix.createEdgeSimMatrix(edgeFile,
+					   ms1Folder, folderName, *lambdas, *params)
+				   for folderName, params in zip(folderDic["direct"],
+												 settingList)]
+				  for edgeFile in edgeFileList]
+	directSeconds = time.perf_counter() - start
+
+	start = time.perf_counter()
+	manifest = artifact_cache.emptyManifest()
+	sweepList = [(folderName, lambdas + params)
+				 for folderName, params in zip(folderDic["sweep"], settingList)]
+	resultList = [pairwise_edge_matrix.sweepEdgeSimMatrix(edgeFile, ms1Folder,
+					  termFolder, sweepList, manifest)
+				  for edgeFile in edgeFileList]
+	sweepSeconds = time.perf_counter() - start
+
+	writeLogs(folderDic["direct"], directList)
+	writeLogs(folderDic["sweep"], resultList)
+	maxDiff = 0.0
+	for directResults, sweepResults in zip(directList, resultList):
+		for direct, sweep in zip(directResults, sweepResults):
+			if direct[3] != 0:
+				maxDiff = max(maxDiff, abs(sweep[3] - direct[3]) /
+									   abs(direct[3]))
+	return({"directSeconds":directSeconds, "sweepSeconds":sweepSeconds,
+			"maxPostNormDiff":maxDiff})
+
+
+def benchmarkSweep(cohortSize, topN, betaList, gammaList, mzTol, ticTol, seed,
+				   workFolder=None):
+	cleanUp = workFolder is None
+	if workFolder is None:
+		workFolder = tempfile.mkdtemp(prefix="ms1connect_sweep_")
+	settingList = [(alpha, beta, gamma)
+				   for beta, gamma in itertools.product(betaList, gammaList)]
+	try:
+		# compile the numba kernels before anything is timed
+		synthetic_features.generateCohort(workFolder + "/ms1", 2, 200,
+										  seed=seed)
+		runSweep(workFolder, settingList[:1], mzTol, ticTol)
+		shutil.rmtree(workFolder + "/ms1", ignore_errors=True)
+		synthetic_features.generateCohort(workFolder + "/ms1", cohortSize,
+										  topN, seed=seed)
+		result = runSweep(workFolder, settingList, mzTol, ticTol)
+	finally:
+		if cleanUp:
+			shutil.rmtree(workFolder, ignore_errors=True)
+	result.update({"cohortSize":cohortSize, "topN":topN,
+				   "numSettings":len(settingList)})
+	return(result)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Times a hyperparameter \
+sweep of the edge similarity matrix with and without the term cache on a \
+synthetic cohort.")
+	parser.add_argument("--cohortSize", help="Number of runs. Default=4",
+						type=int, default=4)
+	parser.add_argument("--topN", help="Number of MS1 features per run.\
+	Default=2000", type=int, default=2000)
+	parser.add_argument("--beta", help="Values of beta. Default=0.000001\
+	0.00001 0.0001", nargs="+", type=float, default=[0.000001, 0.00001, 0.0001])
+	parser.add_argument("--gamma", help="Values of gamma. Default=0.5 1 2",
+						nargs="+", type=float, default=[0.5, 1.0, 2.0])
+	parser.add_argument("--mzTol", help="m/z tolerance in ppm. Default=4",
+						type=float, default=4.0)
+	parser.add_argument("--ticTol", help="TIC tolerance. Default=1",
+						type=float, default=1.0)
+	parser.add_argument("--seed", help="Random seed. Default=0", type=int,
+						default=0)
+	parser.add_argument("--workFolder", help="Folder for intermediate files.\
+	Default=temporary folder")
+	parser.add_argument("--output", help="JSON file for the results")
+	args = parser.parse_args()
+
+	result = benchmarkSweep(args.cohortSize, args.topN, args.beta, args.gamma,
+							args.mzTol, args.ticTol, args.seed,
+							args.workFolder)
+	print("settings", "direct", "sweep", "maxPostNormDiff", sep='\t')
+	print(result["numSettings"], "%.4f" % result["directSeconds"],
+		  "%.4f" % result["sweepSeconds"], "%.2e" % result["maxPostNormDiff"],
+		  sep='\t')
+	if args.output is not None:
+		with open(args.output, 'w') as newFile:
+			json.dump(result, newFile, indent=1)
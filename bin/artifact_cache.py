@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+# Manifest of every intermediate artifact (MS1 feature files, edge files,
+# matroid files, term caches, edge similarity matrices and solver results).
+# Each artifact is stored with a key that hashes the contents of its inputs
+# and the parameters that affect it. An artifact is reused only if its key
+# matches, so changing a parameter recomputes the artifacts that depend on it
+# and nothing else.
+#
+#   {"digests": {path: {"size", "mtime_ns", "sha256"}},
+#    "artifacts": {path: {"key", "meta"}}}
+#
+# digests memoizes the content hash of a file by size and modification time
+# so large inputs (mzML) are only hashed once.
+
+# bump when the output of a stage changes for the same inputs
+stageVersion = {"features":1, "edges":1, "matroid":1, "terms":1, "pairwise":1,
+				"solver":1}
+
+chunkSize = 1 << 20
+
+
+###############################################################################
+def emptyManifest():
+	return({"digests":{}, "artifacts":{}})
+
+
+def loadManifest(fileName):
+	if not Path(fileName).is_file():
+		return(emptyManifest())
+	with open(fileName, 'r') as file1:
+		manifest = json.load(file1)
+	for section in ["digests", "artifacts"]:
+		manifest.setdefault(section, {})
+	return(manifest)
+
+
+def saveManifest(manifest, fileName):
+	tmpFileName = str(fileName) + ".tmp" + str(os.getpid())
+	with open(tmpFileName, 'w') as newFile:
+		json.dump(manifest, newFile, separators=(',',':'))
+	os.replace(tmpFileName, fileName)
+
+
+def _path(fileName):
+	return(os.path.normpath(str(fileName)))
+
+
+###############################################################################
+def fileDigest(fileName, manifest):
+	"""
+	sha256 of the contents of a file. The digest is memoized in manifest by
+	file size and modification time.
+	"""
+	path = _path(fileName)
+	stat = os.stat(path)
+	entry = manifest["digests"].get(path)
+	if entry is not None and entry["size"] == stat.st_size and \
+	   entry["mtime_ns"] == stat.st_mtime_ns:
+		return(entry["sha256"])
+
+	digest = hashlib.sha256()
+	with open(path, 'rb') as file1:
+		for chunk in iter(lambda: file1.read(chunkSize), b''):
+			digest.update(chunk)
+	manifest["digests"][path] = {"size":stat.st_size,
+								 "mtime_ns":stat.st_mtime_ns,
+								 "sha256":digest.hexdigest()}
+	return(digest.hexdigest())
+
+
+def artifactKey(stage, inputDigests, params):
+	"""
+	Key of an artifact from the digests of its inputs and the parameters of
+	the stage that creates it
+	"""
+	keyObject = {"stage":stage, "version":stageVersion[stage],
+				 "inputs":list(inputDigests), "params":params}
+	return(hashlib.sha256(json.dumps(keyObject, sort_keys=True).encode()
+						  ).hexdigest())
+
+
+def isFresh(manifest, fileName, key):
+	"""
+	True if the artifact exists and was created from the same inputs and
+	parameters
+	"""
+	entry = manifest["artifacts"].get(_path(fileName))
+	return(entry is not None and entry["key"] == key and
+		   Path(fileName).is_file())
+
+
+def isUnknown(manifest, fileName):
+	"""
+	True if the artifact is not in the manifest (for example created before the
+	manifest existed or supplied by the user)
+	"""
+	return(_path(fileName) not in manifest["artifacts"])
+
+
+def recordArtifact(manifest, fileName, key, meta=None):
+	manifest["artifacts"][_path(fileName)] = {"key":key, "meta":meta}
+
+
+def getMeta(manifest, fileName):
+	return(manifest["artifacts"][_path(fileName)]["meta"])
+
+
+def removeStale(fileName):
+	"""
+	Remove an artifact that is out of date so the stage recreates it
+	"""
+	if Path(fileName).is_file():
+		os.remove(fileName)
+
+
+###############################################################################
+def subManifest(manifest, fileNameList):
+	"""
+	Part of the manifest that covers fileNameList. Worker processes are given
+	only the entries of the artifacts they touch.
+	"""
+	sub = emptyManifest()
+	for fileName in fileNameList:
+		path = _path(fileName)
+		for section in ["digests", "artifacts"]:
+			if path in manifest[section]:
+				sub[section][path] = manifest[section][path]
+	return(sub)
+
+
+def mergeManifest(manifest, update):
+	for section in ["digests", "artifacts"]:
+		manifest[section].update(update[section])
@@ -6,15 +6,42 @@
 #include <chrono>
 #include <assert.h>
 #include <algorithm>
+#include <cstdint>
+#include <cstring>
+#include <cstdio>
+#include <cerrno>
+#include <cmath>
+#include <map>
+#include <mutex>
+#include <atomic>
+#include <thread>
+#include <unistd.h>
 using namespace std;
 
 // Inputs
 // 1) File containing MS1 features. Columns are mz,
-//    intensity, RT, pTIC, and charge. Sorted by mz
+//    intensity, RT, pTIC, and charge. Sorted by mz.
+//    Files ending in .bin are read as binary feature
+//    files (see bin/feature_store.py)
 // 2) Same type of input as 1)
-// 3) Output file name
+// 3) Output file name. Files ending in .bin are written
+//    as binary edge files (see bin/create_edge.py)
 // 4) m/z tolerance for edge creation (in ppm)
 // 5) pTIC tolerance for edge creation
+//
+// Many pairs can be run at once. Each feature file is
+// read once and the pairs are run by a pool of threads
+//   createEdge --manifest PAIRS MZTOL TICTOL [THREADS]
+//     PAIRS has one pair per line: left file, right file
+//     and output file separated by tabs
+//   createEdge --query QUERY OUTFOLDER FORMAT MZTOL TICTOL
+//              THREADS LIBRARY [LIBRARY ...]
+//     every library file against the query file. The file
+//     name that sorts first is the left file, the same
+//     pair order as getPairList in bin/create_edge.py.
+//     Output files are OUTFOLDER/left___right___score.FORMAT
+//     (txt or bin, same names as getEdgeFileName)
+// THREADS=0 (default) uses every core
 
 // # of columns in input 1 and 2 (note 0 index)
 int numCols = 5;
@@ -29,6 +56,19 @@ struct edge_struct {
 	double leftFileRT;
 };
 
+// MS1 features of one run, read once and shared by every
+// pair the run is in. Features are grouped by charge and
+// sorted by mz within a charge so a pair is only joined
+// over the charges both runs have.
+struct feature_index {
+	std::vector<double> lines; // row major, numCols columns
+	std::vector<int> charges; // sorted charges of the run
+	std::vector<int> chargeStart; // first position of each charge
+	std::vector<int> order; // feature index of each position
+	std::vector<double> mz; // mz of each position
+	std::vector<double> pTic; // pTIC of each position
+};
+
 bool cmp_edge(const edge_struct& edge1, const edge_struct& edge2)
 {
 	if (edge1.leftFileRT < edge2.leftFileRT) {
@@ -37,6 +77,8 @@ bool cmp_edge(const edge_struct& edge1, const edge_struct& edge2)
 	else if (edge1.leftFileRT == edge2.leftFileRT) {
 		if (edge1.leftIndex < edge2.leftIndex)
 			return true;
+		else if (edge1.leftIndex == edge2.leftIndex)
+			return edge1.rightIndex < edge2.rightIndex;
 		else
 			return false;
 	}
@@ -49,6 +91,10 @@ std::string readFileToMatrix(const std::string& fileName,
                       std::vector<double>& lines) {
 
 	std::ifstream inFile(fileName);
+	if (!inFile) {
+		cout << "Cannot read " << fileName << std::endl;
+		exit(1);
+	}
 	std::string header;	
 	std::string line;
 
@@ -62,141 +108,378 @@ std::string readFileToMatrix(const std::string& fileName,
 	return header;
 }
 
-double calcPpmDiff(double mass1, double mass2) {
-	// Calculate the difference in parts-per-million between two peptide masses.
-	// mass 1 is mass of precursor 1
-	// mass 2 is mass of precursor 2
-	// window is ppm window
-	double ppmDiff = (1000000 * (mass1 - mass2)) / (0.5 * (mass1 + mass2));
-	return ppmDiff;
+bool endsWith(const std::string& str, const std::string& suffix) {
+	return str.size() >= suffix.size() &&
+		   str.compare(str.size() - suffix.size(), suffix.size(), suffix) == 0;
 }
 
-int main(int argc, char * argv[])
-{
-	// check that argument count is correct
-	if (argc != 6) {
-		cout << "Not enough arguments" << std::endl;
-		exit(0);
-    }
-
-	// get arguments
-	std::string fileName1 = argv[1]; // filename of input 1
-	std::string fileName2 = argv[2]; // filename of input 2
-	std::string outFileName = argv[3]; // filename of output file
-	double mzTol = stof(argv[4]); // mz tolerance (in ppm)
-	double ticTol = stof(argv[5]); // pTIC tolerance
+// Reads a binary feature file written by bin/feature_store.py into the same
+// row major layout as readFileToMatrix. The file is a 16 byte header (magic,
+// version, number of rows) followed by the pTIC float64 column, the mz,
+// intensity and RT float32 columns and the int8 charge column. pTIC is
+// rounded to float to match readFileToMatrix.
+void readBinaryToMatrix(const std::string& fileName,
+						std::vector<double>& lines) {
 
-	std::vector<double> file1Vector;
-	std::vector<double> file2Vector;
-	std::vector<edge_struct> edgeVector;
+	std::ifstream inFile(fileName, std::ios::binary);
+	if (!inFile) {
+		cout << "Cannot read " << fileName << std::endl;
+		exit(1);
+	}
+	char magic[4];
+	uint32_t version;
+	uint64_t numRows;
+	inFile.read(magic, 4);
+	inFile.read(reinterpret_cast<char*>(&version), sizeof(version));
+	inFile.read(reinterpret_cast<char*>(&numRows), sizeof(numRows));
+	if (!inFile || std::memcmp(magic, "MS1F", 4) != 0 || version != 1) {
+		cout << fileName << " is not a MS1 feature binary file" << std::endl;
+		exit(1);
+	}
 
-	std::string header;
-	header = readFileToMatrix(fileName1,file1Vector);
-	readFileToMatrix(fileName2,file2Vector);
+	std::vector<double> pTicVals(numRows);
+	std::vector<float> floatCols(numRows * 3); // mz, intensity and RT
+	std::vector<int8_t> chargeVals(numRows);
+	inFile.read(reinterpret_cast<char*>(pTicVals.data()),
+				numRows * sizeof(double));
+	inFile.read(reinterpret_cast<char*>(floatCols.data()),
+				floatCols.size() * sizeof(float));
+	inFile.read(reinterpret_cast<char*>(chargeVals.data()), numRows);
 
-	std::cout << fileName1 << "\t" << fileName2 << std::endl;
+	lines.resize(numRows * numCols);
+	for (uint64_t i=0; i<numRows; i++) {
+		for (int col=0; col<3; col++) {
+			lines[numCols*i + col] = floatCols[numRows*col + i];
+		}
+		lines[numCols*i + pTicCol] = (float) pTicVals[i];
+		lines[numCols*i + chargeCol] = chargeVals[i];
+	}
+}
 
-	// calc number of rows
-	int numRowsFile1 = file1Vector.size() / numCols;
-	int numRowsFile2 = file2Vector.size() / numCols;
+void readFeatureFile(const std::string& fileName,
+					 std::vector<double>& lines) {
+	if (endsWith(fileName, ".bin")) {
+		readBinaryToMatrix(fileName, lines);
+	}
+	else {
+		readFileToMatrix(fileName, lines);
+	}
+}
 
-	int startIndex = 0; int endIndex = 0; int edgeCnt = 0;
-	double leftMz; double rightMz;
-	int breakLoop = 0; // becomes 1 when right file index goes past EOF
-	int leftCharge; int rightCharge;
-	double mzDiff; double ticDiff; double ppmDiff;
-	for (int i=0;i<numRowsFile1;i++) {
-		// mz is first column
-		leftMz = file1Vector[numCols*i];
-		rightMz = file2Vector[numCols*startIndex];
-		ppmDiff = calcPpmDiff(rightMz,leftMz);
+void buildFeatureIndex(feature_index& index) {
+	int numRows = index.lines.size() / numCols;
+	const std::vector<double>& lines = index.lines;
+	index.order.resize(numRows);
+	for (int i=0; i<numRows; i++) {
+		index.order[i] = i;
+	}
+	std::sort(index.order.begin(), index.order.end(),
+			  [&lines](int i, int j) {
+		int chargeI = lines[numCols*i + chargeCol];
+		int chargeJ = lines[numCols*j + chargeCol];
+		if (chargeI != chargeJ)
+			return chargeI < chargeJ;
+		if (lines[numCols*i] != lines[numCols*j])
+			return lines[numCols*i] < lines[numCols*j];
+		return i < j;
+	});
 
-		if (ppmDiff > mzTol) {
-			continue;
+	index.mz.resize(numRows);
+	index.pTic.resize(numRows);
+	for (int k=0; k<numRows; k++) {
+		int i = index.order[k];
+		int charge = lines[numCols*i + chargeCol];
+		if (index.charges.empty() || index.charges.back() != charge) {
+			index.charges.push_back(charge);
+			index.chargeStart.push_back(k);
 		}
+		index.mz[k] = lines[numCols*i];
+		index.pTic[k] = lines[numCols*i + pTicCol];
+	}
+	index.chargeStart.push_back(numRows);
+}
 
-		// get updated start index of file2
-		for (int j=startIndex;j<numRowsFile2;j++) {
-			rightMz = file2Vector[numCols*j];
-			ppmDiff = calcPpmDiff(leftMz,rightMz);
+// Writes the output file through a temporary file so other
+// processes never see a partially written edge file. Exits with 1
+// (and removes the temporary file) if the file cannot be written
+void writeOutput(const std::string& fileName, const char* data, size_t size) {
+	std::string tmpFileName = fileName + ".tmp" + std::to_string(getpid());
+	std::FILE* outFile = std::fopen(tmpFileName.c_str(), "wb");
+	if (outFile == NULL) {
+		cout << "Cannot write " << fileName << std::endl;
+		exit(1);
+	}
+	bool written = std::fwrite(data, 1, size, outFile) == size;
+	written = std::fclose(outFile) == 0 && written;
+	if (!written ||
+		std::rename(tmpFileName.c_str(), fileName.c_str()) != 0) {
+		cout << "Cannot write " << fileName << ": " << std::strerror(errno)
+			 << std::endl;
+		std::remove(tmpFileName.c_str());
+		exit(1);
+	}
+}
 
-			if (ppmDiff < mzTol) {
-				startIndex = j;
-				break;
-			}
+// Writes edges as a binary edge file. A 16 byte header (magic, version,
+// number of edges) followed by one packed record per edge (uint32 left index,
+// uint32 right index, float32 mzDiff, ticDiff and leftFileRT). buffer is
+// reused across pairs.
+void writeEdgeBinary(const std::string& fileName,
+					 const std::vector<edge_struct>& edgeVector,
+					 std::vector<char>& buffer) {
+	const uint32_t version = 1;
+	const uint64_t numEdges = edgeVector.size();
+	buffer.resize(16 + numEdges * 20);
+	char* pos = buffer.data();
+	std::memcpy(pos, "MS1E", 4); pos += 4;
+	std::memcpy(pos, &version, 4); pos += 4;
+	std::memcpy(pos, &numEdges, 8); pos += 8;
+	for (auto edge=edgeVector.begin(); edge!=edgeVector.end(); ++edge) {
+		uint32_t leftIndex = (*edge).leftIndex;
+		uint32_t rightIndex = (*edge).rightIndex;
+		float mzDiff = (*edge).mzDiff;
+		float ticDiff = (*edge).ticDiff;
+		float leftFileRT = (*edge).leftFileRT;
+		std::memcpy(pos, &leftIndex, 4); pos += 4;
+		std::memcpy(pos, &rightIndex, 4); pos += 4;
+		std::memcpy(pos, &mzDiff, 4); pos += 4;
+		std::memcpy(pos, &ticDiff, 4); pos += 4;
+		std::memcpy(pos, &leftFileRT, 4); pos += 4;
+	}
+	writeOutput(fileName, buffer.data(), buffer.size());
+}
 
-			if (j == numRowsFile2 - 1 ) { // reached EOF
-				breakLoop = 1;
-			}
+// Writes edges as a text edge file. Lines are formatted
+// into buffer (reused across pairs) and written at once.
+// Numbers are formatted the same as an ostream (%g).
+void writeEdgeText(const std::string& fileName,
+				   const std::vector<edge_struct>& edgeVector,
+				   std::vector<char>& buffer) {
+	const char header[] =
+		"leftFileIndex\trightFileIndex\tmzDiff\tticDiff\tleftFileRT\n";
+	buffer.assign(header, header + sizeof(header) - 1);
+	char line[128];
+	for (auto edge=edgeVector.begin(); edge!=edgeVector.end(); ++edge) {
+		int size = std::snprintf(line, sizeof(line), "%d\t%d\t%g\t%g\t%g\n",
+								 (*edge).leftIndex, (*edge).rightIndex,
+								 (*edge).mzDiff, (*edge).ticDiff,
+								 (*edge).leftFileRT);
+		buffer.insert(buffer.end(), line, line + size);
+	}
+	writeOutput(fileName, buffer.data(), buffer.size());
+}
+
+double calcPpmDiff(double mass1, double mass2) {
+	// Calculate the difference in parts-per-million between two peptide masses.
+	// mass 1 is mass of precursor 1
+	// mass 2 is mass of precursor 2
+	// window is ppm window
+	double ppmDiff = (1000000 * (mass1 - mass2)) / (0.5 * (mass1 + mass2));
+	return ppmDiff;
+}
+
+// Creates the edges of a pair. An edge is created between
+// a left and right MS1 feature when they are within mzTol
+// ppm and ticTol pTIC and have the same charge. Only
+// charges both runs have are joined. edgeVector is reused
+// across pairs.
+void createEdges(const feature_index& left, const feature_index& right,
+				 double mzTol, double ticTol,
+				 std::vector<edge_struct>& edgeVector) {
+	edgeVector.clear();
+	size_t rightCharge = 0;
+	for (size_t c=0; c<left.charges.size(); c++) {
+		while (rightCharge < right.charges.size() &&
+			   right.charges[rightCharge] < left.charges[c]) {
+			rightCharge++;
 		}
-		
-		if (breakLoop == 1) { // right file start index past EOF
+		if (rightCharge == right.charges.size()) {
 			break;
 		}
+		if (right.charges[rightCharge] != left.charges[c]) {
+			continue;
+		}
 
-		// get update end index of file 2
-		for (int j=endIndex; j<numRowsFile2; j++) {
-			rightMz = file2Vector[numCols*j];
-			ppmDiff = calcPpmDiff(rightMz, leftMz);
-			if (ppmDiff >= mzTol) {
-				endIndex = j;
-				break;
+		// both charge partitions are sorted by mz, so the
+		// start of the mz window only moves forward
+		int startIndex = right.chargeStart[rightCharge];
+		int endIndex = right.chargeStart[rightCharge + 1];
+		for (int i=left.chargeStart[c]; i<left.chargeStart[c+1]; i++) {
+			double leftMz = left.mz[i];
+			while (startIndex < endIndex &&
+				   calcPpmDiff(leftMz, right.mz[startIndex]) > mzTol) {
+				startIndex++;
 			}
+			for (int k=startIndex; k<endIndex; k++) {
+				double mzDiff = calcPpmDiff(leftMz, right.mz[k]);
+				if (mzDiff < -mzTol) {
+					break;
+				}
+				double ticDiff = left.pTic[i] - right.pTic[k];
+				if (std::fabs(ticDiff) > ticTol) {
+					continue;
+				}
 
-			if (j == numRowsFile2-1) {
-				endIndex=j;
+				edge_struct newEdge;
+				newEdge.leftIndex = left.order[i];
+				newEdge.rightIndex = right.order[k];
+				newEdge.mzDiff = mzDiff;
+				newEdge.ticDiff = ticDiff;
+				newEdge.leftFileRT = left.pTic[i];
+				edgeVector.push_back(newEdge);
 			}
 		}
+	}
 
-		for (int k=startIndex; k<=endIndex; k++) {
-			// header line is skipped when reading in file
-			mzDiff = calcPpmDiff(leftMz,file2Vector[numCols*k]);
+	// sort edges by retention time of the feaure in the left file
+	std::sort(edgeVector.begin(), edgeVector.end(), cmp_edge);
+}
 
-			// need b/c of edges case
-			if (abs(mzDiff) > mzTol) {
-				continue;
+// Runs job(i) for i in [0, numJobs) on a pool of threads
+template <typename Job>
+void runPool(size_t numJobs, int numThreads, Job job) {
+	std::atomic<size_t> nextJob(0);
+	std::vector<std::thread> threads;
+	if (numThreads <= 0) {
+		numThreads = std::max(1u, std::thread::hardware_concurrency());
+	}
+	numThreads = std::min<size_t>(numThreads, std::max<size_t>(numJobs, 1));
+	for (int t=0; t<numThreads; t++) {
+		threads.push_back(std::thread([&nextJob, numJobs, &job]() {
+			for (size_t i=nextJob++; i<numJobs; i=nextJob++) {
+				job(i);
 			}
+		}));
+	}
+	for (auto thread=threads.begin(); thread!=threads.end(); ++thread) {
+		(*thread).join();
+	}
+}
 
-			ticDiff = file1Vector[numCols*i + pTicCol] - file2Vector[numCols*k + pTicCol];
-			if (abs(ticDiff) > ticTol) {
-				continue;
+// Creates the edge files of every (left file, right file,
+// output file) pair. Each feature file is read and indexed
+// once and the pairs are run by numThreads threads, each
+// with its own edge and output buffers.
+void createEdgeFiles(const std::vector<std::vector<std::string> >& pairList,
+					 double mzTol, double ticTol, int numThreads) {
+	std::map<std::string, size_t> fileIndex;
+	std::vector<std::string> fileList;
+	for (auto pair=pairList.begin(); pair!=pairList.end(); ++pair) {
+		for (int side=0; side<2; side++) {
+			if (fileIndex.count((*pair)[side]) == 0) {
+				fileIndex[(*pair)[side]] = fileList.size();
+				fileList.push_back((*pair)[side]);
 			}
+		}
+	}
 
-			leftCharge = file1Vector[numCols*i + chargeCol];
-			rightCharge = file2Vector[numCols*k + chargeCol];
-			if (leftCharge != rightCharge) {
-				continue;
-			}
+	std::vector<feature_index> indexList(fileList.size());
+	runPool(fileList.size(), numThreads, [&](size_t i) {
+		readFeatureFile(fileList[i], indexList[i].lines);
+		buildFeatureIndex(indexList[i]);
+	});
 
-			edge_struct newEdge;
-			newEdge.leftIndex = i;
-			newEdge.rightIndex = k;
-			newEdge.mzDiff = mzDiff;
-			newEdge.ticDiff = ticDiff;
-			newEdge.leftFileRT = file1Vector[numCols*i + pTicCol];
-			edgeVector.push_back(newEdge);
+	std::mutex outputLock;
+	runPool(pairList.size(), numThreads, [&](size_t i) {
+		thread_local std::vector<edge_struct> edgeVector;
+		thread_local std::vector<char> buffer;
+		const std::vector<std::string>& pair = pairList[i];
+		createEdges(indexList[fileIndex.at(pair[0])],
+					indexList[fileIndex.at(pair[1])], mzTol, ticTol, edgeVector);
+		if (endsWith(pair[2], ".bin")) {
+			writeEdgeBinary(pair[2], edgeVector, buffer);
+		}
+		else {
+			writeEdgeText(pair[2], edgeVector, buffer);
+		}
+		std::lock_guard<std::mutex> lock(outputLock);
+		std::cout << pair[0] << "\t" << pair[1] << '\n';
+	});
+	std::cout.flush();
+}
+
+// Reads a manifest of pairs (left file, right file and
+// output file separated by tabs, one pair per line)
+void readManifest(const std::string& fileName,
+				  std::vector<std::vector<std::string> >& pairList) {
+	std::ifstream inFile(fileName);
+	if (!inFile) {
+		cout << "Cannot read " << fileName << std::endl;
+		exit(1);
+	}
+	std::string line;
+	while (std::getline(inFile,line)) {
+		if (line.empty()) {
+			continue;
+		}
+		std::vector<std::string> pair;
+		std::stringstream ss(line);
+		std::string field;
+		while (getline(ss,field,'\t')) {
+			pair.push_back(field);
+		}
+		if (pair.size() != 3) {
+			cout << "Bad line in " << fileName << ": " << line << std::endl;
+			exit(1);
 		}
+		pairList.push_back(pair);
 	}
+}
 
-	// sort edges by retention time of the feaure in the left file
-	// and write edges to output file
-	std::ofstream outFile(outFileName);
-	outFile << "leftFileIndex\trightFileIndex\tmzDiff\tticDiff\tleftFileRT" <<
-			   std::endl;
-	std::sort(edgeVector.begin(), edgeVector.end(), cmp_edge);
-	for (auto edge=edgeVector.begin(); edge!=edgeVector.end(); ++edge) {
-		outFile << (*edge).leftIndex << '\t'; // left file line index
-		outFile << (*edge).rightIndex << '\t'; // right file line index
-		outFile << (*edge).mzDiff << '\t';
-		outFile << (*edge).ticDiff <<  '\t';
-		outFile << (*edge).leftFileRT;
-		outFile << std::endl;
-		edgeCnt += 1;
-	}
-	outFile.close();
-
-	//std::cout << "nrow: " << numRowsFile1 << '\t' << numRowsFile2 << std::endl;
-	//std::cout << "Total # edges: " << edgeCnt << std::endl;
-	//std::cout << "Done" << std::endl << std::endl;
+// Run name of a feature file, the same as cleanFileName in
+// bin/create_edge.py
+std::string cleanFileName(const std::string& fileName) {
+	std::string name = fileName.substr(fileName.find_last_of('/') + 1);
+	size_t dot = name.find_last_of('.');
+	if (dot != std::string::npos && dot > 0) {
+		name = name.substr(0, dot);
+	}
+	size_t peak;
+	while ((peak = name.find("_ms1Peak")) != std::string::npos) {
+		name.erase(peak, 8);
+	}
+	return name;
+}
+
+int main(int argc, char * argv[])
+{
+	if (argc >= 5 && std::string(argv[1]) == "--manifest") {
+		std::vector<std::vector<std::string> > pairList;
+		readManifest(argv[2], pairList);
+		int numThreads = argc > 5 ? std::stoi(argv[5]) : 0;
+		createEdgeFiles(pairList, stof(argv[3]), stof(argv[4]), numThreads);
+		return 0;
+	}
+	if (argc >= 9 && std::string(argv[1]) == "--query") {
+		std::string queryFile = argv[2];
+		std::string outFolder = argv[3];
+		std::string format = argv[4];
+		std::vector<std::vector<std::string> > pairList;
+		for (int i=8; i<argc; i++) {
+			std::string leftFile = std::min(queryFile, std::string(argv[i]));
+			std::string rightFile = std::max(queryFile, std::string(argv[i]));
+			pairList.push_back({leftFile, rightFile, outFolder + "/" +
+								cleanFileName(leftFile) + "___" +
+								cleanFileName(rightFile) + "___score." + format});
+		}
+		createEdgeFiles(pairList, stof(argv[5]), stof(argv[6]),
+						std::stoi(argv[7]));
+		return 0;
+	}
+
+	// check that argument count is correct
+	if (argc != 6) {
+		cout << "Not enough arguments" << std::endl;
+		exit(0);
+    }
+
+	// get arguments
+	std::string fileName1 = argv[1]; // filename of input 1
+	std::string fileName2 = argv[2]; // filename of input 2
+	std::string outFileName = argv[3]; // filename of output file
+	double mzTol = stof(argv[4]); // mz tolerance (in ppm)
+	double ticTol = stof(argv[5]); // pTIC tolerance
+
+	createEdgeFiles({{fileName1, fileName2, outFileName}}, mzTol, ticTol, 1);
 	return 0;
 }
@@ -3,7 +3,49 @@ import glob
 import os
 import subprocess
 import re
+import numpy as np
 from pathlib import Path
+from bin import feature_store
+
+# indicies for MS1 feature file
+mzCol = 0
+pticCol = 3
+chargeCol = 4
+
+# header of edge file (same as createEdge)
+edgeHeader = "leftFileIndex\trightFileIndex\tmzDiff\tticDiff\tleftFileRT"
+
+# Binary edge file (___score.bin). A 16 byte header (magic, version, number of
+# edges) followed by one packed little endian record per edge with the same
+# fields as the text edge file
+edgeMagic = b"MS1E"
+edgeVersion = 1
+edgeHeaderDtype = np.dtype([("magic", "S4"), ("version", "<u4"),
+							("nEdge", "<u8")])
+edgeDtype = np.dtype([("leftFileIndex", "<u4"), ("rightFileIndex", "<u4"),
+					  ("mzDiff", "<f4"), ("ticDiff", "<f4"),
+					  ("leftFileRT", "<f4")])
+edgeExt = {"txt":"___score.txt", "bin":"___score.bin"}
+# superset edge file built at the widest tolerance of a tolerance sweep
+# (binary edge file format)
+supersetExt = "___superset.bin"
+
+# indicies for edge file
+leftPeakIndex = 0
+rightPeakIndex = 1
+
+# finest pTIC bucket level of a feature index (2**6 buckets, see
+# buildFeatureIndex) and how much the pTIC and m/z windows of a join are
+# widened so rounding never drops a feature (candidates are then filtered
+# exactly)
+maxBucketLevel = 6
+indexSlack = 1e-9
+# pTIC buckets only pay for their extra m/z searches when the m/z windows of
+# a join hold more than this many features per left feature on average
+denseWindow = 16
+
+# feature indexes built by this process (see loadFeatureIndex)
+_indexCache = {}
 
 # clean file name needs to be changed
 def cleanFileName(fileName):
@@ -11,11 +53,13 @@ def cleanFileName(fileName):
 	fileName = re.sub('_ms1Peak','',fileName)
 	return(fileName)
 
-def create_edges(inputFolderName,outputFolderName,binaryPath, mz_tol,\
-				 tic_tol):
-	if os.path.isdir(outputFolderName) == False:
-		os.mkdir(outputFolderName)
-
+def getPairList(inputFolderName):
+	"""
+	List every pair of MS1 feature files (including each file with itself)
+	in the order edges are generated
+	Input: folder that contains MS1 feature files
+	Output: list of (left file, right file) tuples
+	"""
 	fileList = [] # list of file names
 	for f in glob.glob(inputFolderName+'/*_ms1Peak.txt'):
 		fileList.append(f)
@@ -23,15 +67,459 @@ def create_edges(inputFolderName,outputFolderName,binaryPath, mz_tol,\
 	# TODO need better way to check if two files have been compared
 	# ie x___y___score.txt is the same as y___x___.score.txt
 	fileList.sort()
+	pairList = []
 	for i in range(0,len(fileList)):
 		for j in range(i,len(fileList)):
-			leftFile = fileList[i]
-			rightFile = fileList[j]
-			outFile = outputFolderName + '/' + \
-					  cleanFileName(leftFile) + "___" + \
-					  cleanFileName(rightFile) + "___score.txt"
-
-			if Path(outFile).is_file():
-				continue
-			subprocess.call([binaryPath, leftFile, rightFile, outFile,
-							str(mz_tol), str(tic_tol)])
+			pairList.append((fileList[i],fileList[j]))
+	return(pairList)
+
+def getEdgeFileName(leftFile, rightFile, outputFolderName, edgeFormat="txt"):
+	return(outputFolderName + '/' + cleanFileName(leftFile) + "___" + \
+		   cleanFileName(rightFile) + edgeExt[edgeFormat])
+
+def getSupersetFileName(leftFile, rightFile, outputFolderName):
+	return(outputFolderName + '/' + cleanFileName(leftFile) + "___" + \
+		   cleanFileName(rightFile) + supersetExt)
+
+def createEdge(leftFile, rightFile, outFile, binaryPath, mz_tol, tic_tol):
+	"""
+	Generate the edge file for a single pair of MS1 feature files
+	"""
+	if Path(outFile).is_file():
+		return
+	returnCode = subprocess.call([binaryPath, leftFile, rightFile, outFile,
+								  str(mz_tol), str(tic_tol)])
+	if returnCode != 0:
+		raise Exception("createEdge failed with code " + str(returnCode) +
+						" on " + str(leftFile) + " and " + str(rightFile))
+
+def createEdgeFiles(pairList, binaryPath, mz_tol, tic_tol, threads=0):
+	"""
+	Generate the edge files of many pairs of MS1 feature files with a single
+	call of the createEdge binary (manifest mode). Each feature file is read
+	once and the pairs are run by a pool of threads. Edge files that already
+	exist are skipped.
+
+	Parameters
+	----------
+	pairList : list
+		List of (left file, right file, edge file) tuples
+	binaryPath : str
+		createEdge binary
+	mz_tol : float
+		m/z tolerance in ppm
+	tic_tol : float
+		pTIC tolerance
+	threads : int
+		Number of threads. 0 uses every core.
+	"""
+	pairList = [x for x in pairList if not Path(x[2]).is_file()]
+	if len(pairList) == 0:
+		return
+	manifestFile = str(Path(pairList[0][2]).parent) + "/createEdge.pairs.tmp" + \
+				   str(os.getpid())
+	with open(manifestFile, 'w') as newFile:
+		for leftFile, rightFile, outFile in pairList:
+			newFile.write(str(leftFile) + "\t" + str(rightFile) + "\t" +
+						  str(outFile) + "\n")
+	try:
+		returnCode = subprocess.call([binaryPath, "--manifest", manifestFile,
+									  str(mz_tol), str(tic_tol), str(threads)],
+									 stdout=subprocess.DEVNULL)
+	finally:
+		os.remove(manifestFile)
+	if returnCode != 0:
+		raise Exception("createEdge failed with code " + str(returnCode))
+
+###############################################################################
+def buildFeatureIndex(features):
+	"""
+	Index of the MS1 features of a run for edge generation. Built once per run
+	(see loadFeatureIndex) and used for every pair the run is in.
+
+	Features are grouped by charge and, within a charge, by pTIC bucket and
+	sorted by m/z. Level k of the index splits pTIC [0, 1] into 2**k buckets
+	(pTIC outside [0, 1] goes to the first or last bucket). Each (charge,
+	bucket) group is a segment and the features are sorted by a key of segment
+	* mzSpan + m/z, so every segment is a contiguous m/z sorted block that can
+	be searched with a single np.searchsorted. Levels are built on first use
+	(see getIndexLevel).
+
+	Parameters
+	----------
+	features : numpy array
+		MS1 features of the run (see readFeatureFile)
+
+	Returns
+	-------
+	index : dict
+		features : the features (read-only)
+		charges : sorted charges of the run
+		chargeRank : position of the charge of each feature in charges
+		mzSpan : power of two larger than every m/z
+		levels : level to (order, segment, key, m/z, pTIC) of the features
+				 sorted by key
+	"""
+	features = np.asarray(features, dtype=np.float64).view()
+	features.flags.writeable = False
+	charges, chargeRank = np.unique(features[:,chargeCol].astype(int),
+									return_inverse=True)
+	maxMz = np.max(features[:,mzCol]) if features.shape[0] > 0 else 0.0
+	return({"features":features, "charges":charges,
+			"chargeRank":chargeRank.reshape(-1),
+			"mzSpan":2.0 ** np.ceil(np.log2(max(maxMz, 1.0) + 1.0)),
+			"levels":{}})
+
+
+def getPticBucket(ptic, level):
+	"""
+	pTIC bucket of level (see buildFeatureIndex)
+	"""
+	nBucket = 2 ** level
+	return(np.clip(np.floor(ptic * nBucket), 0, nBucket - 1).astype(np.int64))
+
+
+def getIndexLevel(index, level):
+	"""
+	Features of index sorted by (charge, pTIC bucket, m/z) at level
+	Output1: order, feature index of each sorted position
+	Output2: segment (charge rank * 2**level + pTIC bucket) of each position
+	Output3: sort key (segment * mzSpan + m/z) of each position
+	Output4: m/z of each position
+	Output5: pTIC of each position
+	"""
+	if level not in index["levels"]:
+		features = index["features"]
+		segment = index["chargeRank"] * (2 ** level) + \
+				  getPticBucket(features[:,pticCol], level)
+		key = segment * index["mzSpan"] + features[:,mzCol]
+		order = np.argsort(key, kind='stable')
+		index["levels"][level] = (order, segment[order], key[order],
+								  features[order,mzCol], features[order,pticCol])
+	return(index["levels"][level])
+
+
+def getBucketLevel(tic_tol):
+	"""
+	Finest level whose pTIC buckets are wider than tic_tol, so a feature only
+	has to be compared with its own and the two neighbouring buckets
+	"""
+	return(int(np.clip(np.floor(-np.log2(max(tic_tol, 0) + indexSlack)), 0,
+					   maxBucketLevel)))
+
+
+def loadFeatureIndex(fileName):
+	"""
+	Feature index (see buildFeatureIndex) of a MS1 feature file. The index is
+	kept for as long as the binary feature file does not change, so each run
+	is read and indexed once per process.
+	"""
+	store = feature_store.loadFeatures(fileName)
+	binaryFileName = feature_store.getBinaryFileName(fileName)
+	key = (binaryFileName, Path(binaryFileName).stat().st_mtime_ns)
+	if key not in _indexCache:
+		features = feature_store.featureMatrix(store)
+		_indexCache[key] = buildFeatureIndex(
+			features.astype(np.float32).astype(np.float64))
+	return(_indexCache[key])
+
+
+def readFeatureFile(fileName):
+	"""
+	Read a MS1 feature file from its binary feature file (see feature_store).
+	Values are rounded to 32 bit floats, the same as createEdge.
+	Input: MS1 feature file name
+	Output: matrix of MS1 features (one row per feature). Read-only, it is
+			shared with the feature index of the file
+	"""
+	return(loadFeatureIndex(fileName)["features"])
+
+
+def calcPpmDiff(mass1, mass2):
+	"""
+	Calculate the difference in parts-per-million between two peptide masses.
+	"""
+	return((1000000 * (mass1 - mass2)) / (0.5 * (mass1 + mass2)))
+
+
+def joinFeatureIndex(leftRun, rightRun, mz_tol, tic_tol):
+	"""
+	Edges between two feature indexes (see buildEdges). Each left feature is
+	only compared with the right features of the same charge. When the m/z
+	windows are dense (more than denseWindow candidates per left feature) and
+	tic_tol is narrow, it is also only compared with its own pTIC bucket and,
+	when its pTIC is within tic_tol of the bucket edge, the neighbouring
+	bucket. Left features are taken in the order of their own index so the m/z
+	windows are searched in sorted order.
+
+	Parameters
+	----------
+	leftRun : dict
+		Feature index of the left run (see buildFeatureIndex)
+	rightRun : dict
+		Feature index of the right run
+	mz_tol : float
+		m/z tolerance in ppm
+	tic_tol : float
+		pTIC tolerance
+
+	Returns
+	-------
+	edges : numpy array
+		Same as buildEdges
+	"""
+	halfTol = mz_tol * 0.5e-6
+	charges = rightRun["charges"]
+
+	def findWindows(level):
+		"""
+		Left features with a charge in the right run, their segment in the
+		right index and the m/z window of each at level
+		"""
+		nBucket = 2 ** level
+		leftOrder, leftSegment, _, leftMz, leftPtic = getIndexLevel(leftRun,
+																	level)
+		leftCharge = leftRun["charges"][leftSegment // nBucket]
+		chargeRank = np.minimum(np.searchsorted(charges, leftCharge),
+								max(charges.size - 1, 0))
+		query = np.nonzero(charges[chargeRank] == leftCharge)[0] \
+				if charges.size > 0 else np.zeros(0, dtype=np.int64)
+		leftBucket = leftSegment[query] % nBucket
+		# m/z window, widened slightly and then filtered using the segment and
+		# the exact ppm difference
+		return({"level":level, "order":leftOrder[query], "mz":leftMz[query],
+				"ptic":leftPtic[query], "bucket":leftBucket,
+				"segment":chargeRank[query] * nBucket + leftBucket,
+				"lowerMz":leftMz[query] * (1 - halfTol) / (1 + halfTol) * \
+						  (1 - indexSlack),
+				"upperMz":leftMz[query] * (1 + halfTol) / (1 - halfTol) * \
+						  (1 + indexSlack)})
+
+	def searchWindows(left, query, shift):
+		"""
+		Start and end (sorted position in the right index) of the m/z window
+		of each query in the segment shift buckets away
+		"""
+		key = getIndexLevel(rightRun, left["level"])[2]
+		offset = (left["segment"][query] + shift) * rightRun["mzSpan"]
+		return(np.searchsorted(key, offset + left["lowerMz"][query], 'left'),
+			   np.searchsorted(key, offset + left["upperMz"][query], 'right'))
+
+	left = findWindows(0)
+	query = np.arange(left["order"].size)
+	startIndex, endIndex = searchWindows(left, query, 0)
+	passList = [(left, query, 0, startIndex, endIndex)]
+	level = getBucketLevel(tic_tol)
+	if level > 0 and np.sum(endIndex - startIndex) > denseWindow * query.size:
+		left = findWindows(level)
+		passList = []
+		for shift in [-1, 0, 1]:
+			# left features with a pTIC window that reaches the shifted bucket
+			query = np.arange(left["order"].size)
+			if shift != 0:
+				query = np.nonzero((getPticBucket(left["ptic"] + shift * \
+					(tic_tol + indexSlack), level) != left["bucket"]) & \
+					(left["bucket"] + shift >= 0) & \
+					(left["bucket"] + shift < 2 ** level))[0]
+			passList.append((left, query, shift) +
+							searchWindows(left, query, shift))
+
+	edgeList = []
+	for left, query, shift, startIndex, endIndex in passList:
+		rightOrder, segment, _, rightMz, rightPtic = \
+			getIndexLevel(rightRun, left["level"])
+
+		# expand each window to (query, sorted right position) candidates
+		windowSize = endIndex - startIndex
+		queryIndex = np.repeat(query, windowSize)
+		windowStart = np.cumsum(windowSize) - windowSize
+		position = np.repeat(startIndex - windowStart, windowSize) + \
+				   np.arange(queryIndex.size)
+
+		mzDiff = calcPpmDiff(left["mz"][queryIndex], rightMz[position])
+		ticDiff = left["ptic"][queryIndex] - rightPtic[position]
+		keep = (segment[position] == left["segment"][queryIndex] + shift) & \
+			   (np.abs(mzDiff) <= mz_tol) & (np.abs(ticDiff) <= tic_tol)
+		edgeList.append((left["order"][queryIndex[keep]],
+						 rightOrder[position[keep]], mzDiff[keep],
+						 ticDiff[keep]))
+	leftIndex, rightIndex, mzDiff, ticDiff = [np.concatenate(x)
+											  for x in zip(*edgeList)]
+	leftFileRT = leftRun["features"][leftIndex,pticCol]
+
+	# sort edges by retention time of the feature in the left file
+	order = np.lexsort((rightIndex, leftIndex, leftFileRT))
+	edges = np.column_stack((leftIndex[order], rightIndex[order],
+							 mzDiff[order], ticDiff[order],
+							 leftFileRT[order])).astype(np.float64)
+	return(edges)
+
+
+def buildEdges(leftFeatures, rightFeatures, mz_tol, tic_tol):
+	"""
+	In-process version of createEdge. An edge is created between a left and
+	right MS1 feature when they are within mz_tol ppm and tic_tol pTIC and have
+	the same charge. Use joinFeatureIndex with loadFeatureIndex to reuse the
+	index of a run across pairs.
+
+	Parameters
+	----------
+	leftFeatures : numpy array
+		MS1 features of the left run (see readFeatureFile)
+	rightFeatures : numpy array
+		MS1 features of the right run
+	mz_tol : float
+		m/z tolerance in ppm
+	tic_tol : float
+		pTIC tolerance
+
+	Returns
+	-------
+	edges : numpy array
+		One row per edge with the same columns as the edge file (left index,
+		right index, mzDiff, ticDiff, leftFileRT). Sorted by the pTIC of the
+		left feature. Ties are broken by left and then right feature index
+		(createEdge leaves the order of ties unspecified).
+	"""
+	return(joinFeatureIndex(buildFeatureIndex(leftFeatures),
+							buildFeatureIndex(rightFeatures), mz_tol, tic_tol))
+
+
+def writeEdgeFile(edges, outFile):
+	"""
+	Write edges in the same text format as createEdge
+	"""
+	np.savetxt(outFile, edges, fmt=['%d','%d','%g','%g','%g'], delimiter='\t',
+			   header=edgeHeader, comments='')
+
+
+def writeEdgeBinary(edges, outFile):
+	"""
+	Write edges (see buildEdges) to a binary edge file
+	"""
+	records = np.empty(edges.shape[0], dtype=edgeDtype)
+	for col, name in enumerate(edgeDtype.names):
+		records[name] = edges[:,col]
+	header = np.array([(edgeMagic, edgeVersion, records.size)],
+					  dtype=edgeHeaderDtype)
+	tmpFileName = str(outFile) + ".tmp" + str(os.getpid())
+	with open(tmpFileName, 'wb') as newFile:
+		header.tofile(newFile)
+		records.tofile(newFile)
+	os.replace(tmpFileName, outFile)
+
+
+def loadEdges(fileName):
+	"""
+	Load an edge file. Binary edge files (___score.bin and ___superset.bin)
+	are memory mapped.
+	Output: text edge files give a matrix with one row per edge. Binary edge
+			files give a record array (see edgeDtype). Use getEdgeColumn to
+			read either.
+	"""
+	if str(fileName).endswith(".bin"):
+		header = np.fromfile(fileName, dtype=edgeHeaderDtype, count=1)
+		if header.size != 1 or header["magic"][0] != edgeMagic or \
+		   header["version"][0] != edgeVersion:
+			raise Exception(str(fileName) + " is not a binary edge file")
+		nEdge = int(header["nEdge"][0])
+		if nEdge == 0:
+			return(np.zeros(0, dtype=edgeDtype))
+		return(np.memmap(fileName, dtype=edgeDtype, mode='r',
+						 offset=edgeHeaderDtype.itemsize, shape=(nEdge,)))
+	edges = np.loadtxt(fileName, delimiter='\t', skiprows=1, ndmin=2)
+	return(edges.reshape(-1, len(edgeDtype.names)))
+
+
+def getEdgeColumn(edges, col):
+	"""
+	Column col of edges loaded by loadEdges or built by buildEdges
+	"""
+	if edges.dtype.names is not None:
+		return(edges[edges.dtype.names[col]])
+	return(edges[:,col])
+
+
+def createEdgeInProcess(leftFile, rightFile, outFile, mz_tol, tic_tol):
+	"""
+	Generate the edge file for a single pair of MS1 feature files without
+	calling the createEdge binary. The edge file is binary if outFile ends in
+	.bin (___score.bin or ___superset.bin).
+	Output: edges (see buildEdges). None if the edge file already exists
+	"""
+	if Path(outFile).is_file():
+		return(None)
+	edges = joinFeatureIndex(loadFeatureIndex(leftFile),
+							 loadFeatureIndex(rightFile), mz_tol, tic_tol)
+	if str(outFile).endswith(".bin"):
+		writeEdgeBinary(edges, outFile)
+	else:
+		writeEdgeFile(edges, outFile)
+	return(edges)
+
+
+###############################################################################
+def filterEdges(edges, leftFeatures, rightFeatures, mz_tol, tic_tol):
+	"""
+	Edges of a superset edge set (built at a wider tolerance) that are within
+	mz_tol ppm and tic_tol pTIC. mzDiff and ticDiff are recomputed from the
+	MS1 features so the result is the same as buildEdges at mz_tol and
+	tic_tol, without rounding from the edge file. Masking keeps the order of
+	the superset (sorted by leftFileRT).
+
+	Parameters
+	----------
+	edges : numpy array
+		Superset edges (see loadEdges or buildEdges)
+	leftFeatures : numpy array
+		MS1 features of the left run (see readFeatureFile)
+	rightFeatures : numpy array
+		MS1 features of the right run
+	mz_tol : float
+		m/z tolerance in ppm
+	tic_tol : float
+		pTIC tolerance
+
+	Returns
+	-------
+	edges : numpy array
+		Same columns as buildEdges
+	"""
+	leftIndex = getEdgeColumn(edges, leftPeakIndex).astype(np.int64)
+	rightIndex = getEdgeColumn(edges, rightPeakIndex).astype(np.int64)
+	mzDiff = calcPpmDiff(leftFeatures[leftIndex,mzCol],
+						 rightFeatures[rightIndex,mzCol])
+	ticDiff = leftFeatures[leftIndex,pticCol] - rightFeatures[rightIndex,pticCol]
+	keep = (np.abs(mzDiff) <= mz_tol) & (np.abs(ticDiff) <= tic_tol)
+	return(np.column_stack((leftIndex[keep], rightIndex[keep], mzDiff[keep],
+							ticDiff[keep],
+							leftFeatures[leftIndex[keep],pticCol])
+						   ).astype(np.float64).reshape(-1, len(edgeDtype.names)))
+
+
+def createEdgeFromSuperset(leftFile, rightFile, supersetFile, outFile, mz_tol,
+						   tic_tol):
+	"""
+	Generate the edge file for a single pair of MS1 feature files by
+	filtering its superset edge file (see filterEdges). The edge file is
+	binary if outFile ends in ___score.bin.
+	Output: edges (see buildEdges)
+	"""
+	edges = filterEdges(loadEdges(supersetFile), readFeatureFile(leftFile),
+						readFeatureFile(rightFile), mz_tol, tic_tol)
+	if str(outFile).endswith(edgeExt["bin"]):
+		writeEdgeBinary(edges, outFile)
+	else:
+		writeEdgeFile(edges, outFile)
+	return(edges)
+
+
+def create_edges(inputFolderName,outputFolderName,binaryPath, mz_tol,\
+				 tic_tol):
+	if os.path.isdir(outputFolderName) == False:
+		os.mkdir(outputFolderName)
+
+	createEdgeFiles([(leftFile, rightFile,
+					  getEdgeFileName(leftFile, rightFile, outputFolderName))
+					 for leftFile, rightFile in getPairList(inputFolderName)],
+					binaryPath, mz_tol, tic_tol)
@@ -1,11 +1,16 @@
 import argparse
 import json
+import numpy as np
 import re
 from pathlib import Path
+from bin import create_edge
 
 leftFeatureCol = 0
 rightFeatureCol = 1
 
+leftMatroidName = "edges incident to left nodes,V"
+rightMatroidName = "edges incident to right nodes,U"
+
 def jsonHelperPartitionMatroid(dic,limit,name):
 	blockArray = []
 	for key in dic:
@@ -21,8 +26,8 @@ def jsonHelperPartitionMatroid(dic,limit,name):
 	return(singleMatroid)
 
 def makeJson(leftDic,rightDic,limit=1,name="bipartite graph"):
-	leftMatroid = jsonHelperPartitionMatroid(leftDic,limit,"edges incident to left nodes,V")
-	rightMatroid = jsonHelperPartitionMatroid(rightDic,limit,"edges incident to right nodes,U")
+	leftMatroid = jsonHelperPartitionMatroid(leftDic,limit,leftMatroidName)
+	rightMatroid = jsonHelperPartitionMatroid(rightDic,limit,rightMatroidName)
 
 	json_object = {
 					"intersection-of-matroids": {
@@ -33,38 +38,124 @@ def makeJson(leftDic,rightDic,limit=1,name="bipartite graph"):
 				  }	
 	return(json_object)
 
-def createJsonMatroid(inputFileName, outputFolder):
-	newFileName = outputFolder+ "/" + str(inputFileName.stem) + "___matroid.json"
-	if Path(newFileName).is_file():
-		return
-
-	# dic shows which edges are assciated with each MS1 feature
-	leftFeatureEdgeDic = {} # key is feature index. value is list of edge indicies
-	rightFeatureEdgeDic = {}
-	with open(inputFileName,'r') as file1:
-		header = file1.readline().strip()
-		edgeIndex = 0
-		for line1 in file1:
-			line1_sp = line1.split('\t')
-			
-			leftFeatureIndex = line1_sp[leftFeatureCol]
-			rightFeatureIndex = line1_sp[rightFeatureCol]
-
-			if leftFeatureIndex not in leftFeatureEdgeDic:
-				leftFeatureEdgeDic[leftFeatureIndex] = [edgeIndex]
-			else:
-				tmpList = leftFeatureEdgeDic[leftFeatureIndex]
-				tmpList.append(edgeIndex)
-				leftFeatureEdgeDic[leftFeatureIndex] = tmpList
-
-			if rightFeatureIndex not in rightFeatureEdgeDic:
-				rightFeatureEdgeDic[rightFeatureIndex] = [edgeIndex]
-			else:
-				tmpList = rightFeatureEdgeDic[rightFeatureIndex]
-				tmpList.append(edgeIndex)
-				rightFeatureEdgeDic[rightFeatureIndex] = tmpList
-			edgeIndex += 1
-
-	json_object = makeJson(leftFeatureEdgeDic,rightFeatureEdgeDic)
+def buildPartitionBlocks(featureIndex):
+	"""
+	Group edges by the MS1 feature they are incident to. Blocks are in order of
+	first appearance and edges within a block are in increasing order (same
+	as the dictionaries built by the original line by line version).
+
+	Parameters
+	----------
+	featureIndex : numpy array
+		MS1 feature index of each edge (left or right feature index column)
+
+	Returns
+	-------
+	offsets : numpy array
+		Block b holds edgeIds[offsets[b]:offsets[b+1]]
+	edgeIds : numpy array
+		Edge indicies grouped by block
+	"""
+	featureIndex = np.asarray(featureIndex, dtype=np.int64)
+	order = np.argsort(featureIndex, kind='stable')
+	sortedIndex = featureIndex[order]
+	isStart = np.ones(sortedIndex.size, dtype=bool)
+	isStart[1:] = sortedIndex[1:] != sortedIndex[:-1]
+	blockStart = np.flatnonzero(isStart)
+	blockSize = np.diff(np.append(blockStart, sortedIndex.size))
+
+	# stable sort so the first edge of each block is its first appearance
+	blockOrder = np.argsort(order[blockStart], kind='stable')
+	blockSize = blockSize[blockOrder]
+	offsets = np.zeros(blockSize.size + 1, dtype=np.int64)
+	np.cumsum(blockSize, out=offsets[1:])
+	gather = np.repeat(blockStart[blockOrder] - offsets[:-1], blockSize) + \
+			 np.arange(sortedIndex.size)
+	edgeIds = order[gather]
+	return(offsets, edgeIds)
+
+def buildMatroid(edges, limit=1):
+	"""
+	Partition matroids of an edge set (see makeJson) as CSR-style blocks
+	Input: edges (see create_edge.loadEdges or create_edge.buildEdges)
+	Output: dictionary with the blocks of the "left" and "right" partition
+			matroid (offsets, edgeIds) and the limit of every block
+	"""
+	leftBlocks = buildPartitionBlocks(
+		create_edge.getEdgeColumn(edges, leftFeatureCol))
+	rightBlocks = buildPartitionBlocks(
+		create_edge.getEdgeColumn(edges, rightFeatureCol))
+	return({"left":leftBlocks, "right":rightBlocks, "limit":limit})
+
+def writeJsonBlocks(newFile, blocks, limit, name):
+	newFile.write('{"partition-matroid":{"name":' + json.dumps(name) +
+				  ',"blocks":[')
+	offsets, edgeIds = blocks
+	edgeIdStr = edgeIds.astype(str)
+	for b in range(offsets.size - 1):
+		if b != 0:
+			newFile.write(',')
+		newFile.write('{"block":[' +
+					  ','.join(edgeIdStr[offsets[b]:offsets[b+1]]) +
+					  '],"limit":' + str(limit) + '}')
+	newFile.write(']}}')
+
+def writeMatroidJson(matroid, newFileName, name="bipartite graph"):
+	"""
+	Stream a matroid (see buildMatroid) to a compact JSON file with the same
+	structure as makeJson
+	"""
 	with open(newFileName,'w') as newFile:
-		newFile.write(json.dumps(json_object,indent=2))
+		newFile.write('{"intersection-of-matroids":{"name":' + json.dumps(name) +
+					  ',"comment":"","partition-matroids":[')
+		writeJsonBlocks(newFile, matroid["left"], matroid["limit"],
+						leftMatroidName)
+		newFile.write(',')
+		writeJsonBlocks(newFile, matroid["right"], matroid["limit"],
+						rightMatroidName)
+		newFile.write(']}}')
+
+def writeMatroidBinary(matroid, newFileName):
+	"""
+	Write a matroid (see buildMatroid) to a binary sidecar (uncompressed npz)
+	"""
+	np.savez(newFileName, leftOffsets=matroid["left"][0],
+			 leftEdgeIds=matroid["left"][1], rightOffsets=matroid["right"][0],
+			 rightEdgeIds=matroid["right"][1], limit=matroid["limit"])
+
+def loadMatroidBinary(fileName):
+	"""
+	Read a binary sidecar written by writeMatroidBinary
+	"""
+	with np.load(fileName) as matroidFile:
+		return({"left":(matroidFile["leftOffsets"], matroidFile["leftEdgeIds"]),
+				"right":(matroidFile["rightOffsets"],
+						 matroidFile["rightEdgeIds"]),
+				"limit":int(matroidFile["limit"])})
+
+def createJsonMatroid(inputFileName, outputFolder, edges=None, writeJson=True,
+					  writeBinary=False):
+	"""
+	Create the matroid file of an edge file (text or binary, see
+	create_edge.loadEdges). If edges is given (see create_edge.buildEdges) it
+	is used instead of reading the edge file.
+	writeJson writes ___matroid.json and writeBinary the ___matroid.npz
+	sidecar.
+	Output: matroid (see buildMatroid). None if the matroid files already exist
+	"""
+	stem = outputFolder + "/" + str(inputFileName.stem) + "___matroid"
+	newFileName = stem + ".json"
+	binaryFileName = stem + ".npz"
+	if (not writeJson or Path(newFileName).is_file()) and \
+	   (not writeBinary or Path(binaryFileName).is_file()):
+		return(None)
+
+	if edges is None:
+		edges = create_edge.loadEdges(inputFileName)
+	matroid = buildMatroid(edges)
+
+	if writeJson and not Path(newFileName).is_file():
+		writeMatroidJson(matroid, newFileName)
+	if writeBinary and not Path(binaryFileName).is_file():
+		writeMatroidBinary(matroid, binaryFileName)
+	return(matroid)
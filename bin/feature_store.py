@@ -0,0 +1,145 @@
+import numpy as np
+import os
+import re
+from pathlib import Path
+
+# Binary MS1 feature file. Written next to each _ms1Peak.txt file so that the
+# text file is parsed once per run instead of once per pair.
+#
+# Layout (little endian)
+#   magic   4 bytes  b"MS1F"
+#   version uint32
+#   nRow    uint64
+#   pTIC      float64[nRow]
+#   mz        float32[nRow]
+#   intensity float32[nRow] (normalized by max intensity)
+#   RT        float32[nRow]
+#   charge    int8[nRow]
+# pTIC is kept at full precision since the edge similarity matrix compares
+# pTIC differences against a fixed tolerance
+magic = b"MS1F"
+version = 1
+headerDtype = np.dtype([("magic", "S4"), ("version", "<u4"), ("nRow", "<u8")])
+columnList = [("pTIC", "<f8"), ("mz", "<f4"), ("intensity", "<f4"),
+			  ("RT", "<f4"), ("charge", "i1")]
+columnOrder = ["mz", "intensity", "RT", "pTIC", "charge"]
+
+textExt = "_ms1Peak.txt"
+binaryExt = "_ms1Peak.bin"
+
+# indicies for MS1 feature file
+numCols = 5
+intensCol = 1
+
+# memory maps opened by this process
+_storeCache = {}
+
+
+###############################################################################
+def getBinaryFileName(fileName):
+	"""
+	Binary feature file name of a MS1 feature text file
+	"""
+	return(re.sub(textExt + "$", binaryExt, str(fileName)))
+
+
+def writeFeatureStore(features, fileName):
+	"""
+	Write MS1 features to a binary feature file
+
+	Parameters
+	----------
+	features : numpy array
+		One row per MS1 feature. Columns are m/z, intensity, RT, pTIC and
+		charge (same as MS1 feature text file)
+	fileName : str, path
+		Name of binary feature file
+	"""
+	features = np.asarray(features, dtype=np.float64).reshape(-1, numCols)
+	nRow = features.shape[0]
+
+	# normalize intensities by max value
+	intensity = features[:,intensCol]
+	if nRow > 0 and np.max(intensity) != 0:
+		intensity = intensity / np.max(intensity)
+
+	header = np.array([(magic, version, nRow)], dtype=headerDtype)
+	tmpFileName = str(fileName) + ".tmp" + str(os.getpid())
+	with open(tmpFileName, 'wb') as newFile:
+		header.tofile(newFile)
+		for name, dtype in columnList:
+			col = columnOrder.index(name)
+			if col == intensCol:
+				intensity.astype(dtype).tofile(newFile)
+			else:
+				features[:,col].astype(dtype).tofile(newFile)
+	# other processes never see a partially written file
+	os.replace(tmpFileName, fileName)
+
+
+def openFeatureStore(fileName):
+	"""
+	Memory map a binary feature file
+
+	Returns
+	-------
+	store : dict
+		Column name to read-only numpy array (see columnList)
+	"""
+	header = np.fromfile(fileName, dtype=headerDtype, count=1)
+	if header.size != 1 or header["magic"][0] != magic or \
+	   header["version"][0] != version:
+		raise Exception(str(fileName) + " is not a MS1 feature binary file")
+	nRow = int(header["nRow"][0])
+
+	# one memory map per file. Columns are views into it
+	if nRow == 0:
+		raw = np.zeros(headerDtype.itemsize, dtype=np.uint8)
+	else:
+		raw = np.memmap(fileName, dtype=np.uint8, mode='r')
+	store = {}
+	offset = headerDtype.itemsize
+	for name, dtype in columnList:
+		size = nRow * np.dtype(dtype).itemsize
+		store[name] = raw[offset:offset+size].view(dtype)
+		offset += size
+	return(store)
+
+
+def loadFeatures(fileName):
+	"""
+	Load the MS1 features of a MS1 feature text file. The binary feature file
+	is created from the text file the first time a run is loaded and memory
+	mapped afterwards.
+
+	Parameters
+	----------
+	fileName : str, path
+		MS1 feature text file (_ms1Peak.txt) or binary feature file
+
+	Returns
+	-------
+	store : dict
+		Column name to numpy array (see openFeatureStore)
+	"""
+	binaryFileName = getBinaryFileName(fileName)
+	textFile = Path(fileName)
+	binaryFile = Path(binaryFileName)
+	if not binaryFile.is_file() or (textFile.is_file() and \
+	   textFile.stat().st_mtime_ns > binaryFile.stat().st_mtime_ns):
+		features = np.loadtxt(textFile, delimiter='\t', skiprows=1, ndmin=2)
+		writeFeatureStore(features, binaryFileName)
+
+	key = (binaryFileName, binaryFile.stat().st_mtime_ns)
+	if key not in _storeCache:
+		_storeCache[key] = openFeatureStore(binaryFileName)
+	return(_storeCache[key])
+
+
+def featureMatrix(store):
+	"""
+	Stack the columns of a feature store into a matrix with the same columns
+	as the MS1 feature text file
+	"""
+	return(np.column_stack([store[name].astype(np.float64)
+							for name in columnOrder]).reshape(-1, numCols))
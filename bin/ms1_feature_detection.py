@@ -1,27 +1,152 @@
 from pyopenms import *
 from pathlib import Path
-import bisect
+import concurrent.futures
 import logging
+import multiprocessing
+import numpy as np
+import os
+from bin import feature_store
+from bin import trace
 
 LOGGER = logging.getLogger(__name__)
 
 min_pTIC = .05
 max_pTIC = .95
 
+# columns of a FeatureMap pulled out by getFeatureInfo
+featureDtype = np.dtype([("mz", np.float64), ("intensity", np.float64),
+						 ("RT", np.float64), ("charge", np.int64)])
+# indicies for MS1 feature file
+mzCol = 0
+intensCol = 1
+
+# streaming feature detection (see peakPickStreaming)
+# Peak1D is a double m/z and a float intensity
+bytesPerPeak = 16
+# RT (seconds) added to both sides of a chunk
+chunkOverlapRT = 60.0
+
+# OMP_NUM_THREADS when pyOpenMS was loaded. OpenMP reads it once, so this is
+# the number of threads of files run in this process (None is every core)
+processThreads = os.environ.get("OMP_NUM_THREADS")
+
 # Save memory by only loading MS1 spectra into memory
 options = PeakFileOptions()
 options.setMSLevels([1])
 
-# calc TIC from MS1 scans
-def calcTIC(exp):
-	tic = 0.0
+def calcPTIC(exp):
+	"""
+	Single pass over the MS1 scans. pTIC of a scan is the fraction of the TIC
+	in the scans before it.
+	Output1: numpy array of RT of each MS1 scan
+	Output2: numpy array of pTIC of each MS1 scan
+	Output3: TIC
+	"""
+	rtList = []
+	scanTicList = []
 	for scan in exp:
 		if scan.getMSLevel() == 1:
 			mz, i = scan.get_peaks()
-			tic += sum(i)
-	return(tic)
+			rtList.append(scan.getRT())
+			scanTicList.append(np.sum(i, dtype=np.float64))
+	scanTic = np.array(scanTicList, dtype=np.float64)
+	cumTic = np.cumsum(scanTic)
+	totalTic = cumTic[-1] if cumTic.size > 0 else 0.0
+	pTicList = (cumTic - scanTic) / totalTic
+	return(np.array(rtList, dtype=np.float64), pTicList, float(totalTic))
+
+def findFeatures(input_map):
+	"""
+	Run the centroided FeatureFinder on the MS1 scans in input_map
+	Output: FeatureMap
+	"""
+	input_map.updateRanges()
+	ff = FeatureFinder()
+	ff.setLogType(LogType.CMD) # progress log
+
+	# Run the feature finder
+	name = "centroided"
+	features = FeatureMap()
+	seeds = FeatureMap()
+	params = FeatureFinder().getParameters(name)
+	ff.run(name, input_map, features, params, seeds)
+	features.setUniqueIds()
+	#fh = FeatureXMLFile()
+	#fh.store("output.featureXML", features)
+	return(features)
+
+def getFeatureInfo(features, rtList, pTicList, rtRange=None):
+	"""
+	m/z, intensity, RT, pTIC and charge of each feature. The pTIC of a
+	feature is the pTIC of the MS1 scan closest in RT. Features outside of
+	[min_pTIC, max_pTIC] (or with RT outside of rtRange [lo, hi)) are dropped.
+	Output: numpy array with one row per feature (same columns as the MS1
+			feature file)
+	"""
+	# pull every feature out of the FeatureMap in one pass
+	featureArray = np.fromiter(((f.getMZ(), f.getIntensity(), f.getRT(),
+								 f.getCharge()) for f in features),
+							   dtype=featureDtype, count=features.size())
+	if rtRange is not None:
+		featureArray = featureArray[(featureArray["RT"] >= rtRange[0]) &
+									(featureArray["RT"] < rtRange[1])]
+	curMz = np.round(featureArray["mz"], 4)
+	curRt = np.round(featureArray["RT"], 4)
+
+	# closest scan. Ties go to the scan on the left
+	rtList = np.asarray(rtList, dtype=np.float64)
+	pTicList = np.asarray(pTicList, dtype=np.float64)
+	curIndex = np.clip(np.searchsorted(rtList, curRt), 1, rtList.size - 1)
+	leftSideDiff = curRt - rtList[curIndex-1]
+	rightSideDiff = rtList[curIndex] - curRt
+	closest = np.where(leftSideDiff > rightSideDiff, curIndex, curIndex - 1)
+	pTIC = np.round(pTicList[closest], 4)
+
+	keep = (pTIC >= min_pTIC) & (pTIC <= max_pTIC)
+	return(np.column_stack((curMz[keep], featureArray["intensity"][keep],
+							curRt[keep], pTIC[keep],
+							featureArray["charge"][keep])).reshape(-1, 5))
+
+def selectTopN(featureArray, top_n):
+	"""
+	Indicies of the top_n most intense features sorted by m/z. Features with
+	the same intensity are taken in the order they were found and features
+	with the same m/z are sorted by decreasing intensity.
+	"""
+	intensity = featureArray[:,intensCol]
+	index = np.arange(intensity.size)
+	if top_n < intensity.size:
+		threshold = -np.partition(-intensity, top_n - 1)[top_n - 1]
+		above = index[intensity > threshold]
+		ties = index[intensity == threshold][0:top_n - above.size]
+		index = np.concatenate((above, ties))
+	order = np.lexsort((index, -intensity[index], featureArray[index,mzCol]))
+	return(index[order])
+
+def writeMs1PeakFile(featureArray, file_name, folder_loc, top_n):
+	"""
+	Keep the top_n most intense features and write them sorted by m/z to the
+	MS1 feature file (and its binary copy) of file_name
+	"""
+	# TODO the version that we ran for the paper on calculated pTIC
+	# on features that were kept (ie denom only contained top N intensity)
+	# This is kind of odd and doesn't feel right Need to test if this is better.
+
+	# keep N most intense sorted by m/z
+	intens_features = featureArray[selectTopN(featureArray, top_n)]
 
-def peakPick(file_name, folder_loc, top_n):
+	# print MS1 peak file
+	newFileName = folder_loc + "/" + str(Path(file_name).stem) +\
+"_ms1Peak.txt"
+	np.savetxt(newFileName, intens_features, fmt=['%s','%s','%s','%s','%d'],
+			   delimiter='\t', header="mz\tintensity\tRT\tpTIC\tcharge",
+			   comments='')
+
+	# binary copy of the MS1 peak file that downstream stages memory map
+	feature_store.writeFeatureStore(intens_features,
+									feature_store.getBinaryFileName(newFileName))
+
+def peakPick(file_name, folder_loc, top_n, memory_mb=None):
 	"""Performs MS1 feature detection on input file and saves output. TODO fill
 	in more.
 
@@ -33,10 +158,18 @@ def peakPick(file_name, folder_loc, top_n):
 		Location of folder to save output file.
 	top_n : int
 		Top N most intense MS1 features to save.
+	memory_mb : float
+		If given the file is streamed (see peakPickStreaming) and at most about
+		memory_mb megabytes of peaks are held in memory. Default loads every
+		MS1 scan.
 
 	Returns
 	-------
 	"""
+	if memory_mb is not None:
+		peakPickStreaming(file_name, folder_loc, top_n, memory_mb)
+		return
+
 	fh = MzMLFile()
 	fh.setOptions(options)
 
@@ -44,80 +177,239 @@ def peakPick(file_name, folder_loc, top_n):
 	input_map = MSExperiment()
 	fh.load(file_name, input_map)
 
-	# calc TIC
-	totalTic = calcTIC(input_map)
-
-	# convert TIC to pTIC
-	rtList = []
-	pTicList = []
-	sumTIC = 0.0
+	# calc TIC and convert TIC to pTIC
 	LOGGER.info("Converting TIC to pTIC")
-	for scan in input_map:
+	rtList, pTicList, totalTic = calcPTIC(input_map)
+
+	features = findFeatures(input_map)
+	LOGGER.info("Found %s features", features.size())
+
+	featureArray = getFeatureInfo(features, rtList, pTicList)
+	writeMs1PeakFile(featureArray, file_name, folder_loc, top_n)
+
+
+###############################################################################
+class _ScanConsumer():
+	"""
+	MzMLFile.transform consumer that keeps the RT, TIC, number of peaks and
+	spectrum index of each MS1 scan without keeping the peaks
+	"""
+	def __init__(self):
+		self.numSpectra = 0
+		self.scanIndexList = []
+		self.rtList = []
+		self.scanTicList = []
+		self.numPeakList = []
+
+	def setExperimentalSettings(self, settings):
+		pass
+
+	def setExpectedSize(self, numSpectra, numChromatograms):
+		pass
+
+	def consumeSpectrum(self, scan):
+		self.numSpectra += 1
 		if scan.getMSLevel() == 1:
 			mz, i = scan.get_peaks()
+			self.scanIndexList.append(self.numSpectra - 1)
+			self.rtList.append(scan.getRT())
+			self.scanTicList.append(np.sum(i, dtype=np.float64))
+			self.numPeakList.append(i.size)
 
-			rtList.append(scan.getRT())
-			pTicList.append(sumTIC/totalTic)
-			sumTIC += sum(i)
+	def consumeChromatogram(self, chromatogram):
+		pass
 
-	input_map.updateRanges()
-	ff = FeatureFinder()
-	ff.setLogType(LogType.CMD) # progress log
 
-	# Run the feature finder
-	name = "centroided"
-	features = FeatureMap()
-	seeds = FeatureMap()
-	params = FeatureFinder().getParameters(name)
-	ff.run(name, input_map, features, params, seeds)
-	features.setUniqueIds()
-	fh = FeatureXMLFile()
-	#fh.store("output.featureXML", features)
-	LOGGER.info("Found %s features", features.size())
+def getChunkList(rtList, pTicList, numPeakList, memory_mb, overlapRT):
+	"""
+	Split the MS1 scans feature detection needs into RT chunks of at most
+	memory_mb megabytes of peaks. Only scans that can give a feature a pTIC
+	in [min_pTIC, max_pTIC] (plus the nearest scan on each side) are covered.
+
+	Input1: numpy array of RT of each MS1 scan
+	Input2: numpy array of pTIC of each MS1 scan
+	Input3: numpy array of number of peaks of each MS1 scan
+	Input4: memory ceiling in MB
+	Input5: RT (seconds) added to both sides of a chunk so features are not
+			cut at chunk boundaries
+	Output: list of (loadRange, coreRange) RT ranges. Features are found on
+			the scans in loadRange and kept if their RT is in coreRange. The
+			core ranges do not overlap so every feature is kept once.
+	"""
+	keep = np.flatnonzero((pTicList >= min_pTIC) & (pTicList <= max_pTIC))
+	if keep.size == 0:
+		return([])
+	first = max(keep[0] - 1, 0)
+	last = min(keep[-1] + 1, rtList.size - 1)
+
+	maxPeaks = max(1, int(memory_mb * (1 << 20) / bytesPerPeak))
+	cumPeaks = np.cumsum(numPeakList)
+	chunkList = []
+	start = first
+	while start <= last:
+		# largest end scan that stays under the ceiling with the overlap on
+		# both sides. At least one scan per chunk
+		end = start
+		while end < last:
+			lo = np.searchsorted(rtList, rtList[start] - overlapRT)
+			hi = np.searchsorted(rtList, rtList[end+1] + overlapRT, 'right')
+			if cumPeaks[hi-1] - (cumPeaks[lo-1] if lo > 0 else 0) > maxPeaks:
+				break
+			end += 1
+		coreLo = -np.inf if start == first else rtList[start]
+		coreHi = np.inf if end == last else rtList[end+1]
+		loadRange = (rtList[start] - overlapRT, rtList[end] + overlapRT)
+		chunkList.append((loadRange, (coreLo, coreHi)))
+		start = end + 1
+	return(chunkList)
+
+
+def loadRTRange(file_name, rtRange, onDiscExp=None, scanIndex=None):
+	"""
+	Load the MS1 scans with RT in rtRange. If the mzML is indexed
+	(onDiscExp) only the spectra in scanIndex are read.
+	Output: MSExperiment
+	"""
+	input_map = MSExperiment()
+	if onDiscExp is not None:
+		for index in scanIndex:
+			input_map.addSpectrum(onDiscExp.getSpectrum(int(index)))
+		return(input_map)
+
+	rangeOptions = PeakFileOptions()
+	rangeOptions.setMSLevels([1])
+	rangeOptions.setRTRange(DRange1(DPosition1(rtRange[0]),
+									DPosition1(rtRange[1])))
+	fh = MzMLFile()
+	fh.setOptions(rangeOptions)
+	fh.load(file_name, input_map)
+	return(input_map)
+
+
+def peakPickStreaming(file_name, folder_loc, top_n, memory_mb,
+					  overlapRT=chunkOverlapRT):
+	"""Bounded memory version of peakPick. The file is streamed once to get
+	the TIC and pTIC of each MS1 scan. Feature detection is then run on RT
+	chunks of at most memory_mb megabytes of peaks (see getChunkList).
+
+	Parameters
+	----------
+	file_name : str
+		Name of mzML file to convert to MS1 feature file.
+	folder_loc : str
+		Location of folder to save output file.
+	top_n : int
+		Top N most intense MS1 features to save.
+	memory_mb : float
+		Memory ceiling for the peaks of a chunk in megabytes.
+	overlapRT : float
+		RT (seconds) added to both sides of each chunk.
+
+	Returns
+	-------
+	"""
+	# calc TIC and convert TIC to pTIC without loading the peaks
+	LOGGER.info("Converting TIC to pTIC")
+	consumer = _ScanConsumer()
+	MzMLFile().transform(file_name, consumer)
+	rtList = np.array(consumer.rtList, dtype=np.float64)
+	scanTic = np.array(consumer.scanTicList, dtype=np.float64)
+	cumTic = np.cumsum(scanTic)
+	# a file without MS1 scans gives an empty MS1 feature file
+	totalTic = cumTic[-1] if cumTic.size > 0 else 0.0
+	pTicList = (cumTic - scanTic) / totalTic
+	numPeakList = np.array(consumer.numPeakList, dtype=np.int64)
+	scanIndexList = np.array(consumer.scanIndexList, dtype=np.int64)
+
+	# random access to scans if the mzML is indexed
+	onDiscExp = OnDiscMSExperiment()
+	if not onDiscExp.openFile(file_name):
+		onDiscExp = None
 
-	# get info for each feature 
 	featureList = []
-	for f in features:
-		curIntens = f.getIntensity()
-		curMz = round(f.getMZ(),4)
-		curRt = round(f.getRT(),4)
-		curCharge = f.getCharge()
-
-		curIndex = bisect.bisect_left(rtList,curRt)
-		leftSideRT = rtList[curIndex-1]
-		rightSideRT = rtList[curIndex]
-
-		leftSideDiff = curRt - leftSideRT
-		rightSideDiff = rightSideRT - curRt
-
-		pTIC = 0 
-		if leftSideDiff > rightSideDiff:
-			pTIC = round(pTicList[curIndex],4)
-		else:
-			pTIC = round(pTicList[curIndex-1],4)
+	chunkList = getChunkList(rtList, pTicList, numPeakList, memory_mb,
+							 overlapRT)
+	for loadRange, coreRange in chunkList:
+		lo = np.searchsorted(rtList, loadRange[0])
+		hi = np.searchsorted(rtList, loadRange[1], 'right')
+		input_map = loadRTRange(file_name, loadRange, onDiscExp,
+								scanIndexList[lo:hi])
+		features = findFeatures(input_map)
+		featureList.append(getFeatureInfo(features, rtList, pTicList,
+										  coreRange))
+		del input_map
+	featureArray = np.concatenate(featureList + [np.zeros((0,5))])
+	LOGGER.info("Found %s features in %s chunks", featureArray.shape[0],
+				len(chunkList))
 
-		if pTIC >= min_pTIC and pTIC <= max_pTIC:
-			feature = (curMz, curIntens, curRt, pTIC, curCharge)
-			featureList.append(feature)
+	writeMs1PeakFile(featureArray, file_name, folder_loc, top_n)
 
-	# TODO the version that we ran for the paper on calculated pTIC
-	# on features that were kept (ie denom only contained top N intensity)
-	# This is kind of odd and doesn't feel right Need to test if this is better.
 
-	# sort feature list by intensity
-	featureList.sort(key=lambda x:x[1], reverse=True)
+###############################################################################
+def _peakPickStar(args):
+	file_name, folder_loc, top_n, memory_mb, profileStages, profileFolder = args
+	record = trace.newRecord("run", str(Path(file_name).stem))
+	with trace.stage(record, "features", profileStages, profileFolder):
+		peakPick(file_name, folder_loc, top_n, memory_mb)
+	return(file_name, record)
 
-	# keep N most intense
-	intens_features = featureList[0:top_n]
 
-	# sort feature list by m/z
-	intens_features.sort(key=lambda x:x[0])
+def peakPickFiles(fileList, folder_loc, top_n, jobs=1, threads=None,
+				  memory_mb=None, profileStages=(), profileFolder="profile"):
+	"""Performs MS1 feature detection on each input file using a pool of
+	worker processes.
 
-	# print MS1 peak file
-	newFileName = folder_loc + "/" + str(Path(file_name).stem) +\
-"_ms1Peak.txt"
-	with open(newFileName,'w') as newFile:
-		newFile.write("mz\tintensity\tRT\tpTIC\tcharge\n")
-		for item in intens_features:
-			printLine = '\t'.join(str(x) for x in item)
-			newFile.write(printLine + '\n')
+	Parameters
+	----------
+	fileList : list
+		Names of mzML files to convert to MS1 feature files.
+	folder_loc : str
+		Location of folder to save output files.
+	top_n : int
+		Top N most intense MS1 features to save.
+	jobs : int
+		Number of worker processes. 1 runs every file in this process.
+	threads : int
+		Number of OpenMP threads pyOpenMS uses in each worker. Default splits
+		the cores evenly between the workers. Files run in this process (jobs
+		1 or one file) use processThreads instead (see
+		ms1connect.detectFeatures).
+	memory_mb : float
+		Memory ceiling of each worker for streaming feature detection (see
+		peakPick).
+	profileStages : list
+		Run feature detection under cProfile if it contains "features" (see
+		trace.stage)
+	profileFolder : str, path
+		Folder for the cProfile stats
+
+	Returns
+	-------
+	Generator of (file name, trace record) as files finish
+	"""
+	argList = [(str(f), folder_loc, top_n, memory_mb, profileStages,
+				profileFolder) for f in fileList]
+	if jobs <= 1 or len(argList) <= 1:
+		for args in argList:
+			yield(_peakPickStar(args))
+		return
+
+	if threads is None:
+		threads = max(1, (os.cpu_count() or 1) // jobs)
+	# OpenMP reads the number of threads when pyOpenMS is loaded, so it is set
+	# in the environment the workers inherit. Workers are spawned rather than
+	# forked since forking after OpenMP has started is not safe
+	oldThreads = os.environ.get("OMP_NUM_THREADS")
+	os.environ["OMP_NUM_THREADS"] = str(threads)
+	try:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+				mp_context=multiprocessing.get_context("spawn")) as executor:
+			futureList = [executor.submit(_peakPickStar, args)
+						  for args in argList]
+			for future in concurrent.futures.as_completed(futureList):
+				yield(future.result())
+	finally:
+		if oldThreads is None:
+			del os.environ["OMP_NUM_THREADS"]
+		else:
+			os.environ["OMP_NUM_THREADS"] = oldThreads
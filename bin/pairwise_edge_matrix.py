@@ -1,11 +1,17 @@
-import argparse
 import numpy as np
-from numba import jit
+from numba import jit, prange
+from numba.types import float32, float64, int32, int64
 from pathlib import Path
 import math
-import re
+import os
 import scipy.sparse
-import sys
+import shutil
+import struct
+import tempfile
+import zipfile
+from bin import artifact_cache
+from bin import create_edge
+from bin import feature_store
 
 # edge sim tolerance (start and end time)
 startTol = .01
@@ -13,6 +19,12 @@ startTol = .01
 # edge score file extention
 ext = ".txt" 
 
+# bytes of memory per matrix entry while a chunk of rows is filled (index,
+# value, zero mask and the copies without zeros)
+bytesPerEntry = 24
+copyChunkSize = 1 << 20
+zipLocalHeaderSize = 30
+
 # indicies for MS1 feature file
 intensCol = 1
 pticCol = 3
@@ -22,94 +34,206 @@ leftPeakIndex = 0
 rightPeakIndex = 1
 ticDiffIndex = 3
 
-# look at fastmath and parallel
-# and explicit parllel loops
-@jit(nopython=True)
-def fillInMatrix(edgeFile, leftFile, rightFile, nRow, \
-				 lambda1, lambda2, lambda3, lambda4, \
-				 alpha1, alpha2, alpha3):
+# The machine code of the numba kernels is cached on disk (__pycache__, or
+# the numba user cache if this folder is read only), so a new process loads a
+# kernel on its first call instead of compiling it. compileKernels compiles
+# the signatures below ahead of time. The CSR indptr and indices are int32
+# unless the matrix has 2**31 entries or more (see getIndexDtype).
+# fillInMatrixChunked keeps an int64 indptr.
+pticArray = float64[::1]
+countSignatures = [(pticArray, pticArray, pticArray, int64, float64, float64)]
+fillSignatures = [(pticArray, pticArray, pticArray, int64, float64, float64,
+				   float64, float64, float32[::1], int64[::1],
+				   indptrType[::1], indexType[::1], float32[::1], int64, int64)
+				  for indptrType, indexType in [(int32, int32), (int64, int32),
+												(int64, int64)]]
+distanceSignatures = [(pticArray, pticArray, pticArray, int64, int64[::1],
+					   indexType[::1], indexType[::1], float64[::1],
+					   float64[::1]) for indexType in [int32, int64]]
+sumSignatures = [(indexType[::1], int64[::1], float64[::1], int64)
+				 for indexType in [int32, int64]]
+
+@jit(nopython=True, parallel=True, cache=True)
+def countMatrixEntries(edgeLeftpTIC, edgeRightpTIC, edgeTicDiff, nRow, \
+					   alpha2, alpha3):
 	"""
-	Assume that edge file is sorted by leftFileRT
+	First pass of fillInMatrix. Counts the off-diagonal entries of each row
+	and sums the edge similarity term of the entries right of the diagonal.
+	Assume that edges are sorted by leftFileRT
 	"""
+	lowerCount = np.zeros(nRow,dtype=np.int64)
+	upperCount = np.zeros(nRow,dtype=np.int64)
+	upperSum = np.zeros(nRow,dtype=np.float64)
+
+	for i in prange(nRow):
+		# edges before edge i (mirror of the entries right of the diagonal)
+		for j in range(i-1,-1,-1):
+			if (abs(edgeLeftpTIC[i] - edgeLeftpTIC[j]) <= startTol) and \
+			   (abs(edgeRightpTIC[i] - edgeRightpTIC[j]) <= startTol):
+				lowerCount[i] += 1
+			# since edges are ordered by left file RT
+			if (edgeLeftpTIC[i] - edgeLeftpTIC[j]) > startTol:
+				break
 
-	# diagonal values
-	countTermArray = np.zeros(nRow,dtype=np.float32)
-	intensTermArray = np.zeros(nRow,dtype=np.float32)
-	pticTermArray = np.zeros(nRow,dtype=np.float32)
-	diagScoreArray = np.zeros(nRow,dtype=np.float32)
-	diagArray = np.zeros(nRow,dtype=np.uint32)
-
-	countTermSum = np.float32(0.0); intensTermSum = np.float32(0.0);
-	pticTermSum = np.float32(0.0)
-	
-	# non-diagonal values
-	rowList = []; colList = []; 
-	valList = [np.float64(x) for x in range(0)]
-	edgeSimTermSum = 0.0
-
-	for i in range(0,nRow):
-		for j in range(i,nRow):
-			edge1 = edgeFile[i]
-			edge2 = edgeFile[j]
-
-			edge1Left = int(edge1[leftPeakIndex])
-			edge1Right = int(edge1[rightPeakIndex])
-
-			edge2Left = int(edge2[leftPeakIndex])
-			edge2Right = int(edge2[rightPeakIndex])
-
-			# two left ms1 features must be within tolerance
-			edge1LeftpTIC = leftFile[edge1Left,pticCol]
-			edge2LeftpTIC = leftFile[edge2Left,pticCol]
-
-			# two right MS1 features must be within tolerance
-			edge1RightpTIC = rightFile[edge1Right,pticCol]
-			edge2RightpTIC = rightFile[edge2Right,pticCol]
-			
-			if i == j: # edge1 == edge2
-				# count term
-				countTerm = 1.0
-				countTermArray[i] = np.float32(countTerm * lambda1)
-				countTermSum += np.float32(countTerm)
-
-				# intensity term
-				intensTerm = leftFile[edge1Left,intensCol] * \
-							 rightFile[edge1Right,intensCol]
-				intensTermArray[i] = np.float32(intensTerm * lambda2)
-				intensTermSum += np.float32(intensTerm)
-
-				# edge length term
-				pticTerm = math.exp(-alpha1 * abs(leftFile[edge1Left,pticCol] - \
-									rightFile[edge1Right,pticCol]))
-				pticTermArray[i] = np.float32(pticTerm * lambda3)
-				pticTermSum += np.float32(pticTerm)
-
-				diagArray[i] = i
-			elif (abs(edge1LeftpTIC - edge2LeftpTIC) <= startTol) and \
-				 (abs(edge1RightpTIC - edge2RightpTIC) <= startTol):
+		# edges after edge i
+		for j in range(i+1,nRow):
+			if (abs(edgeLeftpTIC[i] - edgeLeftpTIC[j]) <= startTol) and \
+			   (abs(edgeRightpTIC[i] - edgeRightpTIC[j]) <= startTol):
 				# edge shift term
-				shiftTerm = math.exp(-alpha2 * abs(edge1[ticDiffIndex] - \
-												   edge2[ticDiffIndex]))
+				shiftTerm = math.exp(-alpha2 * abs(edgeTicDiff[i] - \
+												   edgeTicDiff[j]))
+				startTerm = math.exp(-alpha3 * abs((edgeLeftpTIC[i] - \
+													edgeLeftpTIC[j])))
+				upperCount[i] += 1
+				upperSum[i] += shiftTerm * startTerm
+			if (edgeLeftpTIC[j] - edgeLeftpTIC[i]) > startTol:
+				break
+	return(lowerCount,upperCount,upperSum)
 
-				startTerm = math.exp(-alpha3 * abs((edge1LeftpTIC - \
-													edge2LeftpTIC)))
 
-				rowList.append(i)
-				colList.append(j)
-				valList.append(lambda4 * shiftTerm * startTerm)
+@jit(nopython=True, parallel=True, cache=True)
+def fillMatrixEntries(edgeLeftpTIC, edgeRightpTIC, edgeTicDiff, nRow, \
+					  lambda4, alpha2, alpha3, edgeSimTermSum, diagScore, \
+					  lowerCount, indptr, indices, data, rowStart, rowEnd):
+	"""
+	Second pass of fillInMatrix. Writes rows rowStart to rowEnd of the CSR
+	matrix into the preallocated indices and data arrays, which start at
+	entry indptr[rowStart]. Columns of a row are in increasing order (entries
+	left of the diagonal, the diagonal, entries right of the diagonal).
+	"""
+	offset = indptr[rowStart]
+	for i in prange(rowStart, rowEnd):
+		# entries left of the diagonal are found from right to left
+		pos = indptr[i] - offset + lowerCount[i] - 1
+		for j in range(i-1,-1,-1):
+			if (abs(edgeLeftpTIC[i] - edgeLeftpTIC[j]) <= startTol) and \
+			   (abs(edgeRightpTIC[i] - edgeRightpTIC[j]) <= startTol):
+				shiftTerm = math.exp(-alpha2 * abs(edgeTicDiff[i] - \
+												   edgeTicDiff[j]))
+				startTerm = math.exp(-alpha3 * abs((edgeLeftpTIC[j] - \
+													edgeLeftpTIC[i])))
+				val = lambda4 * shiftTerm * startTerm
+				if edgeSimTermSum != 0:
+					val = val / edgeSimTermSum
+				indices[pos] = j
+				data[pos] = val
+				pos -= 1
+			if (edgeLeftpTIC[i] - edgeLeftpTIC[j]) > startTol:
+				break
+
+		pos = indptr[i] - offset + lowerCount[i]
+		indices[pos] = i
+		data[pos] = diagScore[i]
+		pos += 1
+
+		for j in range(i+1,nRow):
+			if (abs(edgeLeftpTIC[i] - edgeLeftpTIC[j]) <= startTol) and \
+			   (abs(edgeRightpTIC[i] - edgeRightpTIC[j]) <= startTol):
+				shiftTerm = math.exp(-alpha2 * abs(edgeTicDiff[i] - \
+												   edgeTicDiff[j]))
+				startTerm = math.exp(-alpha3 * abs((edgeLeftpTIC[i] - \
+													edgeLeftpTIC[j])))
+				val = lambda4 * shiftTerm * startTerm
+				if edgeSimTermSum != 0:
+					val = val / edgeSimTermSum
+				indices[pos] = j
+				data[pos] = val
+				pos += 1
+			if (edgeLeftpTIC[j] - edgeLeftpTIC[i]) > startTol:
+				break
 
-				rowList.append(j)
-				colList.append(i)
-				valList.append(lambda4 * shiftTerm * startTerm)
 
-				# sum twice for index i,j and j,i
-				edgeSimTermSum += (shiftTerm * startTerm)
-				edgeSimTermSum += (shiftTerm * startTerm)
+@jit(nopython=True, parallel=True, cache=True)
+def fillMatrixDistances(edgeLeftpTIC, edgeRightpTIC, edgeTicDiff, nRow, \
+						lowerCount, indptr, indices, shiftDist, startDist):
+	"""
+	Same as fillMatrixEntries but writes the distances that enter the edge
+	shift and edge start terms through exp instead of the weighted entries.
+	The diagonal has distance 0.
+	"""
+	for i in prange(nRow):
+		pos = indptr[i] + lowerCount[i] - 1
+		for j in range(i-1,-1,-1):
+			if (abs(edgeLeftpTIC[i] - edgeLeftpTIC[j]) <= startTol) and \
+			   (abs(edgeRightpTIC[i] - edgeRightpTIC[j]) <= startTol):
+				indices[pos] = j
+				shiftDist[pos] = abs(edgeTicDiff[i] - edgeTicDiff[j])
+				startDist[pos] = abs((edgeLeftpTIC[j] - edgeLeftpTIC[i]))
+				pos -= 1
+			if (edgeLeftpTIC[i] - edgeLeftpTIC[j]) > startTol:
+				break
 
-			# since edges are ordered by left file RT 
-			if (edge2LeftpTIC - edge1LeftpTIC) > startTol:
+		pos = indptr[i] + lowerCount[i]
+		indices[pos] = i
+		shiftDist[pos] = 0.0
+		startDist[pos] = 0.0
+		pos += 1
+
+		for j in range(i+1,nRow):
+			if (abs(edgeLeftpTIC[i] - edgeLeftpTIC[j]) <= startTol) and \
+			   (abs(edgeRightpTIC[i] - edgeRightpTIC[j]) <= startTol):
+				indices[pos] = j
+				shiftDist[pos] = abs(edgeTicDiff[i] - edgeTicDiff[j])
+				startDist[pos] = abs((edgeLeftpTIC[i] - edgeLeftpTIC[j]))
+				pos += 1
+			if (edgeLeftpTIC[j] - edgeLeftpTIC[i]) > startTol:
 				break
 
+
+@jit(nopython=True, parallel=True, cache=True)
+def sumUpperEntries(indptr, diagPos, simTerm, nRow):
+	"""
+	Sum of the edge similarity term of the entries right of the diagonal of
+	each row (same order as countMatrixEntries)
+	"""
+	upperSum = np.zeros(nRow,dtype=np.float64)
+	for i in prange(nRow):
+		for pos in range(diagPos[i] + 1, indptr[i+1]):
+			upperSum[i] += simTerm[pos]
+	return(upperSum)
+
+
+def compileKernels():
+	"""
+	Compile every numba kernel for its signatures (and fill the on-disk
+	cache) so no process has to compile them
+	"""
+	for kernel, signatureList in [(countMatrixEntries, countSignatures),
+								  (fillMatrixEntries, fillSignatures),
+								  (fillMatrixDistances, distanceSignatures),
+								  (sumUpperEntries, sumSignatures)]:
+		for signature in signatureList:
+			kernel.compile(signature)
+
+
+def sumFloat32(termArray):
+	"""
+	Sum of the terms accumulated one at a time in float32 (cumsum is
+	sequential unlike sum)
+	"""
+	if termArray.size == 0:
+		return(np.float32(0.0))
+	return(np.cumsum(termArray.astype(np.float32))[-1])
+
+
+def diagonalScore(intensTerm, intensTermSum, pticDist, nRow, \
+				  lambda1, lambda2, lambda3, alpha1):
+	"""
+	Diagonal of the edge similarity matrix (count, intensity and edge length
+	terms, each normalized by its sum)
+	Output1: numpy array of diagonal values
+	Output2-4: count, intensity and edge length term sums
+	"""
+	countTermArray = np.full(nRow, lambda1, dtype=np.float32)
+	countTermSum = np.float32(nRow)
+
+	intensTermArray = (intensTerm * lambda2).astype(np.float32)
+
+	# edge length term
+	pticTerm = np.exp(-alpha1 * pticDist)
+	pticTermArray = (pticTerm * lambda3).astype(np.float32)
+	pticTermSum = sumFloat32(pticTerm)
+
 	# normalize each array by cumulative sum
 	if countTermSum != 0:
 		countTermArray = countTermArray / countTermSum
@@ -117,13 +241,342 @@ def fillInMatrix(edgeFile, leftFile, rightFile, nRow, \
 		intensTermArray = intensTermArray / intensTermSum
 	if pticTermSum != 0:
 		pticTermArray = pticTermArray / pticTermSum
+	diagScore = countTermArray + intensTermArray + pticTermArray
+	return(diagScore, countTermSum, intensTermSum, pticTermSum)
+
+
+def postNormValue(countTermSum, intensTermSum, pticTermSum, edgeSimTermSum, \
+				  lambda1, lambda2, lambda3, lambda4):
+	return((lambda1 * float(countTermSum)) + \
+		   (lambda2 * float(intensTermSum)) + \
+		   (lambda3 * float(pticTermSum)) + \
+		   (lambda4 * float(edgeSimTermSum)))
+
+
+def getEdgeTerms(edgeFile, leftFile, rightFile):
+	"""
+	Columns of the edge file used by the edge similarity matrix
+	Output: pTIC of the left and right MS1 feature of each edge, TIC
+			difference and intensity term of each edge
+	"""
+	edgeLeft = create_edge.getEdgeColumn(edgeFile,
+										 leftPeakIndex).astype(np.int64)
+	edgeRight = create_edge.getEdgeColumn(edgeFile,
+										  rightPeakIndex).astype(np.int64)
+	edgeTicDiff = np.ascontiguousarray(
+		create_edge.getEdgeColumn(edgeFile, ticDiffIndex), dtype=np.float64)
+	intensTerm = leftFile[edgeLeft,intensCol] * rightFile[edgeRight,intensCol]
+	return(leftFile[edgeLeft,pticCol], rightFile[edgeRight,pticCol],
+		   edgeTicDiff, intensTerm)
+
+
+def countEdgeSimMatrix(edgeFile, leftFile, rightFile, nRow, \
+					   lambda1, lambda2, lambda3, lambda4, \
+					   alpha1, alpha2, alpha3):
+	"""
+	Diagonal and first pass (countMatrixEntries) of fillInMatrix. Every
+	output is O(nRow) so the matrix entries can be filled in chunks of rows.
+	Assume that edge file is sorted by leftFileRT
+
+	Returns
+	-------
+	bandArgs : tuple
+		Arguments of fillMatrixEntries before indptr (edgeLeftpTIC,
+		edgeRightpTIC, edgeTicDiff, nRow, lambda4, alpha2, alpha3,
+		edgeSimTermSum, diagScore, lowerCount)
+	indptr : numpy array
+		int64 CSR row pointer
+	postTermNorm : float
+		Post normalization value
+	"""
+	edgeLeftpTIC, edgeRightpTIC, edgeTicDiff, intensTerm = \
+		getEdgeTerms(edgeFile, leftFile, rightFile)
+
+	# diagonal values
+	pticDist = np.abs(edgeLeftpTIC - edgeRightpTIC)
+	diagScore, countTermSum, intensTermSum, pticTermSum = \
+		diagonalScore(intensTerm, sumFloat32(intensTerm), pticDist, nRow,
+					  lambda1, lambda2, lambda3, alpha1)
+
+	# non-diagonal values. Hyperparameters are passed as floats so the
+	# kernels are called with their compiled signatures
+	alpha2 = float(alpha2)
+	alpha3 = float(alpha3)
+	lowerCount, upperCount, upperSum = \
+		countMatrixEntries(edgeLeftpTIC, edgeRightpTIC, edgeTicDiff, nRow,
+						   alpha2, alpha3)
+	# sum twice for index i,j and j,i
+	edgeSimTermSum = 2 * np.sum(upperSum)
+
+	indptr = np.zeros(nRow + 1, dtype=np.int64)
+	np.cumsum(lowerCount + upperCount + 1, out=indptr[1:])
+
+	postTermNorm = postNormValue(countTermSum, intensTermSum, pticTermSum,
+								 edgeSimTermSum, lambda1, lambda2, lambda3,
+								 lambda4)
+	bandArgs = (edgeLeftpTIC, edgeRightpTIC, edgeTicDiff, nRow, float(lambda4),
+				alpha2, alpha3, edgeSimTermSum, diagScore, lowerCount)
+	return(bandArgs, indptr, postTermNorm)
+
+
+def getIndexDtype(nnz):
+	return(np.int32 if nnz < np.iinfo(np.int32).max else np.int64)
+
+
+def fillInMatrix(edgeFile, leftFile, rightFile, nRow, \
+				 lambda1, lambda2, lambda3, lambda4, \
+				 alpha1, alpha2, alpha3):
+	"""
+	Build the sparse edge similarity matrix in CSR format. Rows are counted
+	first so that the CSR arrays are allocated once at their final size and
+	then filled in parallel.
+	Assume that edge file is sorted by leftFileRT
+
+	Returns
+	-------
+	sparseMat : scipy.sparse.csr_matrix
+		Edge similarity matrix
+	postTermNorm : float
+		Post normalization value
+	numEntries : int
+		Number of entries (diagonal and off-diagonal) before removing zeros
+	"""
+	bandArgs, indptr, postTermNorm = \
+		countEdgeSimMatrix(edgeFile, leftFile, rightFile, nRow, lambda1,
+						   lambda2, lambda3, lambda4, alpha1, alpha2, alpha3)
+	nnz = int(indptr[nRow])
+	indexDtype = getIndexDtype(nnz)
+	indptr = indptr.astype(indexDtype)
+	indices = np.empty(nnz, dtype=indexDtype)
+	data = np.empty(nnz, dtype=np.float32)
+	fillMatrixEntries(*bandArgs, indptr, indices, data, 0, nRow)
+
+	sparseMat = scipy.sparse.csr_matrix((data, indices, indptr),
+										shape=(nRow,nRow), copy=False)
+	return(sparseMat,postTermNorm,nnz)
+
+
+def fillInMatrixChunked(edgeFile, leftFile, rightFile, nRow, \
+						lambda1, lambda2, lambda3, lambda4, \
+						alpha1, alpha2, alpha3, newFileName, memory_mb):
+	"""
+	Same as fillInMatrix followed by saveEdgeSimMatrix but the entries are
+	never all in memory. Rows are filled in chunks of at most memory_mb of
+	entries (a single row larger than that is its own chunk), zeros are
+	removed and the indices and data of each chunk are appended to temporary
+	files next to newFileName. The ___pairwise.npz is then assembled from the
+	temporary files (see writeNpzStreamed) and is the same as the one
+	written by saveEdgeSimMatrix.
+	Assume that edge file is sorted by leftFileRT
+
+	Returns
+	-------
+	postTermNorm : float
+		Post normalization value
+	numEntries : int
+		Number of entries (diagonal and off-diagonal) before removing zeros
+	"""
+	bandArgs, indptr, postTermNorm = \
+		countEdgeSimMatrix(edgeFile, leftFile, rightFile, nRow, lambda1,
+						   lambda2, lambda3, lambda4, alpha1, alpha2, alpha3)
+	nnz = int(indptr[nRow])
+	indexDtype = getIndexDtype(nnz)
+	maxEntries = max(1, int(memory_mb * 2**20) // bytesPerEntry)
+
+	rowEntries = np.zeros(nRow, dtype=np.int64)
+	folderName = str(Path(newFileName).parent)
+	with tempfile.TemporaryFile(dir=folderName) as indicesFile, \
+		 tempfile.TemporaryFile(dir=folderName) as dataFile:
+		rowStart = 0
+		while rowStart < nRow:
+			rowEnd = int(np.searchsorted(indptr, indptr[rowStart] + maxEntries,
+										 'right')) - 1
+			rowEnd = min(max(rowEnd, rowStart + 1), nRow)
+			size = int(indptr[rowEnd] - indptr[rowStart])
+			indices = np.empty(size, dtype=indexDtype)
+			data = np.empty(size, dtype=np.float32)
+			fillMatrixEntries(*bandArgs, indptr, indices, data, rowStart,
+							  rowEnd)
+
+			# every row has a diagonal entry so no row is empty
+			keep = data != 0
+			rowEntries[rowStart:rowEnd] = np.add.reduceat(keep,
+				indptr[rowStart:rowEnd] - indptr[rowStart])
+			indices[keep].tofile(indicesFile)
+			data[keep].tofile(dataFile)
+			rowStart = rowEnd
+
+		keptIndptr = np.zeros(nRow + 1, dtype=indexDtype)
+		np.cumsum(rowEntries, out=keptIndptr[1:])
+		numKept = int(keptIndptr[nRow])
+		# same arrays as scipy.sparse.save_npz
+		writeNpzStreamed(newFileName,
+			[("indices", (indicesFile, np.dtype(indexDtype), numKept)),
+			 ("indptr", keptIndptr), ("format", np.array(b"csr")),
+			 ("shape", np.array((nRow,nRow))),
+			 ("data", (dataFile, np.dtype(np.float32), numKept))])
+	return(postTermNorm,nnz)
+
+
+def writeNpzStreamed(fileName, arrayList):
+	"""
+	Write an uncompressed npz (same layout as np.savez) where some arrays are
+	copied from raw files instead of memory
+
+	Parameters
+	----------
+	fileName : str, path
+		npz file. Written to a temporary file first.
+	arrayList : list
+		List of (name, array) or (name, (raw file object, dtype, length))
+	"""
+	tmpFileName = str(fileName) + ".tmp" + str(os.getpid())
+	with zipfile.ZipFile(tmpFileName, 'w', zipfile.ZIP_STORED,
+						 allowZip64=True) as zipFile:
+		for name, array in arrayList:
+			with zipFile.open(name + ".npy", 'w', force_zip64=True) as member:
+				if isinstance(array, np.ndarray):
+					np.lib.format.write_array(member, array)
+					continue
+				rawFile, dtype, length = array
+				np.lib.format.write_array_header_1_0(member,
+					{"descr":np.lib.format.dtype_to_descr(dtype),
+					 "fortran_order":False, "shape":(length,)})
+				rawFile.seek(0)
+				shutil.copyfileobj(rawFile, member, copyChunkSize)
+	os.replace(tmpFileName, fileName)
+
+
+def openEdgeSimMatrix(fileName):
+	"""
+	Memory map a ___pairwise.npz edge similarity matrix. The npz is
+	uncompressed (see saveEdgeSimMatrix) so each array is a contiguous part of
+	the file. Falls back to scipy.sparse.load_npz for compressed files.
+	Output: scipy.sparse.csr_matrix backed by read-only memory maps
+	"""
+	arrays = {}
+	with zipfile.ZipFile(fileName) as zipFile, open(fileName, 'rb') as file1:
+		for info in zipFile.infolist():
+			if info.compress_type != zipfile.ZIP_STORED:
+				return(scipy.sparse.load_npz(fileName))
+			# skip the local file header to the start of the .npy
+			file1.seek(info.header_offset)
+			localHeader = file1.read(zipLocalHeaderSize)
+			nameSize, extraSize = struct.unpack("<HH", localHeader[26:30])
+			file1.seek(info.header_offset + zipLocalHeaderSize + nameSize +
+					   extraSize)
+			version = np.lib.format.read_magic(file1)
+			if version == (1,0):
+				shape, fortranOrder, dtype = \
+					np.lib.format.read_array_header_1_0(file1)
+			else:
+				shape, fortranOrder, dtype = \
+					np.lib.format.read_array_header_2_0(file1)
+			name = info.filename[:-len(".npy")]
+			if name not in ["data", "indices", "indptr"] or \
+			   int(np.prod(shape)) == 0:
+				with zipFile.open(info) as member:
+					arrays[name] = np.lib.format.read_array(member)
+			else:
+				arrays[name] = np.memmap(fileName, dtype=dtype, mode='r',
+										 offset=file1.tell(), shape=shape)
+	nRow, nCol = (int(x) for x in arrays["shape"])
+	return(scipy.sparse.csr_matrix((arrays["data"], arrays["indices"],
+									arrays["indptr"]), shape=(nRow,nCol),
+								   copy=False))
+
+
+###############################################################################
+def buildTermCache(edgeFile, leftFile, rightFile, nRow):
+	"""
+	Hyperparameter free parts of the edge similarity matrix. The count and
+	intensity terms are linear in the lambdas. The edge length, edge shift and
+	edge start terms go through exp so the distances inside exp are kept
+	instead. The sparsity pattern (CSR indptr and indices including the
+	diagonal) does not depend on the hyperparameters.
+	Assume that edge file is sorted by leftFileRT
+
+	Returns
+	-------
+	termCache : dict
+		nRow, intensTerm, intensTermSum, pticDist, indptr, indices, diagPos
+		(position of the diagonal entry of each row), shiftDist and startDist
+		(one entry per matrix entry)
+	"""
+	edgeLeftpTIC, edgeRightpTIC, edgeTicDiff, intensTerm = \
+		getEdgeTerms(edgeFile, leftFile, rightFile)
+	lowerCount, upperCount, upperSum = \
+		countMatrixEntries(edgeLeftpTIC, edgeRightpTIC, edgeTicDiff, nRow,
+						   0.0, 0.0)
+	indptr = np.zeros(nRow + 1, dtype=np.int64)
+	np.cumsum(lowerCount + upperCount + 1, out=indptr[1:])
+	nnz = int(indptr[nRow])
+	indexDtype = getIndexDtype(nnz)
+	indptr = indptr.astype(indexDtype)
+	indices = np.empty(nnz, dtype=indexDtype)
+	shiftDist = np.empty(nnz, dtype=np.float64)
+	startDist = np.empty(nnz, dtype=np.float64)
+	fillMatrixDistances(edgeLeftpTIC, edgeRightpTIC, edgeTicDiff, nRow,
+						lowerCount, indptr, indices, shiftDist, startDist)
+	return({"nRow":np.int64(nRow), "intensTerm":intensTerm,
+			"intensTermSum":sumFloat32(intensTerm),
+			"pticDist":np.abs(edgeLeftpTIC - edgeRightpTIC),
+			"indptr":indptr, "indices":indices,
+			"diagPos":(indptr[:-1] + lowerCount).astype(np.int64),
+			"shiftDist":shiftDist, "startDist":startDist})
+
+
+def weightTermCache(termCache, lambda1, lambda2, lambda3, lambda4, \
+					alpha1, alpha2, alpha3):
+	"""
+	Edge similarity matrix from a term cache (see buildTermCache). Same output
+	as fillInMatrix but only takes linear combinations and exp of the cached
+	distances.
+	"""
+	nRow = int(termCache["nRow"])
+	indptr = termCache["indptr"]
+	diagPos = termCache["diagPos"]
+
+	diagScore, countTermSum, intensTermSum, pticTermSum = \
+		diagonalScore(termCache["intensTerm"], termCache["intensTermSum"],
+					  termCache["pticDist"], nRow, lambda1, lambda2, lambda3,
+					  alpha1)
+
+	# edge shift and edge start terms
+	simTerm = np.exp(-alpha2 * termCache["shiftDist"]) * \
+			  np.exp(-alpha3 * termCache["startDist"])
+	# sum twice for index i,j and j,i
+	edgeSimTermSum = 2 * np.sum(sumUpperEntries(indptr, diagPos, simTerm,
+												nRow))
+
+	simTerm *= lambda4
 	if edgeSimTermSum != 0:
-		valList = [x/edgeSimTermSum for x in valList]
-	
-	postTermNorm = (lambda1 * countTermSum) + (lambda2 * intensTermSum) + \
-				   (lambda3 * pticTermSum) + (lambda4 * edgeSimTermSum)
-	diagScoreArray = countTermArray + intensTermArray + pticTermArray
-	return(rowList,colList,valList,diagArray,diagScoreArray,postTermNorm)
+		simTerm /= edgeSimTermSum
+	data = simTerm.astype(np.float32)
+	data[diagPos] = diagScore
+
+	postTermNorm = postNormValue(countTermSum, intensTermSum, pticTermSum,
+								 edgeSimTermSum, lambda1, lambda2, lambda3,
+								 lambda4)
+	sparseMat = scipy.sparse.csr_matrix((data, termCache["indices"], indptr),
+										shape=(nRow,nRow), copy=False)
+	return(sparseMat,postTermNorm,int(indptr[nRow]))
+
+
+def getTermCacheFileName(edgeFileName, outputFolderName):
+	return(str(Path(outputFolderName) /
+			   Path(Path(edgeFileName).stem + "___terms.npz")))
+
+
+def saveTermCache(termCache, fileName):
+	tmpFileName = str(fileName) + ".tmp" + str(os.getpid()) + ".npz"
+	np.savez(tmpFileName, **termCache)
+	os.replace(tmpFileName, fileName)
+
+
+def loadTermCache(fileName):
+	with np.load(fileName) as termFile:
+		return({name:termFile[name] for name in termFile.files})
 
 leftFileIndex = 0
 rightFileIndex = 1
@@ -153,63 +606,193 @@ def normalizeIntensity(inputFile):
 
 
 ###############################################################################
+def loadPairInputs(edgeFileName, peakFolderName, edges=None):
+	"""
+	Edges of an edge file (text or binary, see create_edge.loadEdges) and the
+	MS1 feature matricies of its left and right runs. If edges is given (see
+	create_edge.buildEdges) it is used instead of reading the edge file.
+	Output: edges, left MS1 features, right MS1 features (None if there are
+			no edges)
+	"""
+	if edges is None:
+		edgeFile = create_edge.loadEdges(edgeFileName)
+	else:
+		edgeFile = edges
+	nRow = edgeFile.shape[0]
+	if nRow == 0:
+		return(edgeFile, None, None)
+
+	# leftFile and rightFile are MS1 feature files
+	leftFileName,rightFileName = getLeftRightFile(Path(edgeFileName).stem,
+												  peakFolderName)
+	# intensities of the binary feature files are already normalized by
+	# max value (see normalizeIntensity)
+	leftFile = feature_store.featureMatrix(
+		feature_store.loadFeatures(leftFileName))
+	rightFile = feature_store.featureMatrix(
+		feature_store.loadFeatures(rightFileName))
+
+	# checks that the last edge is between MS1 features
+	# that exist in the MS1 feature files
+	assert(edgeFile[nRow-1][leftPeakIndex] <= leftFile.shape[0])
+	assert(edgeFile[nRow-1][rightPeakIndex] <= rightFile.shape[0])
+	return(edgeFile, leftFile, rightFile)
+
+
+def getEdgeSimMatrixFileName(edgeFileName, outputFolderName):
+	return(str(Path(outputFolderName) /
+			   Path(Path(edgeFileName).stem + "___pairwise.npz")))
+
+
+def saveEdgeSimMatrix(sparseMat, edgeFileName, outputFolderName):
+	"""
+	Remove zero entries and write the sparse edge similarity matrix
+	Output: number of rows
+	"""
+	if Path(outputFolderName).is_dir() == False:
+		raise Exception(outputFolderName + " does not exist")
+	newFileName = getEdgeSimMatrixFileName(edgeFileName, outputFolderName)
+	sparseMat.eliminate_zeros()
+	scipy.sparse.save_npz(newFileName, sparseMat,compressed=False)
+	return(sparseMat.shape[0])
+
+
 def createEdgeSimMatrix(edgeFileName,peakFolderName,outputFolderName, \
 						lambda1, lambda2, lambda3,lambda4, \
-						alpha1, alpha2, alpha3):
+						alpha1, alpha2, alpha3, edges=None, termFolderName=None,
+						memory_mb=None, manifest=None):
+	"""
+	Create the sparse edge similarity matrix of an edge file (text or binary,
+	see create_edge.loadEdges). If edges is given (see create_edge.buildEdges)
+	it is used instead of reading the edge file. If termFolderName is given
+	the matrix is weighted from the term cache of the edge file (see
+	getTermCache, keyed in manifest) so later calls with other
+	hyperparameters are cheap.
+	Otherwise if memory_mb is given the matrix is written in chunks of rows
+	that keep at most memory_mb of entries in memory (see
+	fillInMatrixChunked).
+	"""
 	if Path(outputFolderName).is_dir() == False:
 		raise Exception(outputFolderName + " does not exist")
-
-	# determine new file name
 	edgeFileName_basename =  Path(edgeFileName).stem
-	newFileName = Path(outputFolderName) / Path(edgeFileName_basename + "___pairwise.npz")
 
-	# check if output file already exists
-	#if Path(newFileName).is_file():
-	#	return
-
-	edgeFile = np.loadtxt(edgeFileName,delimiter='\t',skiprows=1,ndmin=2)
+	if termFolderName is not None:
+		termCache = getTermCache(edgeFileName, peakFolderName, termFolderName,
+								 manifest, edges)
+		sparseMat,postNormVal,numEntries = \
+			weightTermCache(termCache, lambda1,lambda2,lambda3,lambda4,\
+							alpha1,alpha2,alpha3)
+		nRow = saveEdgeSimMatrix(sparseMat, edgeFileName, outputFolderName)
+		return(edgeFileName_basename,nRow,numEntries,postNormVal)
+
+	edgeFile, leftFile, rightFile = loadPairInputs(edgeFileName,
+												   peakFolderName, edges)
 	nRow = edgeFile.shape[0]
-
+	if nRow != 0 and memory_mb is not None:
+		postNormVal,numEntries = \
+			fillInMatrixChunked(edgeFile, leftFile, rightFile, nRow,\
+								lambda1,lambda2,lambda3,lambda4,\
+								alpha1,alpha2,alpha3,\
+								getEdgeSimMatrixFileName(edgeFileName,
+														 outputFolderName),
+								memory_mb)
+		return(edgeFileName_basename,nRow,numEntries,postNormVal)
 	if nRow != 0:
-		# leftFile and rightFile are MS1 feature files
-		leftFileName,rightFileName = getLeftRightFile(edgeFileName_basename,peakFolderName)
-		leftFile = np.loadtxt(leftFileName,delimiter='\t',skiprows=1)
-		rightFile = np.loadtxt(rightFileName,delimiter='\t',skiprows=1)
-
-		normalizeIntensity(leftFile)
-		normalizeIntensity(rightFile)
-
-		# checks that the last edge is between MS1 features
-		# that exist in the MS1 feature files
-		assert(edgeFile[nRow-1][0] <= leftFile.shape[0])
-		assert(edgeFile[nRow-1][1] <= rightFile.shape[0])
-
-		rowList,colList,valList,diagRow,diagScore,postNormVal = \
+		sparseMat,postNormVal,numEntries = \
 			fillInMatrix(edgeFile, leftFile, rightFile, nRow,\
 						 lambda1,lambda2,lambda3,lambda4,\
 						 alpha1,alpha2,alpha3)
+	else:
+		sparseMat = scipy.sparse.csr_matrix((nRow,nRow),dtype=np.float32)
+		postNormVal = 0.0
+		numEntries = 0
+
+	saveEdgeSimMatrix(sparseMat, edgeFileName, outputFolderName)
+	return(edgeFileName_basename,nRow,numEntries,postNormVal)
+
+
+def formatLogLine(edgeFileName_basename, nRow, numEntries, postNormVal):
+	"""
+	Line of pairwise-edge.log.txt for the output of createEdgeSimMatrix
+	"""
+	return(edgeFileName_basename + '\t' + str(nRow) + '\t' + str(numEntries) +
+		   '\t' + str(postNormVal) + '\n')
+
 
-		rowList_tmp = np.array(rowList,dtype=np.uint32)
-		del rowList
-		colList_tmp = np.array(colList,dtype=np.uint32)
-		del colList
-		valList_tmp = np.array(valList,dtype=np.float32)
-		del valList
-
-		rowList_np = np.append(diagRow,rowList_tmp)
-		del rowList_tmp
-		colList_np = np.append(diagRow,colList_tmp)
-		del colList_tmp
-		valList_np = np.append(diagScore,valList_tmp)
-		del valList_tmp
+###############################################################################
+def getTermCache(edgeFileName, peakFolderName, termFolderName, manifest, \
+				 edges=None):
+	"""
+	Load the ___terms.npz term cache of an edge file from termFolderName.
+	The cache is keyed in manifest (see artifact_cache) by the contents of the
+	edge file and its left and right MS1 feature files and is built (see
+	buildTermCache) if its key does not match.
+	"""
+	termFileName = getTermCacheFileName(edgeFileName, termFolderName)
+	leftFileName,rightFileName = getLeftRightFile(Path(edgeFileName).stem,
+												  peakFolderName)
+	termKey = artifact_cache.artifactKey("terms",
+		[artifact_cache.fileDigest(fileName, manifest)
+		 for fileName in [edgeFileName, leftFileName, rightFileName]], {})
+	if artifact_cache.isFresh(manifest, termFileName, termKey):
+		return(loadTermCache(termFileName))
+
+	artifact_cache.removeStale(termFileName)
+	edgeFile, leftFile, rightFile = loadPairInputs(edgeFileName,
+												   peakFolderName, edges)
+	if edgeFile.shape[0] == 0:
+		empty = np.zeros(0, dtype=np.float64)
+		termCache = {"nRow":np.int64(0), "intensTerm":empty,
+					 "intensTermSum":np.float32(0.0), "pticDist":empty,
+					 "indptr":np.zeros(1, dtype=np.int32),
+					 "indices":np.zeros(0, dtype=np.int32),
+					 "diagPos":np.zeros(0, dtype=np.int64),
+					 "shiftDist":empty, "startDist":empty}
 	else:
-		rowList_np = np.array([])
-		colList_np = np.array([])
-		valList_np = np.array([])
+		termCache = buildTermCache(edgeFile, leftFile, rightFile,
+								   edgeFile.shape[0])
+	saveTermCache(termCache, termFileName)
+	artifact_cache.recordArtifact(manifest, termFileName, termKey)
+	return(termCache)
 
-	sparseMat = scipy.sparse.csr_matrix((valList_np, (rowList_np, colList_np)),shape=(nRow,nRow))
-	sparseMat.eliminate_zeros()
 
-	#print(edgeFileName_basename,nRow,rowList_np.size,postNormVal)
-	scipy.sparse.save_npz(newFileName, sparseMat,compressed=False)
-	return(edgeFileName_basename,nRow,rowList_np.size,postNormVal)
+def sweepEdgeSimMatrix(edgeFileName, peakFolderName, termFolderName, \
+					   sweepList, manifest, edges=None):
+	"""
+	Create the sparse edge similarity matrix of an edge file for many
+	hyperparameter settings. The band scan is done once (see getTermCache)
+	and every setting only reweights the cached terms.
+
+	Parameters
+	----------
+	edgeFileName : str, path
+		Edge file (text or binary)
+	peakFolderName : str, path
+		Folder that contains the MS1 feature files
+	termFolderName : str, path
+		Folder of the ___terms.npz term cache
+	sweepList : list
+		List of (output folder, (lambda1, lambda2, lambda3, lambda4, alpha1,
+		alpha2, alpha3)). The ___pairwise.npz of each setting is written to
+		its output folder.
+	manifest : dict
+		Artifact manifest the term cache is keyed in (see artifact_cache).
+		Updated in place.
+	edges : numpy array
+		Edges of the edge file (see create_edge.buildEdges)
+
+	Returns
+	-------
+	List of (edge file stem, nRow, number of entries, post normalization
+	value) in the same order as sweepList. Same as createEdgeSimMatrix (see
+	formatLogLine for the pairwise-edge.log.txt line of each).
+	"""
+	termCache = getTermCache(edgeFileName, peakFolderName, termFolderName,
+							 manifest, edges)
+	edgeFileName_basename = Path(edgeFileName).stem
+	resultList = []
+	for outputFolderName, params in sweepList:
+		sparseMat,postNormVal,numEntries = weightTermCache(termCache, *params)
+		nRow = saveEdgeSimMatrix(sparseMat, edgeFileName, outputFolderName)
+		resultList.append((edgeFileName_basename,nRow,numEntries,postNormVal))
+	return(resultList)
@@ -0,0 +1,458 @@
+import collections
+import concurrent.futures
+import logging
+import os
+import time
+from pathlib import Path
+from bin import artifact_cache
+from bin import create_edge
+from bin import edge_to_json_matroid
+from bin import feature_store
+from bin import pairwise_edge_matrix
+from bin import solver
+from bin import solver_driver
+from bin import trace
+
+LOGGER = logging.getLogger(__name__)
+
+binFolder = str(Path(__file__).resolve().parent)
+# batch solver problems in flight per unit of solver_concurrency
+batchWindow = 2
+
+
+###############################################################################
+def usesJsonMatroid(config):
+	"""
+	coopraiz reads the JSON matroid. The native solver uses the binary sidecar
+	or the in-memory matroid
+	"""
+	return(config["solver"] in ["coopraiz", "coopraiz-batch"])
+
+
+def getPairFileNames(leftFile, rightFile, config):
+	"""
+	Names of the artifacts created for a pair of MS1 feature files
+	"""
+	edgeFile = create_edge.getEdgeFileName(leftFile, rightFile,
+										   config["edge_folder"],
+										   config["edge_format"])
+	stem = Path(edgeFile).stem
+	matroidExt = ".json" if usesJsonMatroid(config) else ".npz"
+	return({"edge":edgeFile,
+			"superset":create_edge.getSupersetFileName(leftFile, rightFile,
+													   config["edge_folder"]),
+			"matroid":config["matroid_folder"] + "/" + stem + "___matroid" +
+					  matroidExt,
+			"terms":pairwise_edge_matrix.getTermCacheFileName(edgeFile,
+						config["edge_sim_folder"]),
+			"pairwise":config["edge_sim_folder"] + "/" + stem +
+					   "___pairwise.npz",
+			"solver":config["edge_sim_folder"] + "/" + stem + "___solver.log"})
+
+
+def buildPairEdges(leftFile, rightFile, edgeFile, mz_tol, tic_tol, config):
+	"""
+	Generate an edge file with the edge backend of config
+	Output: edges (see create_edge.buildEdges). None if the createEdge binary
+			wrote the edge file
+	"""
+	if config["edge_backend"] == "createEdge":
+		# createEdge reads the binary feature files
+		feature_store.loadFeatures(leftFile)
+		feature_store.loadFeatures(rightFile)
+		create_edge.createEdge(feature_store.getBinaryFileName(leftFile),
+							   feature_store.getBinaryFileName(rightFile),
+							   edgeFile, binFolder + "/createEdge", mz_tol,
+							   tic_tol)
+		return(None)
+	# edges are kept in memory and handed to the next stages
+	return(create_edge.createEdgeInProcess(leftFile, rightFile, edgeFile,
+										   mz_tol, tic_tol))
+
+
+def buildEdgeFiles(pairList, config, manifest):
+	"""
+	Generate the missing edge files of every pair (superset edge files in a
+	tolerance sweep) with one call of the createEdge binary, which reads each
+	run once and runs the pairs on a pool of threads (see
+	create_edge.createEdgeFiles). The edge files are recorded in manifest so
+	runPair finds them up to date.
+	"""
+	if config["superset_tol"] is None:
+		fileType = "edge"
+		mz_tol, tic_tol = config["mz_tol"], config["tic_tol"]
+	else:
+		fileType = "superset"
+		mz_tol, tic_tol = config["superset_tol"]
+	taskList = []
+	for leftFile, rightFile in pairList:
+		edgeFile = getPairFileNames(leftFile, rightFile, config)[fileType]
+		edgeKey = artifact_cache.artifactKey("edges",
+			[artifact_cache.fileDigest(leftFile, manifest),
+			 artifact_cache.fileDigest(rightFile, manifest)],
+			{"mz_tol":mz_tol, "tic_tol":tic_tol})
+		if not artifact_cache.isFresh(manifest, edgeFile, edgeKey):
+			artifact_cache.removeStale(edgeFile)
+			taskList.append((leftFile, rightFile, edgeFile, edgeKey))
+	if len(taskList) == 0:
+		return
+
+	# createEdge reads the binary feature files
+	for fileName in sorted(set(x for task in taskList for x in task[:2])):
+		feature_store.loadFeatures(fileName)
+	start = time.perf_counter()
+	create_edge.createEdgeFiles([(feature_store.getBinaryFileName(leftFile),
+								  feature_store.getBinaryFileName(rightFile),
+								  edgeFile)
+								 for leftFile, rightFile, edgeFile, _ in taskList],
+								binFolder + "/createEdge", mz_tol, tic_tol)
+	LOGGER.info("createEdge built %d edge files in %.1f s", len(taskList),
+				time.perf_counter() - start)
+	for _, _, edgeFile, edgeKey in taskList:
+		artifact_cache.recordArtifact(manifest, edgeFile, edgeKey)
+
+
+def getSolverKey(fileNames, config, cache):
+	return(artifact_cache.artifactKey("solver",
+		[artifact_cache.fileDigest(fileNames["pairwise"], cache),
+		 artifact_cache.fileDigest(fileNames["matroid"], cache)],
+		{"solver":config["solver"]}))
+
+
+def saveSolverOutput(fileNames, config, cache, solverResult, solverOutput):
+	"""
+	Keep the standard output of the solver next to the edge similarity matrix
+	and record it in cache
+	"""
+	with open(fileNames["solver"], 'w') as newFile:
+		newFile.write(solverOutput)
+	# failed solves are not recorded so they are retried
+	if solverResult is not None:
+		artifact_cache.recordArtifact(cache, fileNames["solver"],
+			getSolverKey(fileNames, config, cache), list(solverResult))
+
+
+def addSolverRecord(record, solverResult, outcome=None):
+	"""
+	Add the solver result (and the solver_driver.SolveOutcome of a batch
+	solver) to the trace record of a pair
+	"""
+	if outcome is not None:
+		record["stages"]["solver"]["wall"] = outcome.seconds
+		record.update({"solverStatus":outcome.status,
+					   "solverAttempts":outcome.attempts})
+	if solverResult is not None:
+		record.update({"score":solverResult.score,
+					   "numSelectedEdge":solverResult.numSelectedEdge,
+					   "numIterations":solverResult.numIterations})
+
+
+def runPair(leftFile, rightFile, config, cache, solve=True):
+	"""
+	Run the full per-pair chain (edges, matroid, sparse edge similarity matrix
+	and solver) for a single pair of MS1 feature files. Each stage is skipped
+	if its artifact was already created from the same inputs and parameters
+	(see artifact_cache).
+
+	Parameters
+	----------
+	leftFile : str, path
+		MS1 feature file of the left run
+	rightFile : str, path
+		MS1 feature file of the right run
+	config : dict
+		Folders and hyperparameters shared by every pair. See ms1Connect.
+	cache : dict
+		Manifest entries of the artifacts of this pair (see
+		artifact_cache.subManifest). Updated in place.
+	solve : bool
+		False leaves the problem of a batch solver (see solver_driver) to the
+		caller: solverOutput and solverResult are None and record has
+		"solverPending". Default solves it with the solver_driver of this
+		process.
+
+	Returns
+	-------
+	edgeStem : str
+		Stem of the edge file (left___right___score)
+	pairwiseLine : str
+		Line for pairwise-edge.log.txt
+	solverOutput : str
+		Standard output of the solver
+	solverResult : solver.SolverResult
+		Score and number of selected edges. None if the solver failed.
+	cache : dict
+		Updated manifest entries of this pair
+	record : dict
+		Trace record of this pair (see trace)
+	"""
+	fileNames = getPairFileNames(leftFile, rightFile, config)
+	edgeFile = fileNames["edge"]
+	record = trace.newRecord("pair", Path(edgeFile).stem)
+	profileArgs = (config["profile_stages"], config["profile_folder"])
+	leftDigest = artifact_cache.fileDigest(leftFile, cache)
+	rightDigest = artifact_cache.fileDigest(rightFile, cache)
+
+	# edges. In a tolerance sweep the edges are filtered from the superset
+	# edges built once at the widest tolerance
+	edges = None
+	edgeKey = artifact_cache.artifactKey("edges", [leftDigest, rightDigest],
+		{"mz_tol":config["mz_tol"], "tic_tol":config["tic_tol"]})
+	with trace.stage(record, "edges", *profileArgs) as stats:
+		stats["cached"] = artifact_cache.isFresh(cache, edgeFile, edgeKey)
+		if not stats["cached"]:
+			artifact_cache.removeStale(edgeFile)
+			if config["superset_tol"] is None:
+				edges = buildPairEdges(leftFile, rightFile, edgeFile,
+									   config["mz_tol"], config["tic_tol"],
+									   config)
+			else:
+				supersetFile = fileNames["superset"]
+				supersetMzTol, supersetTicTol = config["superset_tol"]
+				supersetKey = artifact_cache.artifactKey("edges",
+					[leftDigest, rightDigest],
+					{"mz_tol":supersetMzTol, "tic_tol":supersetTicTol})
+				if not artifact_cache.isFresh(cache, supersetFile, supersetKey):
+					artifact_cache.removeStale(supersetFile)
+					buildPairEdges(leftFile, rightFile, supersetFile,
+								   supersetMzTol, supersetTicTol, config)
+					artifact_cache.recordArtifact(cache, supersetFile,
+												  supersetKey)
+				edges = create_edge.createEdgeFromSuperset(leftFile, rightFile,
+					supersetFile, edgeFile, config["mz_tol"], config["tic_tol"])
+			artifact_cache.recordArtifact(cache, edgeFile, edgeKey)
+		edgeDigest = artifact_cache.fileDigest(edgeFile, cache)
+
+	# matroid
+	matroid = None
+	isJson = usesJsonMatroid(config)
+	matroidKey = artifact_cache.artifactKey("matroid", [edgeDigest], {})
+	with trace.stage(record, "matroid", *profileArgs) as stats:
+		stats["cached"] = artifact_cache.isFresh(cache, fileNames["matroid"],
+												 matroidKey)
+		if not stats["cached"]:
+			artifact_cache.removeStale(fileNames["matroid"])
+			matroid = edge_to_json_matroid.createJsonMatroid(Path(edgeFile),
+				config["matroid_folder"], edges, writeJson=isJson,
+				writeBinary=not isJson)
+			artifact_cache.recordArtifact(cache, fileNames["matroid"],
+										  matroidKey)
+
+	# sparse edge similarity matrix
+	pairwiseParams = {name:config[name] for name in ["lambda1", "lambda2",
+					  "lambda3", "lambda4", "alpha", "beta", "gamma"]}
+	pairwiseKey = artifact_cache.artifactKey("pairwise",
+		[edgeDigest, leftDigest, rightDigest], pairwiseParams)
+	with trace.stage(record, "pairwise", *profileArgs) as stats:
+		stats["cached"] = artifact_cache.isFresh(cache, fileNames["pairwise"],
+												 pairwiseKey)
+		if stats["cached"]:
+			fileName, nRow, rowListSize, postNormVal = \
+				artifact_cache.getMeta(cache, fileNames["pairwise"])
+		else:
+			fileName, nRow, rowListSize, postNormVal = \
+				pairwise_edge_matrix.createEdgeSimMatrix(edgeFile,
+				config["ms1_folder"], config["edge_sim_folder"],
+				config["lambda1"], config["lambda2"], config["lambda3"],
+				config["lambda4"], config["alpha"], config["beta"],
+				config["gamma"], edges,
+				config["edge_sim_folder"] if config["term_cache"] else None,
+				config["pairwise_memory_mb"], cache)
+			artifact_cache.recordArtifact(cache, fileNames["pairwise"],
+				pairwiseKey,
+				[fileName, int(nRow), int(rowListSize), float(postNormVal)])
+	pairwiseLine = pairwise_edge_matrix.formatLogLine(fileName, nRow,
+													  rowListSize, postNormVal)
+	record.update({"numEdges":int(nRow), "numEntries":int(rowListSize),
+				   "postNormVal":float(postNormVal)})
+	if config["trace_file"] is not None:
+		# memory mapped so tracing does not load the whole matrix
+		sparseMat = pairwise_edge_matrix.openEdgeSimMatrix(fileNames["pairwise"])
+		record["nnz"] = int(sparseMat.nnz)
+		record.update(trace.bandStats(sparseMat))
+
+	# solver. Standard output is kept next to the edge similarity matrix
+	outcome = None
+	solverKey = getSolverKey(fileNames, config, cache)
+	with trace.stage(record, "solver", *profileArgs) as stats:
+		stats["cached"] = artifact_cache.isFresh(cache, fileNames["solver"],
+												 solverKey)
+		if stats["cached"]:
+			solverResult = solver.SolverResult(
+				*artifact_cache.getMeta(cache, fileNames["solver"]))
+			with open(fileNames["solver"], 'r') as file1:
+				solverOutput = file1.read()
+		elif config["solver"] in solver_driver.batchSolvers:
+			if solve:
+				outcome = solver_driver.getDriver(config).solve(
+					fileNames["pairwise"], fileNames["matroid"])
+				solverResult, solverOutput = solver_driver.outcomeResult(outcome)
+				saveSolverOutput(fileNames, config, cache, solverResult,
+								 solverOutput)
+			else:
+				solverResult, solverOutput = None, None
+				record["solverPending"] = True
+		else:
+			solverResult, solverOutput = \
+				solver.solverBackends[config["solver"]](fileNames["pairwise"],
+														fileNames["matroid"],
+														matroid)
+			saveSolverOutput(fileNames, config, cache, solverResult,
+							 solverOutput)
+	addSolverRecord(record, solverResult, outcome)
+
+	LOGGER.info("Finished %s (pid %s)", fileName, os.getpid())
+	return(Path(edgeFile).stem, pairwiseLine, solverOutput, solverResult,
+		   cache, record)
+
+
+def _runPairStar(args):
+	return(runPair(*args))
+
+
+def finishBatchSolve(result, fileNames, config, outcome):
+	"""
+	Add the solver_driver.SolveOutcome of a pair left to the caller by
+	runPair (solve=False) to its runPair output
+	"""
+	edgeStem, pairwiseLine, solverOutput, solverResult, cache, record = result
+	solverResult, solverOutput = solver_driver.outcomeResult(outcome)
+	saveSolverOutput(fileNames, config, cache, solverResult, solverOutput)
+	del record["solverPending"]
+	addSolverRecord(record, solverResult, outcome)
+	return(edgeStem, pairwiseLine, solverOutput, solverResult, cache, record)
+
+
+def _initWorker(numThreads):
+	"""
+	Split the cores between worker processes so the parallel numba kernels
+	of each worker do not oversubscribe the machine
+	"""
+	import numba
+	numba.set_num_threads(max(1, min(numThreads, numba.config.NUMBA_NUM_THREADS)))
+
+
+###############################################################################
+def checkConfig(config):
+	"""
+	Raise an exception if options of config cannot be combined
+	"""
+	if config["superset_tol"] is not None and \
+	   (config["superset_tol"][0] < config["mz_tol"] or
+		config["superset_tol"][1] < config["tic_tol"]):
+		raise Exception("Superset tolerance " + str(config["superset_tol"]) +
+						" is narrower than mz_tol " + str(config["mz_tol"]) +
+						" or tic_tol " + str(config["tic_tol"]))
+	if config["term_cache"] and config["pairwise_memory_mb"] is not None:
+		raise Exception("The term cache keeps every matrix entry in memory and "
+						"cannot be used with pairwise_memory_mb")
+
+
+def sortPairs(pairList, config):
+	"""
+	Pairs sorted by edge file name (order of the outputs of runPairs)
+	"""
+	return(sorted(pairList, key=lambda x: create_edge.getEdgeFileName(
+		x[0], x[1], config["edge_folder"], config["edge_format"])))
+
+
+def runPairs(pairList, config, jobs=1, manifest=None):
+	"""
+	Run runPair on every pair of MS1 feature files using a pool of worker
+	processes. Results are yielded sorted by edge file name so the output is
+	identical to a serial run regardless of the order pairs finish in.
+	Each worker gets the manifest entries of its pair and the updated entries
+	are merged back into manifest. With a batch solver (see solver_driver)
+	each problem is sent to one solver process as soon as its pair is ready
+	and the problems are solved concurrently.
+	With the createEdge edge backend the edge files of every pair are built
+	first by one call of the createEdge binary (see buildEdgeFiles).
+
+	Parameters
+	----------
+	pairList : list
+		List of (left file, right file) tuples
+	config : dict
+		Folders and hyperparameters shared by every pair
+	jobs : int
+		Number of worker processes. 1 runs every pair in this process.
+	manifest : dict
+		Artifact manifest (see artifact_cache). Updated in place.
+
+	Returns
+	-------
+	Generator of runPair outputs
+	"""
+	checkConfig(config)
+	pairList = sortPairs(pairList, config)
+	if manifest is None:
+		manifest = artifact_cache.emptyManifest()
+	if config["edge_backend"] == "createEdge":
+		buildEdgeFiles(pairList, config, manifest)
+	isBatch = config["solver"] in solver_driver.batchSolvers
+	argList = []
+	fileNameList = []
+	for leftFile, rightFile in pairList:
+		fileNames = getPairFileNames(leftFile, rightFile, config)
+		cache = artifact_cache.subManifest(manifest,
+			[leftFile, rightFile] + list(fileNames.values()))
+		argList.append((leftFile, rightFile, config, cache, not isBatch))
+		fileNameList.append(fileNames)
+
+	if isBatch:
+		yield from runBatchSolver(_runPairOutputs(argList, jobs), fileNameList,
+								  config, manifest)
+		return
+	for result in _runPairOutputs(argList, jobs):
+		artifact_cache.mergeManifest(manifest, result[4])
+		yield(result)
+
+
+def _runPairOutputs(argList, jobs):
+	if jobs <= 1:
+		for args in argList:
+			yield(_runPairStar(args))
+		return
+
+	# map returns results in submission order even though pairs are scored
+	# concurrently
+	numThreads = (os.cpu_count() or 1) // jobs
+	with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+			initializer=_initWorker, initargs=(numThreads,)) as executor:
+		yield from executor.map(_runPairStar, argList)
+
+
+def runBatchSolver(pairOutputs, fileNameList, config, manifest):
+	"""
+	Solve the problems runPair left to the caller with the solver_driver of
+	this process while the remaining pairs are prepared. At most
+	batchWindow * solver_concurrency problems are in flight; a result is
+	yielded as soon as it and every result before it are done.
+	Output: generator of runPair outputs in pairOutputs order
+	"""
+	maxInFlight = batchWindow * max(config["solver_concurrency"], 1)
+	resultQueue = collections.deque()
+	numInFlight = 0
+	for result, fileNames in zip(pairOutputs, fileNameList):
+		future = None
+		if result[5].get("solverPending"):
+			future = solver_driver.getDriver(config).submit(fileNames["pairwise"],
+															fileNames["matroid"])
+			numInFlight += 1
+		resultQueue.append((result, fileNames, future))
+		while resultQueue and (numInFlight >= maxInFlight or
+							   resultQueue[0][2] is None or
+							   resultQueue[0][2].done()):
+			isSolved, result = _finishHead(resultQueue, config, manifest)
+			numInFlight -= isSolved
+			yield(result)
+	while resultQueue:
+		yield(_finishHead(resultQueue, config, manifest)[1])
+
+
+def _finishHead(resultQueue, config, manifest):
+	result, fileNames, future = resultQueue.popleft()
+	if future is not None:
+		result = finishBatchSolve(result, fileNames, config, future.result())
+	artifact_cache.mergeManifest(manifest, result[4])
+	return(future is not None, result)
@@ -0,0 +1,10 @@
+# Plot methods of plots.createRunSimMatrix. Kept apart from plots so command
+# line parsers can list them without importing the plotting dependencies
+# (seaborn, matplotlib, sklearn).
+
+# cohorts with more runs than this are embedded with classical MDS and drawn
+# as a rasterized heatmap when the plot method is auto
+largeCohortSize = 500
+
+mdsMethods = ["auto", "smacof", "classical", "landmark"]
+heatmapModes = ["auto", "cells", "raster", "label"]
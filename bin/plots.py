@@ -4,12 +4,16 @@ import numpy as np
 import seaborn as sns
 import pandas as pd
 import re
+import scipy.sparse
+import scipy.sparse.linalg
 from matplotlib import pyplot as plt
 from matplotlib import patches as mpatches
 from sklearn.manifold import MDS
 from sklearn.metrics.pairwise import euclidean_distances
 from sklearn import metrics
 from pathlib import Path
+from bin import plot_modes
+from bin import results_store
 
 
 ###############################################################################
@@ -61,17 +65,118 @@ lines in " + metadataFileName)
 
 
 ###############################################################################
-def plotMDS(runMatrix, metadata_label, output_folder):
+def classicalMDS(runMatrix, n_components=2):
+	"""
+	Classical MDS of the euclidean distances between rows of the run
+	similarity matrix (the distances plotMDS gives SMACOF). Classical MDS of
+	euclidean distances is the projection of the centered rows onto their
+	top principal axes, so the distance matrix is never formed. The top
+	eigenvectors of the centered Gram matrix are found with eigsh using only
+	matrix-vector products with the run similarity matrix.
+	Input1: matrix of pairwise run similarities
+	Output: numpy array of coordinates (one row per run)
+	"""
+	runMatrix = np.asarray(runMatrix, dtype=np.float64)
+	nRun = runMatrix.shape[0]
+	mean = runMatrix.mean(axis=0)
+	if nRun <= n_components + 1:
+		centered = runMatrix - mean
+		eigVal, eigVec = np.linalg.eigh(centered @ centered.T)
+	else:
+		def matvec(v):
+			v = np.ravel(v)
+			y = runMatrix.T @ v - mean * np.sum(v)
+			return(runMatrix @ y - np.dot(mean, y))
+		gram = scipy.sparse.linalg.LinearOperator((nRun,nRun), matvec=matvec,
+												  rmatvec=matvec,
+												  dtype=np.float64)
+		# fixed start vector so the plot is reproducible
+		v0 = np.random.default_rng(0).standard_normal(nRun)
+		eigVal, eigVec = scipy.sparse.linalg.eigsh(gram, k=n_components,
+												   which='LA', v0=v0)
+	return(mdsCoordinates(eigVal, eigVec, n_components))
+
+
+def landmarkMDS(runMatrix, n_components=2, numLandmarks=200, seed=0):
+	"""
+	Landmark MDS. Classical MDS is run on the distances between numLandmarks
+	random runs and every other run is placed from its distances to the
+	landmarks (de Silva and Tenenbaum 2004). Distances are euclidean
+	distances between rows of the run similarity matrix.
+	Input1: matrix of pairwise run similarities
+	Output: numpy array of coordinates (one row per run)
+	"""
+	runMatrix = np.asarray(runMatrix, dtype=np.float64)
+	nRun = runMatrix.shape[0]
+	if nRun <= numLandmarks:
+		return(classicalMDS(runMatrix, n_components))
+	rng = np.random.default_rng(seed)
+	landmarks = np.sort(rng.choice(nRun, size=numLandmarks, replace=False))
+
+	# squared distances of every run to the landmarks
+	sqNorm = np.einsum('ij,ij->i', runMatrix, runMatrix)
+	sqDist = sqNorm[:,None] + sqNorm[None,landmarks] - \
+			 2 * (runMatrix @ runMatrix[landmarks].T)
+	sqDist = np.maximum(sqDist, 0)
+
+	# classical MDS of the landmarks
+	landmarkSqDist = sqDist[landmarks]
+	meanSqDist = landmarkSqDist.mean(axis=1)
+	centering = np.eye(numLandmarks) - 1.0 / numLandmarks
+	eigVal, eigVec = np.linalg.eigh(-0.5 * centering @ landmarkSqDist @
+									centering)
+	order = np.argsort(eigVal)[::-1][0:n_components]
+	eigVal = np.maximum(eigVal[order], np.finfo(np.float64).tiny)
+	eigVec = eigVec[:,order]
+
+	# triangulate every run from its distances to the landmarks
+	coords = -0.5 * (sqDist - meanSqDist[None,:]) @ (eigVec / np.sqrt(eigVal))
+	# landmarks are centered on their own mean and their principal axes. Center
+	# and rotate onto the axes of every run (same axes as classicalMDS)
+	coords = coords - coords.mean(axis=0)
+	axes = np.linalg.svd(coords, full_matrices=False)[2]
+	return(fixSigns(coords @ axes.T))
+
+
+def mdsCoordinates(eigVal, eigVec, n_components):
+	"""
+	Coordinates from the eigenpairs of a centered Gram matrix
+	"""
+	order = np.argsort(eigVal)[::-1][0:n_components]
+	coords = eigVec[:,order] * np.sqrt(np.maximum(eigVal[order], 0))
+	return(fixSigns(coords))
+
+
+def fixSigns(coords):
+	"""
+	Flip each axis so its largest coordinate is positive (eigenvectors have
+	an arbitrary sign)
+	"""
+	maxIndex = np.argmax(np.abs(coords), axis=0)
+	signs = np.sign(coords[maxIndex, np.arange(coords.shape[1])])
+	signs[signs == 0] = 1
+	return(coords * signs)
+
+
+def plotMDS(runMatrix, metadata_label, output_folder, method="smacof"):
 	"""
 	Plots MDS on run similarity matrix. Plots a normal MDS.
 	If species data also plots a second MDS to better visualize things
 	Input1: matrix of pairwise run similarities
 	Input2: list of labels (run order in run sim matrix)
+	Input3: output folder
+	Input4: "smacof" (sklearn MDS), "classical" (see classicalMDS) or
+			"landmark" (see landmarkMDS)
 	"""
-    # MDS of run sim matrix
-	dist = euclidean_distances(runMatrix)
-	model = MDS(dissimilarity='precomputed',n_components=2,random_state=0)
-	out = model.fit_transform(dist)
+	if method == "classical":
+		out = classicalMDS(runMatrix)
+	elif method == "landmark":
+		out = landmarkMDS(runMatrix)
+	else:
+		# MDS of run sim matrix
+		dist = euclidean_distances(runMatrix)
+		model = MDS(dissimilarity='precomputed',n_components=2,random_state=0)
+		out = model.fit_transform(dist)
 
     # normal MDS
 	fig,ax = plt.subplots()
@@ -83,6 +188,16 @@ def plotMDS(runMatrix, metadata_label, output_folder):
 
 
 ###############################################################################
+def squareColorBar(c_bar):
+	"""
+	square the color bar tick label to undo sqrt of sim matrix
+	"""
+	ticLoc = c_bar.get_ticks()
+	newTic = [int(x*x) for x in ticLoc]
+	c_bar.set_ticks(ticLoc)
+	c_bar.set_ticklabels(newTic)
+
+
 def plotHeatmap(inputRunMatrix, tick_label, output_folder):
 	"""
 	Plot two different heatmaps of the run similarity matrix
@@ -99,13 +214,7 @@ def plotHeatmap(inputRunMatrix, tick_label, output_folder):
 	fig,ax = plt.subplots()
 	ax = sns.heatmap(inputRunMatrix,vmin=vmin,vmax=vmax, \
                      xticklabels=tick_label,yticklabels=tick_label)
-
-	# square the color bar tick label to undo sqrt of sim matrix
-	c_bar = ax.collections[0].colorbar
-	ticLoc = c_bar.get_ticks()
-	newTic = [int(x*x) for x in ticLoc]
-	c_bar.set_ticks(ticLoc)
-	c_bar.set_ticklabels(newTic)
+	squareColorBar(ax.collections[0].colorbar)
 
 	plt.tight_layout()
 	fig.savefig(output_folder + "/heatmap.png")
@@ -117,63 +226,67 @@ def plotHeatmap(inputRunMatrix, tick_label, output_folder):
 #	plt.close()
 
 
-###############################################################################
-def fillInSimMatrixCooprize(ms1FileList,scoreFile,matrix):
+def plotHeatmapRaster(inputRunMatrix, metadata_label, output_folder):
 	"""
-	Fill in run similarity matrix based on cooprize output file
-    Fill in run similarity matrix based on baseline output file
-	Input1: List of ordered file names (same run order as matrix)
-	Input2: output of baseline score file
-	Input3: run similarity matrix to be filled in
+	Heatmap of the run similarity matrix for large cohorts. Runs are grouped
+	by metadata label and the matrix is drawn as a single image with one
+	tick per label instead of one cell and tick per run.
+	Input1: run similarity matrix
+	Input2: list of labels (run order in run sim matrix)
 	"""
-	coopLeftFileIndex = 1
-	coopRightFileIndex = 2
-	scoreFileDelim = "___"
-	numEdgeDic = {}
-	with open(scoreFile,'r') as file1:
-		for line1 in file1:
-			if line1.startswith("filename___"):
-				line1_sp = line1.split(scoreFileDelim)
-
-				leftFile = line1_sp[coopLeftFileIndex]
-				rightFile = line1_sp[coopRightFileIndex]
-
-				if leftFile not in ms1FileList or \
-				   rightFile not in ms1FileList:
-					leftFileIndex = -1
-					rightFileIndex = -1
-				else:
-					leftFileIndex = ms1FileList.index(leftFile)
-					rightFileIndex = ms1FileList.index(rightFile)
-			elif line1.startswith("Loaded raw SPSSD "):
-				line1_sp = line1.split(' ')
-				token = line1_sp[3]
-				token_sp = token.split("x")
-				numEdges = float(token_sp[0])
-			elif line1.startswith("Summary valuation:"):
-				# to get # selected edges
-				line1_sp = line1.split(',')
-				token = line1_sp[0]
-				token_sp = token.split('=')
-				numSelectedEdge = float(token_sp[1])
-
-				# to get score
-				line1_sp = line1.split("=")
-				lastIndex = len(line1_sp) - 1
-				score = float(line1_sp[lastIndex].strip())
-
-				if leftFileIndex == -1 and \
-				   rightFileIndex == -1:
-					continue
-				matrix[leftFileIndex,rightFileIndex] = score
-				matrix[rightFileIndex,leftFileIndex] = score 
-
-				# fill in numEdgeDic
-				dicKey = str(leftFileIndex) + "-" + str(rightFileIndex)
-				numEdgeDic[dicKey] = numEdges
-				dicKey = str(rightFileIndex) + "-" + str(leftFileIndex)
-				numEdgeDic[dicKey] = numEdges
-	return(numEdgeDic)
+	labels = np.asarray(metadata_label).astype(str)
+	order = np.argsort(labels, kind='stable')
+	labels = labels[order]
+	inputRunMatrix = np.sqrt(inputRunMatrix[np.ix_(order, order)])
+	vmax = np.percentile(inputRunMatrix,95)
+	vmin = np.amin(inputRunMatrix)
+
+	# first run of each label (labels are sorted)
+	uniqLabel, start, count = np.unique(labels, return_index=True,
+										return_counts=True)
+	end = start + count
+
+	fig,ax = plt.subplots()
+	image = ax.imshow(inputRunMatrix, vmin=vmin, vmax=vmax, cmap="rocket",
+					  aspect='equal', rasterized=True)
+	for boundary in start[1:]:
+		ax.axhline(boundary - 0.5, color='white', linewidth=0.5)
+		ax.axvline(boundary - 0.5, color='white', linewidth=0.5)
+	tickLoc = (start + end - 1) / 2
+	ax.set_xticks(tickLoc)
+	ax.set_xticklabels(uniqLabel, rotation=90)
+	ax.set_yticks(tickLoc)
+	ax.set_yticklabels(uniqLabel)
+	squareColorBar(fig.colorbar(image, ax=ax))
+
+	plt.tight_layout()
+	fig.savefig(output_folder + "/heatmap.png")
+	plt.close(fig)
+
+
+def plotHeatmapAggregate(inputRunMatrix, metadata_label, output_folder):
+	"""
+	Heatmap of the mean run similarity between every pair of metadata labels
+	Input1: run similarity matrix
+	Input2: list of labels (run order in run sim matrix)
+	"""
+	labels = np.asarray(metadata_label).astype(str)
+	uniqLabel, labelIndex = np.unique(labels, return_inverse=True)
+	membership = scipy.sparse.csr_matrix(
+		(np.ones(labels.size), (np.arange(labels.size), labelIndex)),
+		shape=(labels.size, uniqLabel.size))
+	blockSum = np.asarray((membership.T @ (membership.T @
+						   inputRunMatrix).T).T)
+	count = np.asarray(membership.sum(axis=0)).ravel()
+	blockMean = np.sqrt(blockSum / np.outer(count, count))
+
+	fig,ax = plt.subplots()
+	ax = sns.heatmap(blockMean, xticklabels=uniqLabel, yticklabels=uniqLabel)
+	squareColorBar(ax.collections[0].colorbar)
+
+	plt.tight_layout()
+	fig.savefig(output_folder + "/heatmap_by_label.png")
+	plt.close(fig)
 
 
 ###############################################################################
@@ -188,65 +301,44 @@ def assertDiagonal(curRunMatrix):
 	if nRow == 2:
 		return
 	for i in range(0,nRow):
-		assert(curRunMatrix[i][i] != 0), "Metadata file contains file that was not present in score file. Remove from metadata file. %s line" %(i)
+		assert(curRunMatrix[i][i] != 0), "Metadata file contains file that was not present in the results store. Remove from metadata file. %s line" %(i)
 	return
 
 
-##############################################################################
-def postNormBySetE(inputRunMatrix, setEScores, ms1FileList):
-	"""
-	Allows for post normalization of coopraize scores by some value
-	found in setEScores file
-	"""
-	ext = "_ms1Peak.txt"
-	# currently assumes that post norm value is found in 4th column of file
-	with open(setEScores,'r') as normFile:
-		for line1 in normFile:
-			line1_sp = line1.strip().split('\t')
-
-			curFile = line1_sp[0]
-			curFile_sp = curFile.split("___")
-
-			leftFile = curFile_sp[0]
-			rightFile = curFile_sp[1]
-
-			leftFileIndex = ms1FileList.index(leftFile)
-			rightFileIndex = ms1FileList.index(rightFile)
-			
-			normVal = float(line1_sp[3])
-
-			if leftFileIndex == rightFileIndex:
-				inputRunMatrix[leftFileIndex][rightFileIndex] = \
-				inputRunMatrix[leftFileIndex][rightFileIndex] * normVal
-			else:
-				inputRunMatrix[leftFileIndex][rightFileIndex] = \
-				inputRunMatrix[leftFileIndex][rightFileIndex] * normVal
-
-				inputRunMatrix[rightFileIndex][leftFileIndex] = \
-				inputRunMatrix[rightFileIndex][leftFileIndex] * normVal
-
-
 ###############################################################################			
-def createRunSimMatrix(ms1PeakFolderName, scoreFileName, metadataFileName, \
-					   edgeCountFileName, output_folder):
+def createRunSimMatrix(ms1PeakFolderName, metadataFileName, resultsStoreName, \
+					   output_folder, mdsMethod="auto", heatmapMode="auto"):
 	"""
 	Main driver script
+	The post-normalized run similarity matrix is built from the results store
+	(see results_store.assembleRunMatrix) in metadata file order.
+	mdsMethod (see plotMDS) and heatmapMode (cells is plotHeatmap, raster is
+	plotHeatmapRaster and plotHeatmapAggregate, label is plotHeatmapAggregate)
+	are picked from the number of runs if auto
 	"""
 	fileList, metadataList = getFileList(ms1PeakFolderName,metadataFileName)
-	runMatrix = np.zeros((len(fileList),len(fileList)))
+	conn = results_store.openResultsStore(resultsStoreName)
+	runMatrix = results_store.assembleRunMatrix(fileList,
+		results_store.loadPairResults(conn))
+	conn.close()
 
-	# create run similarity matrix
-	edgeDic = fillInSimMatrixCooprize(fileList, scoreFileName, runMatrix)
-	
 	# assert diagonal is non-zero
 	assertDiagonal(runMatrix)
 
-	# post-normalize each value in runMatrix
-	# by value of last col in file
-	postNormBySetE(runMatrix,edgeCountFileName,fileList)
-
-	plotHeatmap(runMatrix, metadataList, output_folder)
-	plotMDS(runMatrix, metadataList, output_folder)
+	isLarge = len(fileList) > plot_modes.largeCohortSize
+	if mdsMethod == "auto":
+		mdsMethod = "classical" if isLarge else "smacof"
+	if heatmapMode == "auto":
+		heatmapMode = "raster" if isLarge else "cells"
+
+	if heatmapMode == "cells":
+		plotHeatmap(runMatrix, metadataList, output_folder)
+	else:
+		# the raster heatmap is paired with the per label summary
+		if heatmapMode == "raster":
+			plotHeatmapRaster(runMatrix, metadataList, output_folder)
+		plotHeatmapAggregate(runMatrix, metadataList, output_folder)
+	plotMDS(runMatrix, metadataList, output_folder, mdsMethod)
 
 	np.savetxt(output_folder + "/output_score_matrix.txt", runMatrix, \
 			   delimiter='\t',fmt='%f')
@@ -254,16 +346,27 @@ def createRunSimMatrix(ms1PeakFolderName, scoreFileName, metadataFileName, \
 
 ###############################################################################
 if __name__ == "__main__":
-	parser = argparse.ArgumentParser(description='From baseline metric output '+
+	parser = argparse.ArgumentParser(description='From the results store '+
 	"Create a pairwise run similarity matrix. Plot heatmap and " +
 	"MDS of this matrix. Metadata file determines order of runs " +
 	"in output files.")
 	parser.add_argument("ms1PeakFolder", help='Folder containing MS1 peaks')
-	parser.add_argument("baselineOutput", help='coopraize score file')
 	parser.add_argument("metadataFile", help='Metadata file for LB data')
-	parser.add_argument('edgeCountFile', help='pairwise edge count file. ' +
-	"This file contains the score used for post-normalization")
+	parser.add_argument("resultsStore", help='SQLite results store with the\
+	score and post-normalization value of every pair')
 	parser.add_argument("output", help="output folder")
+	parser.add_argument("--mdsMethod", help='MDS method. smacof is sklearn\
+	MDS, classical and landmark scale to thousands of runs. auto uses\
+	classical above ' + str(plot_modes.largeCohortSize) + ' runs.\
+	Default=auto',
+						default="auto", choices=plot_modes.mdsMethods)
+	parser.add_argument("--heatmapMode", help='Heatmap mode. cells draws every\
+	run with a tick label, raster draws the matrix as an image grouped by\
+	metadata label, label draws the mean similarity between labels. auto uses\
+	raster above ' + str(plot_modes.largeCohortSize) + ' runs.\
+	Default=auto',
+						default="auto", choices=plot_modes.heatmapModes)
 	args = parser.parse_args()
-	createRunSimMatrix(args.ms1PeakFolder, args.baselineOutput, args.metadataFile,\
-					   args.edgeCountFile, args.output)
+	createRunSimMatrix(args.ms1PeakFolder, args.metadataFile,
+					   args.resultsStore, args.output,
+					   mdsMethod=args.mdsMethod, heatmapMode=args.heatmapMode)
@@ -0,0 +1,156 @@
+import numpy as np
+import sqlite3
+
+# SQLite store of the result of every pair of runs. The run similarity matrix
+# is built from it only. coopraize.log.txt and pairwise-edge.log.txt are
+# written for reference and never read back.
+#
+#   pairResults(edgeStem, leftRun, rightRun, score, numSelectedEdge, numEdges,
+#               numIterations, nRow, nnz, postNormVal)
+#
+# score, numSelectedEdge, numEdges and numIterations are NULL if the solver
+# failed.
+
+schema = """CREATE TABLE IF NOT EXISTS pairResults (
+	edgeStem TEXT PRIMARY KEY,
+	leftRun TEXT NOT NULL,
+	rightRun TEXT NOT NULL,
+	score REAL,
+	numSelectedEdge REAL,
+	numEdges REAL,
+	numIterations INTEGER,
+	nRow INTEGER,
+	nnz INTEGER,
+	postNormVal REAL)"""
+indexSchema = """CREATE INDEX IF NOT EXISTS pairResultsRuns
+	ON pairResults (leftRun, rightRun)"""
+rightIndexSchema = """CREATE INDEX IF NOT EXISTS pairResultsRightRun
+	ON pairResults (rightRun)"""
+
+scoreFileDelim = "___"
+# runs per query of loadPairResults (two parameters each, SQLite allows 999)
+maxQueryRuns = 400
+
+
+###############################################################################
+def openResultsStore(fileName):
+	"""
+	Open (and create if needed) a results store
+	Output: sqlite3 connection
+	"""
+	conn = sqlite3.connect(str(fileName))
+	conn.execute(schema)
+	conn.execute(indexSchema)
+	conn.execute(rightIndexSchema)
+	return(conn)
+
+
+def pairRow(edgeStem, nRow, nnz, postNormVal, solverResult):
+	"""
+	Row of the pairResults table for one pair
+	Input1: edge file stem (left___right___score)
+	Input2-4: outputs of pairwise_edge_matrix.createEdgeSimMatrix
+	Input5: solver.SolverResult. None if the solver failed
+	"""
+	edgeStem_sp = edgeStem.split(scoreFileDelim)
+	if solverResult is None:
+		solverValues = (None, None, None, None)
+	else:
+		solverValues = tuple(solverResult)
+	return((edgeStem, edgeStem_sp[0], edgeStem_sp[1]) + solverValues +
+		   (int(nRow), int(nnz), float(postNormVal)))
+
+
+def writePairResults(conn, rowList):
+	"""
+	Insert or replace pair results (see pairRow) in one transaction
+	"""
+	with conn:
+		conn.executemany("INSERT OR REPLACE INTO pairResults VALUES " +
+						 "(?,?,?,?,?,?,?,?,?,?)", rowList)
+
+
+def loadPairResults(conn, runNames=None):
+	"""
+	Every pair result (or only the pairs that include a run in runNames) as
+	columns. A pair of two runs in runNames can be listed twice.
+	Output: dict of numpy arrays (leftRun, rightRun, score, numEdges,
+			postNormVal). Missing solver values are nan.
+	"""
+	query = "SELECT leftRun, rightRun, score, numEdges, postNormVal " + \
+			"FROM pairResults"
+	if runNames is None:
+		rowList = conn.execute(query).fetchall()
+	else:
+		# runs are looked up in batches that stay under the SQLite limit on
+		# query parameters
+		runNames = list(runNames)
+		rowList = []
+		for i in range(0, len(runNames), maxQueryRuns):
+			batch = runNames[i:i+maxQueryRuns]
+			marks = ",".join("?" * len(batch))
+			rowList += conn.execute(query + " WHERE leftRun IN (" + marks +
+									") OR rightRun IN (" + marks + ")",
+									batch + batch).fetchall()
+	columns = list(zip(*rowList)) if rowList else [[]] * 5
+	return({"leftRun":np.array(columns[0], dtype=str),
+			"rightRun":np.array(columns[1], dtype=str),
+			"score":np.array(columns[2], dtype=np.float64),
+			"numEdges":np.array(columns[3], dtype=np.float64),
+			"postNormVal":np.array(columns[4], dtype=np.float64)})
+
+
+###############################################################################
+def runIndicies(ms1FileList, runNames):
+	"""
+	Index of each run name in ms1FileList. -1 for runs that are not in it.
+	"""
+	if len(ms1FileList) == 0:
+		return(np.full(len(runNames), -1, dtype=np.int64))
+	fileArray = np.array(ms1FileList, dtype=str)
+	order = np.argsort(fileArray, kind='stable')
+	sortedFiles = fileArray[order]
+	pos = np.minimum(np.searchsorted(sortedFiles, runNames),
+					 sortedFiles.size - 1)
+	found = sortedFiles[pos] == runNames
+	return(np.where(found, order[pos], -1).astype(np.int64))
+
+
+def assembleRunMatrix(ms1FileList, results, postNormalize=True):
+	"""
+	Run similarity matrix from pair results by a vectorized scatter
+
+	Parameters
+	----------
+	ms1FileList : list
+		Ordered run names (same run order as the matrix)
+	results : dict
+		Pair results (see loadPairResults)
+	postNormalize : bool
+		Multiply each score by its post normalization value (the last column
+		of pairwise-edge.log.txt)
+
+	Returns
+	-------
+	matrix : numpy array
+		Symmetric run similarity matrix. Pairs without a score are 0.
+	"""
+	numRuns = len(ms1FileList)
+	matrix = np.zeros((numRuns,numRuns))
+	scatterRunMatrix(matrix, ms1FileList, results, postNormalize)
+	return(matrix)
+
+
+def scatterRunMatrix(matrix, ms1FileList, results, postNormalize=True):
+	"""
+	Set the entries of the pairs in results in a run similarity matrix (see
+	assembleRunMatrix). Other entries are not changed.
+	"""
+	leftIndex = runIndicies(ms1FileList, results["leftRun"])
+	rightIndex = runIndicies(ms1FileList, results["rightRun"])
+	score = results["score"]
+	if postNormalize:
+		score = score * results["postNormVal"]
+	keep = (leftIndex >= 0) & (rightIndex >= 0) & ~np.isnan(score)
+	matrix[leftIndex[keep],rightIndex[keep]] = score[keep]
+	matrix[rightIndex[keep],leftIndex[keep]] = score[keep]
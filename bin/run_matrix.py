@@ -0,0 +1,87 @@
+import numpy as np
+import os
+from pathlib import Path
+from bin import results_store
+
+# Persistent run similarity matrix. The score and post normalization value of
+# every pair of runs are kept in the results store (see results_store), and
+# the post-normalized matrix assembled from it is kept here so new runs can be
+# added by filling in only their rows and columns.
+#
+#   names : run names (MS1 feature file name without _ms1Peak.txt). Row and
+#           column i of the matrix is run names[i]
+#   matrix : post-normalized run similarity matrix (see
+#            results_store.assembleRunMatrix)
+storeFileName = "run_matrix.npz"
+
+
+###############################################################################
+def emptyRunMatrix():
+	return({"names":[], "matrix":np.zeros((0,0))})
+
+
+def loadRunMatrix(fileName):
+	"""
+	Run matrix store of fileName. The matrix is None for stores that only
+	kept the run names (see updateRuns).
+	"""
+	if not Path(fileName).is_file():
+		return(emptyRunMatrix())
+	with np.load(fileName) as storeFile:
+		return({"names":[str(x) for x in storeFile["names"]],
+				"matrix":storeFile["matrix"] if "matrix" in storeFile.files
+						 else None})
+
+
+def saveRunMatrix(store, fileName):
+	tmpFileName = str(fileName) + ".tmp" + str(os.getpid()) + ".npz"
+	np.savez(tmpFileName, names=np.array(store["names"], dtype=str),
+			 matrix=store["matrix"])
+	os.replace(tmpFileName, fileName)
+
+
+###############################################################################
+def getRunIndex(store):
+	"""
+	Run name to row index
+	"""
+	return({name:i for i, name in enumerate(store["names"])})
+
+
+def buildRunMatrix(nameList, resultsFileName):
+	"""
+	Run matrix store of the runs in nameList assembled from every pair of the
+	results store
+	"""
+	conn = results_store.openResultsStore(resultsFileName)
+	results = results_store.loadPairResults(conn)
+	conn.close()
+	return({"names":list(nameList),
+			"matrix":results_store.assembleRunMatrix(nameList, results)})
+
+
+def updateRuns(store, nameList, resultsFileName):
+	"""
+	Add a row and column for each run in nameList that is not in the store yet
+	and fill in the rows and columns of the runs in nameList from the results
+	store. The entries of other pairs are kept, so only the pairs of the runs
+	in nameList are read. A store without a matrix is rebuilt from every pair.
+	"""
+	runIndex = getRunIndex(store)
+	newNames = [name for name in nameList if name not in runIndex]
+	if store["matrix"] is None:
+		store.update(buildRunMatrix(store["names"] + newNames,
+									resultsFileName))
+		return
+	store["names"] = store["names"] + newNames
+	store["matrix"] = np.pad(store["matrix"],
+							 ((0,len(newNames)),(0,len(newNames))))
+	conn = results_store.openResultsStore(resultsFileName)
+	results = results_store.loadPairResults(conn, nameList)
+	conn.close()
+	results_store.scatterRunMatrix(store["matrix"], store["names"], results)
+
+
+def writeScoreMatrix(store, output_folder):
+	np.savetxt(output_folder + "/output_score_matrix.txt", store["matrix"],
+			   delimiter='\t', fmt='%f')
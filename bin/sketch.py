@@ -0,0 +1,282 @@
+import numpy as np
+import os
+from pathlib import Path
+from bin import artifact_cache
+from bin import create_edge
+from bin import feature_store
+from bin import run_matrix
+
+# MinHash sketch of the MS1 features of a run. Each feature is turned into a
+# token (charge, m/z bin, pTIC bin) and the sketch keeps the minimum hash of
+# the tokens of the run under numHashes hash functions. The fraction of equal
+# entries in the sketches of two runs estimates the Jaccard similarity of their
+# token sets, which stands in for the number of edges MS1Connect would create
+# between them. Sketches are kept in an index next to the run matrix store
+# (see run_matrix) so the library runs most similar to a new run can be found
+# without scoring every pair.
+#
+# Features near the edge of a bin would miss their match in the neighbouring
+# bin, so every feature is binned on two grids (the second shifted by half a
+# bin in m/z and pTIC) and emits a token for each.
+#
+# Index layout (npz)
+#   names : run names (same as run_matrix)
+#   digest : sha256 of the MS1 feature file each sketch was built from
+#   signature : uint64 matrix. Row i is the sketch of run names[i]
+#   numTokens : number of tokens of each run
+#   params : mzBinPpm, pticBinWidth, numHashes, seed
+indexFileName = "sketch_index.npz"
+
+mzBinPpm = 10.0
+pticBinWidth = 0.1
+numHashes = 256
+seed = 0
+
+numGrids = 2
+emptyHash = np.iinfo(np.uint64).max
+
+
+###############################################################################
+def splitMix64(x):
+	"""
+	splitmix64 finalizer. Mixes uint64 values (wraps on overflow)
+	"""
+	x = x + np.uint64(0x9E3779B97F4A7C15)
+	x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+	x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+	return(x ^ (x >> np.uint64(31)))
+
+
+def hashSeeds(numHashes, seed):
+	"""
+	One seed per hash function
+	"""
+	return(splitMix64(np.arange(numHashes, dtype=np.uint64) +
+					  np.uint64(seed) * np.uint64(numHashes)))
+
+
+def featureTokens(features, mzBinPpm, pticBinWidth):
+	"""
+	Token of each MS1 feature on each grid
+
+	Parameters
+	----------
+	features : numpy array
+		MS1 features (columns of the MS1 feature text file)
+	mzBinPpm : float
+		Width of an m/z bin in ppm. Bins are equal width in log m/z.
+	pticBinWidth : float
+		Width of a pTIC bin
+
+	Returns
+	-------
+	tokens : numpy array
+		Unique uint64 tokens of the run
+	"""
+	features = np.asarray(features, dtype=np.float64).reshape(-1,
+		feature_store.numCols)
+	logMz = np.log(np.maximum(features[:,create_edge.mzCol], 1e-12)) / \
+			np.log1p(mzBinPpm * 1e-6)
+	ptic = features[:,create_edge.pticCol] / pticBinWidth
+	charge = features[:,create_edge.chargeCol].astype(np.int64) & 0xff
+
+	tokenList = []
+	for grid in range(numGrids):
+		shift = grid / numGrids
+		mzBin = np.floor(logMz + shift).astype(np.int64)
+		pticBin = np.floor(ptic + shift).astype(np.int64) & 0xffff
+		key = (((mzBin << 16) | pticBin) << 8 | charge) * numGrids + grid
+		tokenList.append(key.astype(np.uint64))
+	return(np.unique(np.concatenate(tokenList)))
+
+
+def minHash(tokens, seeds):
+	"""
+	MinHash signature of a set of tokens. Entry i is the minimum over the
+	tokens of hash function i (emptyHash if there are no tokens)
+	"""
+	if tokens.size == 0:
+		return(np.full(seeds.size, emptyHash, dtype=np.uint64))
+	return(splitMix64(tokens[:,None] ^ seeds[None,:]).min(axis=0))
+
+
+def sketchFeatures(features, params):
+	"""
+	Output1: MinHash signature of a run
+	Output2: number of tokens
+	"""
+	tokens = featureTokens(features, params["mzBinPpm"],
+						   params["pticBinWidth"])
+	seeds = hashSeeds(params["numHashes"], params["seed"])
+	return(minHash(tokens, seeds), tokens.size)
+
+
+def sketchFile(fileName, params):
+	"""
+	Sketch of a MS1 feature file (see sketchFeatures)
+	"""
+	features = feature_store.featureMatrix(feature_store.loadFeatures(fileName))
+	return(sketchFeatures(features, params))
+
+
+###############################################################################
+def defaultParams():
+	return({"mzBinPpm":mzBinPpm, "pticBinWidth":pticBinWidth,
+			"numHashes":numHashes, "seed":seed})
+
+
+def emptyIndex(params=None):
+	if params is None:
+		params = defaultParams()
+	return({"names":[], "digest":[],
+			"signature":np.zeros((0,params["numHashes"]), dtype=np.uint64),
+			"numTokens":np.zeros(0, dtype=np.int64), "params":dict(params)})
+
+
+def loadIndex(fileName):
+	if not Path(fileName).is_file():
+		return(emptyIndex())
+	with np.load(fileName) as indexFile:
+		params = {"mzBinPpm":float(indexFile["mzBinPpm"]),
+				  "pticBinWidth":float(indexFile["pticBinWidth"]),
+				  "numHashes":int(indexFile["numHashes"]),
+				  "seed":int(indexFile["seed"])}
+		return({"names":[str(x) for x in indexFile["names"]],
+				"digest":[str(x) for x in indexFile["digest"]],
+				"signature":indexFile["signature"],
+				"numTokens":indexFile["numTokens"], "params":params})
+
+
+def saveIndex(index, fileName):
+	tmpFileName = str(fileName) + ".tmp" + str(os.getpid()) + ".npz"
+	np.savez(tmpFileName, names=np.array(index["names"], dtype=str),
+			 digest=np.array(index["digest"], dtype=str),
+			 signature=index["signature"], numTokens=index["numTokens"],
+			 **index["params"])
+	os.replace(tmpFileName, fileName)
+
+
+def updateIndex(index, ms1FileList, manifest):
+	"""
+	Sketch every MS1 feature file that is not in the index or has changed
+	since it was sketched
+
+	Parameters
+	----------
+	index : dict
+		Sketch index. Updated in place.
+	ms1FileList : list
+		MS1 feature files (_ms1Peak.txt)
+	manifest : dict
+		Artifact manifest used to memoize file digests (see artifact_cache)
+
+	Returns
+	-------
+	Number of runs sketched
+	"""
+	runIndex = {name:i for i, name in enumerate(index["names"])}
+	numSketched = 0
+	for fileName in ms1FileList:
+		name = create_edge.cleanFileName(fileName)
+		digest = artifact_cache.fileDigest(fileName, manifest)
+		if name in runIndex and index["digest"][runIndex[name]] == digest:
+			continue
+		signature, numTokens = sketchFile(fileName, index["params"])
+		if name in runIndex:
+			i = runIndex[name]
+			index["digest"][i] = digest
+			index["signature"][i] = signature
+			index["numTokens"][i] = numTokens
+		else:
+			runIndex[name] = len(index["names"])
+			index["names"].append(name)
+			index["digest"].append(digest)
+			index["signature"] = np.vstack((index["signature"], signature))
+			index["numTokens"] = np.append(index["numTokens"], numTokens)
+		numSketched += 1
+	return(numSketched)
+
+
+###############################################################################
+def similarity(index, signature):
+	"""
+	Estimated Jaccard similarity of signature to every run in the index
+	"""
+	if len(index["names"]) == 0:
+		return(np.zeros(0))
+	return(np.count_nonzero(index["signature"] == signature[None,:], axis=1) /
+		   signature.size)
+
+
+def topCandidates(scores, top_k, exclude=()):
+	"""
+	Indicies of the top_k highest scores, highest first. Ties are broken by
+	index so the order is reproducible.
+	"""
+	scores = np.asarray(scores, dtype=np.float64).copy()
+	scores[list(exclude)] = -np.inf
+	top_k = min(top_k, scores.size - len(exclude))
+	if top_k <= 0:
+		return(np.zeros(0, dtype=np.int64))
+	candidate = np.argpartition(-scores, top_k - 1)[0:top_k]
+	# every index tied with the k-th score is considered before breaking ties
+	candidate = np.flatnonzero(scores >= scores[candidate].min())
+	order = np.lexsort((candidate, -scores[candidate]))
+	return(candidate[order][0:top_k])
+
+
+def query(index, signature, top_k, exclude=()):
+	"""
+	Library runs most similar to a run
+
+	Parameters
+	----------
+	index : dict
+		Sketch index
+	signature : numpy array
+		Sketch of the query run (see sketchFeatures)
+	top_k : int
+		Number of candidates
+	exclude : list
+		Run names that are not candidates (for example the query itself)
+
+	Returns
+	-------
+	List of (run name, estimated Jaccard similarity), most similar first
+	"""
+	scores = similarity(index, signature)
+	runIndex = {name:i for i, name in enumerate(index["names"])}
+	excludeIndex = [runIndex[name] for name in exclude if name in runIndex]
+	return([(index["names"][i], float(scores[i]))
+			for i in topCandidates(scores, top_k, excludeIndex)])
+
+
+###############################################################################
+def measureRecall(index, store, top_k):
+	"""
+	Recall of the sketch prefilter against exhaustive scoring. Every run in
+	both the index and the run matrix store (see run_matrix) is used as a
+	query against the other runs. Recall of a query is the fraction of its
+	top_k runs by MS1Connect score that are among its top_k sketch candidates.
+
+	Returns
+	-------
+	List of (run name, recall)
+	"""
+	runMatrix = store["matrix"]
+	storeIndex = run_matrix.getRunIndex(store)
+	names = [name for name in index["names"] if name in storeIndex]
+	sketchIndex = {name:i for i, name in enumerate(index["names"])}
+	rows = np.array([storeIndex[name] for name in names], dtype=np.int64)
+
+	recallList = []
+	for i, name in enumerate(names):
+		exactTop = topCandidates(runMatrix[rows[i],rows], top_k, [i])
+		scores = similarity(index, index["signature"][sketchIndex[name]])
+		sketchTop = topCandidates(scores[[sketchIndex[x] for x in names]],
+								  top_k, [i])
+		if exactTop.size == 0:
+			continue
+		recallList.append((name, np.intersect1d(exactTop, sketchTop).size /
+						   exactTop.size))
+	return(recallList)
@@ -0,0 +1,305 @@
+import collections
+import heapq
+import json
+import numpy as np
+import os
+import scipy.sparse
+import shlex
+import subprocess
+from pathlib import Path
+from bin import edge_to_json_matroid
+from bin import pairwise_edge_matrix
+
+binFolder = str(Path(__file__).resolve().parent)
+coopraizContainer = binFolder + "/coopraiz-singularity"
+
+# folders the coopraiz container sees the ___pairwise.npz and matroid files
+# at (see containerBinds)
+pairwiseMount = "/pairwise/"
+matroidMount = "/matroid/"
+
+# Result of maximizing the edge similarity objective over the intersection of
+# the two partition matroids (see edge_to_json_matroid.makeJson)
+#   score : objective value of the selected edges
+#   numSelectedEdge : number of selected edges
+#   numEdges : number of edges (rows of the edge similarity matrix)
+#   numIterations : number of candidate edges examined by the solver. None if
+#                   the solver does not report it
+SolverResult = collections.namedtuple("SolverResult",
+	["score", "numSelectedEdge", "numEdges", "numIterations"])
+
+
+###############################################################################
+def readMatroidJson(fileName, numEdges):
+	"""
+	Read a matroid file written by edge_to_json_matroid.createJsonMatroid
+
+	Parameters
+	----------
+	fileName : str, path
+		Matroid file
+	numEdges : int
+		Number of edges in the ground set
+
+	Returns
+	-------
+	blockLabelList : list
+		One numpy array per partition matroid. Entry e is the block edge e
+		belongs to (-1 if edge e is in no block).
+	limitList : list
+		One numpy array per partition matroid. Entry b is the limit of block b.
+	"""
+	with open(fileName, 'r') as file1:
+		json_object = json.load(file1)
+
+	blockLabelList = []
+	limitList = []
+	for matroid in json_object["intersection-of-matroids"]["partition-matroids"]:
+		blocks = matroid["partition-matroid"]["blocks"]
+		blockLabel = np.full(numEdges, -1, dtype=np.int64)
+		limit = np.zeros(len(blocks), dtype=np.int64)
+		for blockIndex, block in enumerate(blocks):
+			blockLabel[np.asarray(block["block"], dtype=np.int64)] = blockIndex
+			limit[blockIndex] = block["limit"]
+		blockLabelList.append(blockLabel)
+		limitList.append(limit)
+	return(blockLabelList, limitList)
+
+
+def blockLabelsFromMatroid(matroid, numEdges):
+	"""
+	Convert CSR-style matroid blocks (see edge_to_json_matroid.buildMatroid)
+	to the blockLabelList and limitList used by greedyMaximize
+	"""
+	blockLabelList = []
+	limitList = []
+	for side in ["left", "right"]:
+		offsets, edgeIds = matroid[side]
+		numBlocks = offsets.size - 1
+		blockLabel = np.full(numEdges, -1, dtype=np.int64)
+		blockLabel[edgeIds] = np.repeat(np.arange(numBlocks), np.diff(offsets))
+		blockLabelList.append(blockLabel)
+		limitList.append(np.full(numBlocks, matroid["limit"], dtype=np.int64))
+	return(blockLabelList, limitList)
+
+
+###############################################################################
+def greedyMaximize(sparseMat, blockLabelList, limitList):
+	"""
+	Greedy maximization of f(A) = sum of sparseMat[i,j] over all i,j in A
+	subject to the intersection of partition matroids. The diagonal holds the
+	score of each edge and the off-diagonal entries the similarity between two
+	edges, so the gain of adding edge e is sparseMat[e,e] plus twice the
+	similarity of e to the edges already selected.
+
+	Gains of the remaining edges only change when a neighbour (non-zero entry
+	of the selected row) is selected, so gains are kept in a heap and only the
+	neighbours of each selected edge are updated. Stale heap entries are
+	skipped when popped.
+
+	Parameters
+	----------
+	sparseMat : scipy.sparse matrix
+		Symmetric edge similarity matrix (see pairwise_edge_matrix)
+	blockLabelList : list
+		Block of each edge for every partition matroid (see readMatroidJson)
+	limitList : list
+		Limit of each block for every partition matroid
+
+	Returns
+	-------
+	result : SolverResult
+	selected : numpy array
+		Indicies of the selected edges in the order they were selected
+	"""
+	sparseMat = scipy.sparse.csr_matrix(sparseMat)
+	numEdges = sparseMat.shape[0]
+	indptr = sparseMat.indptr
+	indices = sparseMat.indices
+	data = sparseMat.data.astype(np.float64)
+
+	gain = sparseMat.diagonal().astype(np.float64)
+	blockCountList = [np.zeros(limit.size, dtype=np.int64) for limit in limitList]
+	isSelected = np.zeros(numEdges, dtype=bool)
+
+	heap = [(-gain[e], e) for e in range(numEdges)]
+	heapq.heapify(heap)
+
+	score = 0.0
+	selected = []
+	numIterations = 0
+	while heap:
+		negGain, e = heapq.heappop(heap)
+		numIterations += 1
+		if isSelected[e] or -negGain != gain[e]:
+			continue # stale entry
+		if gain[e] <= 0:
+			break
+
+		# edges that violate a matroid stay infeasible since block counts only
+		# increase
+		feasible = True
+		for blockLabel, blockCount, limit in \
+			zip(blockLabelList, blockCountList, limitList):
+			block = blockLabel[e]
+			if block >= 0 and blockCount[block] >= limit[block]:
+				feasible = False
+				break
+		if not feasible:
+			continue
+
+		isSelected[e] = True
+		selected.append(e)
+		score += gain[e]
+		for blockLabel, blockCount in zip(blockLabelList, blockCountList):
+			if blockLabel[e] >= 0:
+				blockCount[blockLabel[e]] += 1
+
+		for k in range(indptr[e], indptr[e+1]):
+			neighbour = indices[k]
+			if neighbour == e or isSelected[neighbour]:
+				continue
+			gain[neighbour] += 2 * data[k]
+			heapq.heappush(heap, (-gain[neighbour], neighbour))
+
+	result = SolverResult(float(score), len(selected), numEdges, numIterations)
+	return(result, np.array(selected, dtype=np.int64))
+
+
+###############################################################################
+def solveGreedy(npzFile, matroidFile, matroid=None):
+	"""
+	Native solver backend. Reads the ___pairwise.npz edge similarity matrix and
+	matroid of a pair of runs and maximizes the objective with greedyMaximize.
+	The matroid is taken from matroid (see edge_to_json_matroid.buildMatroid)
+	if given, otherwise from matroidFile (___matroid.json or the
+	___matroid.npz sidecar). The matrix is memory-mapped (see
+	pairwise_edge_matrix.openEdgeSimMatrix).
+
+	Returns
+	-------
+	result : SolverResult
+	"""
+	sparseMat = pairwise_edge_matrix.openEdgeSimMatrix(npzFile)
+	numEdges = sparseMat.shape[0]
+	if matroid is None and str(matroidFile).endswith(".npz"):
+		matroid = edge_to_json_matroid.loadMatroidBinary(matroidFile)
+	if matroid is None:
+		blockLabelList, limitList = readMatroidJson(matroidFile, numEdges)
+	else:
+		blockLabelList, limitList = blockLabelsFromMatroid(matroid, numEdges)
+	result, selected = greedyMaximize(sparseMat, blockLabelList, limitList)
+	return(result)
+
+
+###############################################################################
+def containerBinds(pairwiseFolder, matroidFolder):
+	"""
+	singularity --bind options that make the folders of the ___pairwise.npz
+	and matroid files visible in the coopraiz container (see containerPath).
+	The folders are bound by absolute path so the files can be anywhere,
+	whatever the working directory is.
+	"""
+	return(["--bind", os.path.abspath(pairwiseFolder) + ":" + pairwiseMount,
+			"--bind", os.path.abspath(matroidFolder) + ":" + matroidMount])
+
+
+def containerPath(fileName, mount):
+	"""
+	Path of a file in the coopraiz container when its folder is bound at
+	mount (see containerBinds)
+	"""
+	return(mount + os.path.basename(str(fileName)))
+
+
+def coopraizCommand(npzFile, matroidFile):
+	"""
+	Build the shell command that runs the coopraiz solver on one pair
+	"""
+	# log file can be directly generated from coopraize using the below
+	# -flogfilename /output/coopraiz_log.txt
+	cmd = "singularity exec " + \
+	" ".join(shlex.quote(x) for x in containerBinds(os.path.dirname(npzFile),
+		os.path.dirname(matroidFile))) + \
+	" --bind ./:/output/ " + shlex.quote(coopraizContainer) + " " +\
+	"/submarine/build/opic-coopraiz -spssdfilename " +\
+	shlex.quote(containerPath(npzFile, pairwiseMount)) + " -imjson " +\
+	shlex.quote(containerPath(matroidFile, matroidMount)) +\
+	" -cloglevel info " +\
+	"-ctrl-logsolution -flogtruncate false"
+	return(cmd)
+
+
+def parseCoopraizOutput(output):
+	"""
+	Get the result from the standard output of coopraiz
+	Output: SolverResult. None if coopraiz did not report a solution
+	"""
+	numEdges = None
+	for line1 in output.splitlines():
+		if line1.startswith("Loaded raw SPSSD "):
+			token = line1.split(' ')[3]
+			numEdges = float(token.split("x")[0])
+		elif line1.startswith("Summary valuation:"):
+			# to get # selected edges
+			token = line1.split(',')[0]
+			numSelectedEdge = float(token.split('=')[1])
+
+			# to get score
+			line1_sp = line1.split("=")
+			score = float(line1_sp[len(line1_sp) - 1].strip())
+			return(SolverResult(score, numSelectedEdge, numEdges, None))
+	return(None)
+
+
+def solveCoopraiz(npzFile, matroidFile, matroid=None):
+	"""
+	coopraiz solver backend. Runs the coopraiz singularity container on the
+	___matroid.json matroidFile (matroid is not used).
+
+	Returns
+	-------
+	result : SolverResult
+		None if coopraiz did not report a solution
+	output : str
+		Standard output of coopraiz. If coopraiz failed (the container is
+		missing or expired, singularity is not installed or coopraiz exited
+		with an error) a "Solver failed:" line with the reason is added (see
+		solver_driver.outcomeResult)
+	"""
+	if not Path(coopraizContainer).exists():
+		return(None, "Solver failed: coopraiz container " + coopraizContainer +
+			   " does not exist\n")
+	cmd = coopraizCommand(npzFile, matroidFile)
+	completed = subprocess.run(cmd, shell=True, capture_output=True)
+	output = completed.stdout.decode(errors="replace")
+	result = parseCoopraizOutput(output)
+	if completed.returncode == 0 and result is not None:
+		return(result, output)
+
+	if output and not output.endswith("\n"):
+		output += "\n"
+	stderr = " ".join(completed.stderr.decode(errors="replace").split())
+	if completed.returncode != 0:
+		output += "Solver failed: coopraiz container exited with code " + \
+				  str(completed.returncode) + " (check that singularity is " + \
+				  "installed and " + coopraizContainer + " has not " + \
+				  "expired): " + stderr + "\n"
+	else:
+		output += "Solver failed: coopraiz did not report a solution: " + \
+				  stderr + "\n"
+	return(None, output)
+
+
+def solveNative(npzFile, matroidFile, matroid=None):
+	"""
+	Native solver backend (see solveGreedy). Same interface as solveCoopraiz.
+	The native backend has no standard output.
+	"""
+	return(solveGreedy(npzFile, matroidFile, matroid), "")
+
+
+# solver backends. Each takes the edge similarity matrix file, the matroid
+# file and optionally the in-memory matroid of a pair and returns
+# (SolverResult, standard output). Batch solvers are in solver_driver.
+solverBackends = {"coopraiz": solveCoopraiz, "greedy": solveNative}
@@ -0,0 +1,307 @@
+import asyncio
+import atexit
+import collections
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from bin import solver
+
+LOGGER = logging.getLogger(__name__)
+
+# Batch solver driver. Instead of one singularity exec per pair, a driver
+# starts one long-lived solver process (see solver_server) and sends it every
+# problem of the process it runs in. Problems are submitted from any thread
+# and run concurrently on an asyncio event loop in a background thread. Each
+# problem gets a timeout and is retried if it times out or the solver
+# process dies (the process is restarted).
+#
+# Batch solvers (config["solver"]) and the solver_server backend they run
+#   coopraiz-batch : coopraiz in one container started once per driver
+#   greedy-batch : local stand-in that writes coopraiz output (for tests)
+batchSolvers = {"coopraiz-batch":"coopraiz", "greedy-batch":"greedy"}
+
+solverTimeout = 3600.0
+solverRetries = 1
+
+# folder the coopraiz container sees this folder (for solver_server.py) at.
+# The folders of the problem files are bound at solver.pairwiseMount and
+# solver.matroidMount
+serverFolder = "/ms1connect/"
+
+# Outcome of one problem
+#   status : "ok", "no_solution" (the solver finished without a solution),
+#            "timeout" (every attempt timed out) or "error" (the solver or the
+#            solver process failed)
+#   result : solver.SolverResult. None unless status is "ok"
+#   output : standard output of the solver (of the last attempt)
+#   attempts : number of attempts
+#   seconds : wall time over every attempt
+#   message : reason of the failure
+SolveOutcome = collections.namedtuple("SolveOutcome",
+	["status", "result", "output", "attempts", "seconds", "message"])
+
+# drivers of this process (see getDriver)
+_drivers = {}
+
+
+###############################################################################
+def serverCommand(backend, concurrency, delay=0.0, folders=None):
+	"""
+	Command that starts a solver_server process. folders is the (pairwise
+	folder, matroid folder) of the problems of a coopraiz process.
+	"""
+	if backend == "coopraiz":
+		return(["singularity", "exec"] +
+			   solver.containerBinds(*folders) +
+			   ["--bind", "./:/output/", "--bind",
+				solver.binFolder + ":" + serverFolder,
+				solver.coopraizContainer, "python3",
+				serverFolder + "solver_server.py", "--backend", "coopraiz",
+				"--concurrency", str(concurrency)])
+	return([sys.executable, solver.binFolder + "/solver_server.py",
+			"--backend", backend, "--concurrency", str(concurrency),
+			"--delay", str(delay)])
+
+
+def problemPaths(backend, npzFile, matroidFile, folders=None):
+	"""
+	Paths of the files of a problem as seen by the solver process. The files
+	of a coopraiz problem must be in the folders the process was started with
+	(see serverCommand).
+	"""
+	if backend == "coopraiz":
+		for fileName, folder in zip([npzFile, matroidFile], folders):
+			if os.path.dirname(os.path.abspath(fileName)) != \
+			   os.path.abspath(folder):
+				raise Exception(str(fileName) + " is not in " + str(folder) +
+								", the folder bound in the solver container")
+		return(solver.containerPath(npzFile, solver.pairwiseMount),
+			   solver.containerPath(matroidFile, solver.matroidMount))
+	return(os.path.abspath(npzFile), os.path.abspath(matroidFile))
+
+
+def outcomeResult(outcome):
+	"""
+	Output1: solver.SolverResult of an outcome. None if it failed
+	Output2: standard output of the solver. A failed outcome gets a
+			 "Solver failed:" line so it shows in coopraize.log.txt
+	"""
+	output = outcome.output
+	if outcome.status != "ok":
+		if output and not output.endswith("\n"):
+			output += "\n"
+		output += "Solver failed: " + outcome.status + " after " + \
+				  str(outcome.attempts) + " attempts: " + \
+				  " ".join(outcome.message.split()) + "\n"
+	return(outcome.result, output)
+
+
+###############################################################################
+class SolverDriver():
+	"""
+	Sends problems to a long-lived solver process
+
+	Parameters
+	----------
+	backend : str
+		solver_server backend ("coopraiz" or "greedy")
+	concurrency : int
+		Problems solved at the same time
+	timeout : float
+		Seconds before an attempt at a problem is given up
+	retries : int
+		Attempts after the first for problems that time out or fail
+	command : list
+		Command of the solver process. Default=serverCommand
+	folders : tuple
+		(pairwise folder, matroid folder) the problem files of a coopraiz
+		solver process are in
+	"""
+	def __init__(self, backend, concurrency=1, timeout=solverTimeout,
+				 retries=solverRetries, command=None, folders=None):
+		self.backend = backend
+		self.concurrency = max(1, concurrency)
+		self.timeout = timeout
+		self.retries = retries
+		self.folders = folders
+		self.command = command
+		if self.command is None:
+			self.command = serverCommand(backend, self.concurrency,
+										 folders=folders)
+		self.process = None
+		self.pending = {}
+		self.problemIds = itertools.count()
+		self.loop = asyncio.new_event_loop()
+		self.thread = threading.Thread(target=self.loop.run_forever,
+									   daemon=True)
+		self.thread.start()
+		asyncio.run_coroutine_threadsafe(self._init(), self.loop).result()
+
+	async def _init(self):
+		self.semaphore = asyncio.Semaphore(self.concurrency)
+		self.startLock = asyncio.Lock()
+
+	async def _startProcess(self):
+		async with self.startLock:
+			if self.process is None or self.process.returncode is not None:
+				if self.process is not None:
+					LOGGER.warning("Solver process exited with code %s. "
+								   "Restarting", self.process.returncode)
+				# a coopraiz log can be longer than the default line limit
+				self.process = await asyncio.create_subprocess_exec(
+					*self.command, stdin=asyncio.subprocess.PIPE,
+					stdout=asyncio.subprocess.PIPE, limit=2**30)
+				self.loop.create_task(self._readResponses(self.process))
+			return(self.process)
+
+	async def _readResponses(self, process):
+		"""
+		Hand each response of process to the problem waiting for it. Problems
+		still waiting when process exits fail.
+		"""
+		while True:
+			line = await process.stdout.readline()
+			if not line:
+				break
+			response = json.loads(line)
+			if response["id"] in self.pending:
+				future = self.pending.pop(response["id"])[1]
+				if not future.done():
+					future.set_result(response)
+		returncode = await process.wait()
+		for problemId, (owner, future) in list(self.pending.items()):
+			if owner is process:
+				del self.pending[problemId]
+				if not future.done():
+					future.set_exception(Exception(
+						"Solver process exited with code " + str(returncode)))
+
+	async def _send(self, process, request):
+		process.stdin.write((json.dumps(request) + "\n").encode())
+		await process.stdin.drain()
+
+	async def _attempt(self, npzFile, matroidFile):
+		"""
+		One attempt at a problem
+		Output: response of the solver process
+		"""
+		process = await self._startProcess()
+		problemId = next(self.problemIds)
+		future = self.loop.create_future()
+		self.pending[problemId] = (process, future)
+		npzPath, matroidPath = problemPaths(self.backend, npzFile, matroidFile,
+											self.folders)
+		try:
+			await self._send(process, {"id":problemId, "npz":npzPath,
+									   "matroid":matroidPath})
+			return(await asyncio.wait_for(future, self.timeout))
+		except asyncio.TimeoutError:
+			try:
+				await self._send(process, {"cancel":problemId})
+			except (ConnectionError, RuntimeError):
+				pass
+			raise
+		finally:
+			self.pending.pop(problemId, None)
+
+	async def solveAsync(self, npzFile, matroidFile):
+		"""
+		Solve one problem. Runs on the event loop of the driver.
+		Output: SolveOutcome
+		"""
+		async with self.semaphore:
+			start = time.perf_counter()
+			output = ""
+			for attempt in range(1, self.retries + 2):
+				try:
+					response = await self._attempt(npzFile, matroidFile)
+				except asyncio.TimeoutError:
+					status = "timeout"
+					message = "no result after " + str(self.timeout) + " s"
+					continue
+				except Exception as e:
+					status = "error"
+					message = str(e)
+					continue
+				output = response["output"]
+				result = solver.parseCoopraizOutput(output)
+				if result is not None:
+					return(SolveOutcome("ok", result, output, attempt,
+										time.perf_counter() - start, ""))
+				if response["returncode"] == 0:
+					# coopraiz is deterministic, so this is not retried
+					return(SolveOutcome("no_solution", None, output, attempt,
+										time.perf_counter() - start,
+										response["error"][-1000:]))
+				status = "error"
+				message = "return code " + str(response["returncode"]) + \
+						  ": " + response["error"][-1000:]
+			LOGGER.warning("Solver %s on %s: %s", status, npzFile, message)
+			return(SolveOutcome(status, None, output, attempt,
+								time.perf_counter() - start, message))
+
+	def submit(self, npzFile, matroidFile):
+		"""
+		Solve one problem from any thread
+		Output: concurrent.futures.Future of the SolveOutcome
+		"""
+		return(asyncio.run_coroutine_threadsafe(
+			self.solveAsync(npzFile, matroidFile), self.loop))
+
+	def solve(self, npzFile, matroidFile):
+		return(self.submit(npzFile, matroidFile).result())
+
+	async def _close(self):
+		if self.process is not None and self.process.returncode is None:
+			self.process.stdin.close()
+			try:
+				await asyncio.wait_for(self.process.wait(), 10)
+			except asyncio.TimeoutError:
+				self.process.kill()
+				await self.process.wait()
+
+	def close(self):
+		"""
+		Stop the solver process and the event loop
+		"""
+		if self.loop.is_closed():
+			return
+		try:
+			asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+		finally:
+			self.loop.call_soon_threadsafe(self.loop.stop)
+			self.thread.join()
+			self.loop.close()
+
+
+###############################################################################
+def getDriver(config):
+	"""
+	Driver of this process for the batch solver of config. The driver (and
+	its solver process) is started on first use and reused by every later
+	pair, so each worker process starts one solver process.
+	"""
+	folders = (os.path.abspath(config["edge_sim_folder"]),
+			   os.path.abspath(config["matroid_folder"]))
+	key = (os.getpid(), config["solver"], config["solver_concurrency"],
+		   config["solver_timeout"], config["solver_retries"], folders)
+	if key not in _drivers:
+		_drivers[key] = SolverDriver(batchSolvers[config["solver"]],
+									 config["solver_concurrency"],
+									 config["solver_timeout"],
+									 config["solver_retries"],
+									 folders=folders)
+	return(_drivers[key])
+
+
+@atexit.register
+def closeDrivers():
+	for key in list(_drivers):
+		driver = _drivers.pop(key)
+		# drivers of a parent process are copies in a forked worker
+		if key[0] == os.getpid():
+			driver.close()
@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Long-lived solver process (see solver_driver). Reads one JSON request per
+# line on standard input and writes one JSON response per line on standard
+# output as problems finish, so many problems share one process (and one
+# container start for coopraiz).
+#
+#   request : {"id", "npz": ___pairwise.npz file, "matroid": ___matroid file}
+#             or {"cancel": id} to stop a problem that timed out
+#   response : {"id", "returncode", "output": standard output of the solver,
+#               "error": standard error or exception}
+#
+# Backends
+#   coopraiz : runs opic-coopraiz on each problem. Meant to run inside the
+#              coopraiz container, so only the standard library is used.
+#   greedy : local stand-in that runs solver.solveGreedy and writes the same
+#            lines coopraiz writes. Used for tests and machines without
+#            singularity.
+#
+# Each problem runs in its own child process (opic-coopraiz, or this script
+# with --problem for greedy). A cancelled problem is killed, or never started
+# if it is still queued, and gets no response.
+
+coopraizBinary = "/submarine/build/opic-coopraiz"
+
+
+###############################################################################
+def problemCommand(backend, npzFile, matroidFile, delay):
+	"""
+	Command of the child process that solves one problem
+	"""
+	if backend == "coopraiz":
+		return([coopraizBinary, "-spssdfilename", npzFile, "-imjson",
+				matroidFile, "-cloglevel", "info", "-ctrl-logsolution",
+				"-flogtruncate", "false"])
+	return([sys.executable, os.path.abspath(__file__), "--backend", "greedy",
+			"--delay", str(delay), "--problem", npzFile, matroidFile])
+
+
+def runProblem(command, problemId, processes, cancelled, processLock):
+	"""
+	Run the child process of one problem. It is registered in processes so a
+	cancel request can kill it.
+	Output: return code, standard output, standard error. None if the problem
+			was cancelled before it started
+	"""
+	with processLock:
+		if problemId in cancelled:
+			return(None)
+		process = subprocess.Popen(command, stdout=subprocess.PIPE,
+								   stderr=subprocess.PIPE)
+		processes[problemId] = process
+	try:
+		output, error = process.communicate()
+	finally:
+		with processLock:
+			processes.pop(problemId, None)
+	return(process.returncode, output.decode(errors="replace"),
+		   error.decode(errors="replace"))
+
+
+def runGreedy(npzFile, matroidFile, delay):
+	"""
+	Run the native greedy solver on one problem and format the result like
+	the standard output of coopraiz (see solver.parseCoopraizOutput)
+	Output: standard output
+	"""
+	from bin import solver
+	if delay > 0:
+		time.sleep(delay)
+	result = solver.solveGreedy(npzFile, matroidFile)
+	output = "Loaded raw SPSSD " + str(result.numEdges) + "x" + \
+			 str(result.numEdges) + " matrix\n" + \
+			 "Summary valuation: selected=" + str(result.numSelectedEdge) + \
+			 ", iterations=" + str(result.numIterations) + ", value=" + \
+			 repr(result.score) + "\n"
+	return(output)
+
+
+def serve(backend, concurrency, delay=0.0):
+	"""
+	Answer requests on standard input until it is closed
+	"""
+	writeLock = threading.Lock()
+	processLock = threading.Lock()
+	processes = {}
+	cancelled = set()
+
+	def respond(request):
+		try:
+			response = runProblem(problemCommand(backend, request["npz"],
+												 request["matroid"], delay),
+								  request["id"], processes, cancelled,
+								  processLock)
+		except Exception as e:
+			response = (-1, "", repr(e))
+		with processLock:
+			if request["id"] in cancelled:
+				cancelled.discard(request["id"])
+				return
+		returncode, output, error = response
+		with writeLock:
+			sys.stdout.write(json.dumps({"id":request["id"],
+										 "returncode":returncode,
+										 "output":output, "error":error}) +
+							 "\n")
+			sys.stdout.flush()
+
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		for line in sys.stdin:
+			if not line.strip():
+				continue
+			request = json.loads(line)
+			if "cancel" in request:
+				with processLock:
+					cancelled.add(request["cancel"])
+					process = processes.get(request["cancel"])
+					if process is not None:
+						process.kill()
+				continue
+			executor.submit(respond, request)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Long-lived solver process \
+that solves the problems sent on standard input (see solver_driver).")
+	parser.add_argument("--backend", help="Solver. Default=coopraiz",
+						default="coopraiz", choices=["coopraiz","greedy"])
+	parser.add_argument("--concurrency", help='Problems solved at the same\
+	time. Default=1', type=int, default=1)
+	parser.add_argument("--delay", help='Seconds the greedy stand-in waits\
+	before each problem. Default=0', type=float, default=0.0)
+	parser.add_argument("--problem", help='Solve one problem with the greedy\
+	stand-in, write its output and exit (the child process of each greedy\
+	problem)', nargs=2, metavar=("NPZ", "MATROID"))
+	args = parser.parse_args()
+	if args.backend == "greedy":
+		# run as a script, so the package is not on the path
+		sys.path.insert(0, os.path.dirname(os.path.dirname(
+			os.path.abspath(__file__))))
+	if args.problem is not None:
+		sys.stdout.write(runGreedy(args.problem[0], args.problem[1],
+								   args.delay))
+	else:
+		serve(args.backend, args.concurrency, args.delay)
@@ -0,0 +1,137 @@
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import time
+from pathlib import Path
+
+# Per-stage instrumentation. Every run (feature detection) and every pair of
+# runs gets a record that is written as one JSON line:
+#
+#   {"kind": "run" or "pair", "name": mzML stem or edge file stem, "pid",
+#    "stages": {stage: {"wall", "cpu", "peakRssKb", "cached"}},
+#    ... stage specific counts (numEdges, nnz, bandWidth, numIterations)}
+#
+# wall and cpu are seconds (cpu includes every thread of the process).
+# peakRssKb is the peak resident set size of the process during the stage.
+# The peak is reset at the start of each stage (/proc/self/clear_refs), so a
+# large pair does not show up in the later pairs of the same worker process.
+# Stages that run at the same time in one process (threads) share the peak.
+# Without /proc (not Linux) the peak cannot be reset and the stage gets
+# rssGrowthKb instead, how much the peak of the process grew during the
+# stage (0 if the stage stayed below an earlier peak).
+
+stageNames = ["features", "edges", "matroid", "pairwise", "solver"]
+
+# writing 5 to clearRefsFile resets VmHWM (peak RSS) in statusFile
+clearRefsFile = "/proc/self/clear_refs"
+statusFile = "/proc/self/status"
+
+
+###############################################################################
+def newRecord(kind, name):
+	return({"kind":kind, "name":name, "pid":os.getpid(), "stages":{}})
+
+
+def resetPeakRss():
+	"""
+	Reset the peak resident set size of this process to its current resident
+	set size
+	Output: True if it was reset (Linux), otherwise False
+	"""
+	try:
+		with open(clearRefsFile, 'w') as file1:
+			file1.write("5")
+		return(True)
+	except OSError:
+		return(False)
+
+
+def peakRss(isReset):
+	"""
+	Peak resident set size of this process in KB. VmHWM (since the last
+	resetPeakRss) if isReset, otherwise the peak over the life of the process
+	"""
+	if isReset:
+		with open(statusFile, 'r') as file1:
+			for line1 in file1:
+				if line1.startswith("VmHWM:"):
+					return(int(line1.split()[1]))
+	return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+@contextlib.contextmanager
+def stage(record, stageName, profileStages=(), profileFolder="profile"):
+	"""
+	Time a stage and add its wall time, CPU time and peak RSS (see above) to
+	record.
+	Yields the stats dict of the stage so the caller can add to it. Stages in
+	profileStages are run under cProfile and the stats are dumped to
+	profileFolder/<record name>___<stage>.prof (see pstats).
+	"""
+	stats = {"cached":False}
+	record["stages"][stageName] = stats
+	profiler = None
+	if stageName in profileStages:
+		profiler = cProfile.Profile()
+		profiler.enable()
+	isReset = resetPeakRss()
+	rssStart = peakRss(isReset)
+	wallStart = time.perf_counter()
+	cpuStart = time.process_time()
+	try:
+		yield(stats)
+	finally:
+		stats["wall"] = time.perf_counter() - wallStart
+		stats["cpu"] = time.process_time() - cpuStart
+		if isReset:
+			stats["peakRssKb"] = peakRss(isReset)
+		else:
+			stats["rssGrowthKb"] = peakRss(isReset) - rssStart
+		if profiler is not None:
+			profiler.disable()
+			Path(profileFolder).mkdir(parents=True, exist_ok=True)
+			profiler.dump_stats(profileFolder + "/" + record["name"] + "___" +
+								stageName + ".prof")
+
+
+def bandStats(sparseMat):
+	"""
+	Shape of the band of a sparse edge similarity matrix (CSR, columns sorted
+	within each row)
+	Output: dict with bandWidth (largest |i - j| of an entry) and
+			maxRowEntries (largest number of entries in a row)
+	"""
+	indptr = sparseMat.indptr
+	rowEntries = indptr[1:] - indptr[:-1]
+	hasEntries = rowEntries > 0
+	if not hasEntries.any():
+		return({"bandWidth":0, "maxRowEntries":0})
+	rows = hasEntries.nonzero()[0]
+	first = sparseMat.indices[indptr[rows]]
+	last = sparseMat.indices[indptr[rows + 1] - 1]
+	bandWidth = max(int((rows - first).max()), int((last - rows).max()))
+	return({"bandWidth":bandWidth, "maxRowEntries":int(rowEntries.max())})
+
+
+###############################################################################
+def traceFileName(value):
+	"""
+	Trace file of a --trace option. An empty value or "none" turns tracing
+	off (None).
+	"""
+	if value.strip().lower() in ["", "none"]:
+		return(None)
+	return(value)
+
+
+def writeRecord(record, fileName):
+	"""
+	Append a record to a JSON-lines trace file. Nothing is written if fileName
+	is None.
+	"""
+	if fileName is None:
+		return
+	with open(fileName, 'a') as newFile:
+		newFile.write(json.dumps(record, separators=(',',':')) + '\n')
@@ -0,0 +1,375 @@
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+from bin import artifact_cache
+from bin import pipeline
+from bin import solver
+
+LOGGER = logging.getLogger(__name__)
+
+# Work queue on a shared filesystem. Worker processes on one or many hosts
+# claim pairs of runs, run pipeline.runPair on them and write the result of
+# each pair to its own file. Nothing but the filesystem is shared, so workers
+# can be started and stopped at any time.
+#
+#   queue.json : config (see pipeline.runPair), pairs (sorted as runPairs)
+#                and params (options of the reduce step)
+#   leases/<task>.lease : lease of a worker on a pair. Created with O_EXCL so
+#                         only one worker gets it. The worker touches the
+#                         file while it works and a lease that has not been
+#                         touched for leaseSeconds is taken over.
+#   results/<task>.json : output of runPair. Written to a temporary file and
+#                         renamed so a result is either complete or missing.
+#   failed/<task>.txt : traceback of the last failure of a pair
+#
+# Every path in queue.json is absolute so workers can run from any folder.
+# Hosts must mount the shared filesystem at the same path and have roughly
+# synchronized clocks.
+queueFileName = "queue.json"
+leaseFolderName = "leases"
+resultFolderName = "results"
+failedFolderName = "failed"
+
+leaseSeconds = 600.0
+pollSeconds = 5.0
+
+
+###############################################################################
+def taskName(taskId):
+	return("%08d" % taskId)
+
+
+def getLeaseFileName(queueFolder, taskId):
+	return(str(Path(queueFolder) / leaseFolderName / (taskName(taskId) +
+													  ".lease")))
+
+
+def getResultFileName(queueFolder, taskId):
+	return(str(Path(queueFolder) / resultFolderName / (taskName(taskId) +
+													   ".json")))
+
+
+def getFailedFileName(queueFolder, taskId):
+	return(str(Path(queueFolder) / failedFolderName / (taskName(taskId) +
+													   ".txt")))
+
+
+def writeJsonAtomic(jsonObject, fileName):
+	tmpFileName = str(fileName) + ".tmp" + socket.gethostname() + \
+				  str(os.getpid())
+	with open(tmpFileName, 'w') as newFile:
+		json.dump(jsonObject, newFile, separators=(',',':'))
+	os.replace(tmpFileName, fileName)
+
+
+###############################################################################
+def createQueue(queueFolder, config, pairList, params):
+	"""
+	Create (or reset) a work queue. Results, leases and failures of a previous
+	queue in queueFolder are removed.
+
+	Parameters
+	----------
+	queueFolder : str, path
+		Folder on the shared filesystem
+	config : dict
+		Config of pipeline.runPair. Folders must be absolute paths.
+	pairList : list
+		List of (left file, right file) tuples
+	params : dict
+		Options of the reduce step (see ms1connect.ms1ConnectReduce)
+
+	Returns
+	-------
+	Number of tasks
+	"""
+	pipeline.checkConfig(config)
+	pairList = pipeline.sortPairs(pairList, config)
+	for folderName in [leaseFolderName, resultFolderName, failedFolderName]:
+		folder = Path(queueFolder) / folderName
+		folder.mkdir(parents=True, exist_ok=True)
+		for f in folder.iterdir():
+			f.unlink()
+	writeJsonAtomic({"config":config, "pairs":[list(x) for x in pairList],
+					 "params":params}, Path(queueFolder) / queueFileName)
+	return(len(pairList))
+
+
+def loadQueue(queueFolder):
+	with open(Path(queueFolder) / queueFileName, 'r') as file1:
+		queue = json.load(file1)
+	# json has no tuples
+	if queue["config"]["superset_tol"] is not None:
+		queue["config"]["superset_tol"] = tuple(queue["config"]["superset_tol"])
+	queue["config"]["profile_stages"] = tuple(
+		queue["config"]["profile_stages"])
+	queue["pairs"] = [tuple(x) for x in queue["pairs"]]
+	return(queue)
+
+
+###############################################################################
+def readLease(leaseFileName):
+	"""
+	Output1: token of a lease file
+	Output2: seconds since the lease was last renewed
+	"""
+	with open(leaseFileName, 'r') as leaseFile:
+		return(leaseFile.read(),
+			   time.time() - os.fstat(leaseFile.fileno()).st_mtime)
+
+
+def claimTask(queueFolder, taskId, leaseTime=leaseSeconds):
+	"""
+	Try to take the lease of a task. A lease that has not been renewed for
+	leaseTime seconds is broken first: it is renamed to a unique name, which
+	only one worker can do, checked to still be the expired lease and then
+	removed.
+	Output: lease token if the lease was taken, otherwise None
+	"""
+	leaseFileName = getLeaseFileName(queueFolder, taskId)
+	token = socket.gethostname() + ":" + str(os.getpid()) + ":" + \
+			uuid.uuid4().hex
+	for attempt in range(2):
+		try:
+			fd = os.open(leaseFileName, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+		except FileExistsError:
+			try:
+				staleToken, age = readLease(leaseFileName)
+			except FileNotFoundError:
+				continue # released in the meantime
+			if age <= leaseTime:
+				return(None)
+			staleFileName = leaseFileName + ".stale" + uuid.uuid4().hex
+			try:
+				os.rename(leaseFileName, staleFileName)
+			except FileNotFoundError:
+				return(None) # another worker broke it first
+			# between the age check and the rename another worker can break
+			# the lease and take a new one. A lease that is not the expired
+			# one is put back (unless yet another lease was taken since)
+			movedToken, movedAge = readLease(staleFileName)
+			if movedToken != staleToken or movedAge <= leaseTime:
+				try:
+					os.link(staleFileName, leaseFileName)
+				except FileExistsError:
+					pass
+				os.remove(staleFileName)
+				return(None)
+			LOGGER.warning("Broke expired lease %s (%.0f s old)",
+						   leaseFileName, age)
+			os.remove(staleFileName)
+			continue
+		with os.fdopen(fd, 'w') as leaseFile:
+			leaseFile.write(token)
+		return(token)
+	return(None)
+
+
+def ownsLease(queueFolder, taskId, token):
+	try:
+		with open(getLeaseFileName(queueFolder, taskId), 'r') as file1:
+			return(file1.read() == token)
+	except FileNotFoundError:
+		return(False)
+
+
+def releaseTask(queueFolder, taskId, token):
+	"""
+	Remove the lease of a task if it is still held with token
+	"""
+	if ownsLease(queueFolder, taskId, token):
+		try:
+			os.remove(getLeaseFileName(queueFolder, taskId))
+		except FileNotFoundError:
+			pass
+
+
+@contextlib.contextmanager
+def heartbeat(queueFolder, taskId, token, leaseTime=leaseSeconds):
+	"""
+	Renew the lease of a task every leaseTime / 4 seconds until the with block
+	ends. The lease file is only touched while it still holds token. Once
+	another worker has broken and taken the lease the heartbeat stops and
+	the yielded event is set so the result of the task can be dropped.
+	Output: threading.Event that is set if the lease was lost
+	"""
+	leaseFileName = getLeaseFileName(queueFolder, taskId)
+	done = threading.Event()
+	lost = threading.Event()
+	def renew():
+		while not done.wait(leaseTime / 4):
+			try:
+				# the file that was read is the one touched, even if the
+				# lease path is replaced in between
+				with open(leaseFileName, 'r') as leaseFile:
+					if leaseFile.read() != token:
+						break
+					os.utime(leaseFile.fileno())
+			except FileNotFoundError:
+				break
+		else:
+			return
+		LOGGER.warning("Lost the lease of task %s", taskName(taskId))
+		lost.set()
+	thread = threading.Thread(target=renew, daemon=True)
+	thread.start()
+	try:
+		yield(lost)
+	finally:
+		done.set()
+		thread.join()
+
+
+###############################################################################
+def isDone(queueFolder, taskId):
+	return(Path(getResultFileName(queueFolder, taskId)).is_file())
+
+
+def writeResult(queueFolder, taskId, result):
+	"""
+	Write the output of runPair for a task
+	"""
+	edgeStem, pairwiseLine, solverOutput, solverResult, cache, record = result
+	writeJsonAtomic({"edgeStem":edgeStem, "pairwiseLine":pairwiseLine,
+					 "solverOutput":solverOutput,
+					 "solverResult":None if solverResult is None else
+									list(solverResult),
+					 "cache":cache, "record":record},
+					getResultFileName(queueFolder, taskId))
+
+
+def loadResult(queueFolder, taskId):
+	"""
+	Output of runPair written by writeResult
+	"""
+	with open(getResultFileName(queueFolder, taskId), 'r') as file1:
+		result = json.load(file1)
+	solverResult = result["solverResult"]
+	if solverResult is not None:
+		solverResult = solver.SolverResult(*solverResult)
+	return(result["edgeStem"], result["pairwiseLine"], result["solverOutput"],
+		   solverResult, result["cache"], result["record"])
+
+
+def queueStatus(queueFolder, queue=None):
+	"""
+	Output: dict with the number of tasks, done tasks, leased tasks and
+			failed tasks
+	"""
+	if queue is None:
+		queue = loadQueue(queueFolder)
+	def count(folderName, ext):
+		return(sum(1 for f in (Path(queueFolder) / folderName).iterdir()
+				   if f.name.endswith(ext)))
+	return({"tasks":len(queue["pairs"]),
+			"done":count(resultFolderName, ".json"),
+			"leased":count(leaseFolderName, ".lease"),
+			"failed":count(failedFolderName, ".txt")})
+
+
+###############################################################################
+def runWorker(queueFolder, maxTasks=None, leaseTime=leaseSeconds,
+			  pollTime=pollSeconds, threads=None):
+	"""
+	Claim and run tasks until every task is done. Tasks leased by other
+	workers are waited for (and taken over if their lease expires). Each
+	worker starts at a different task so workers rarely compete for the same
+	lease. A task that fails is recorded in the failed folder and not retried
+	by the same worker.
+
+	Parameters
+	----------
+	queueFolder : str, path
+		Folder of the work queue (see createQueue)
+	maxTasks : int
+		Stop after this many tasks. Default=run until the queue is done
+	leaseTime : float
+		Seconds after which a lease that is not renewed is taken over
+	pollTime : float
+		Seconds to wait when every remaining task is leased
+	threads : int
+		Number of numba threads of this worker. Default=every core
+
+	Returns
+	-------
+	Number of tasks run by this worker
+	"""
+	if threads is not None:
+		pipeline._initWorker(threads)
+	queue = loadQueue(queueFolder)
+	config = queue["config"]
+	pairList = queue["pairs"]
+	numTasks = len(pairList)
+	manifest = artifact_cache.loadManifest(queue["params"]["manifest_file"])
+
+	numRun = 0
+	failedTasks = set()
+	start = uuid.uuid4().int % max(numTasks, 1)
+	while True:
+		for k in range(numTasks):
+			taskId = (start + k) % numTasks
+			if taskId in failedTasks or isDone(queueFolder, taskId):
+				continue
+			token = claimTask(queueFolder, taskId, leaseTime)
+			if token is None:
+				continue
+			try:
+				# finished by another worker between the check and the claim
+				if isDone(queueFolder, taskId):
+					continue
+				leftFile, rightFile = pairList[taskId]
+				fileNames = pipeline.getPairFileNames(leftFile, rightFile,
+													  config)
+				cache = artifact_cache.subManifest(manifest,
+					[leftFile, rightFile] + list(fileNames.values()))
+				with heartbeat(queueFolder, taskId, token, leaseTime) as lost:
+					result = pipeline.runPair(leftFile, rightFile, config,
+											  cache)
+				# another worker took the lease over and runs the task
+				if lost.is_set() or not ownsLease(queueFolder, taskId, token):
+					LOGGER.warning("Dropped the result of task %s",
+								   taskName(taskId))
+					continue
+				writeResult(queueFolder, taskId, result)
+				if Path(getFailedFileName(queueFolder, taskId)).is_file():
+					os.remove(getFailedFileName(queueFolder, taskId))
+				numRun += 1
+			except Exception:
+				LOGGER.exception("Task %s failed", taskName(taskId))
+				failedTasks.add(taskId)
+				with open(getFailedFileName(queueFolder, taskId), 'w') as \
+					 newFile:
+					newFile.write(traceback.format_exc())
+			finally:
+				releaseTask(queueFolder, taskId, token)
+			if maxTasks is not None and numRun >= maxTasks:
+				return(numRun)
+		if all(taskId in failedTasks or isDone(queueFolder, taskId)
+			   for taskId in range(numTasks)):
+			return(numRun)
+		time.sleep(pollTime)
+
+
+def collectResults(queueFolder, queue=None):
+	"""
+	Outputs of runPair of every task in task order (same order as runPairs).
+	Raises an exception if a task is not done.
+	Output: generator of runPair outputs
+	"""
+	if queue is None:
+		queue = loadQueue(queueFolder)
+	status = queueStatus(queueFolder, queue)
+	if status["done"] < status["tasks"]:
+		raise Exception(str(status["tasks"] - status["done"]) + " of " +
+						str(status["tasks"]) + " tasks in " + str(queueFolder) +
+						" are not done (" + str(status["failed"]) +
+						" failed, see " + failedFolderName + ")")
+	return(loadResult(queueFolder, taskId)
+		   for taskId in range(status["tasks"]))
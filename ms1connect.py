@@ -1,17 +1,180 @@
 import argparse
-import subprocess
+import contextlib
+import math
+import os
+import sys
 from pathlib import Path
-from bin import ms1_feature_detection
+from bin import artifact_cache
 from bin import create_edge
-from bin import edge_to_json_matroid
-from bin import pairwise_edge_matrix
-from bin import plots
+from bin import pipeline
+from bin import plot_modes
+from bin import results_store
+from bin import run_matrix
+from bin import sketch
+from bin import solver_driver
+from bin import trace
+from bin import work_queue
+
+
+def detectFeatures(mzmlFileList, ms1_folder, top_n, manifest, jobs=1,
+				   feature_threads=None, memory_mb=None, trace_file=None,
+				   profile_stages=(), profile_folder="profile"):
+	"""
+	Perform MS1 feature detection on each mzML file unless its MS1 feature
+	file is up to date (see artifact_cache). Files are split over jobs worker
+	processes with feature_threads pyOpenMS threads each, or run in this
+	process if jobs is 1 or there is one file. Files run in this process use
+	feature_threads threads unless pyOpenMS was already loaded (see
+	ms1_feature_detection.processThreads).
+	If memory_mb is given files are streamed with a memory ceiling of
+	memory_mb per worker.
+	A trace record of each file is appended to trace_file (see trace).
+	"""
+	params = {"top_n":top_n}
+	if memory_mb is not None:
+		params["memory_mb"] = memory_mb
+	todo = {}
+	for f in mzmlFileList:
+		f = Path(f)
+		ms1File = ms1_folder + "/" + f.stem + "_ms1Peak.txt"
+		featureKey = artifact_cache.artifactKey("features",
+			[artifact_cache.fileDigest(f, manifest)], params)
+		if artifact_cache.isFresh(manifest, ms1File, featureKey):
+			continue
+		if Path(ms1File).is_file() and artifact_cache.isUnknown(manifest,
+																ms1File):
+			# MS1 feature file created before the manifest existed
+			artifact_cache.recordArtifact(manifest, ms1File, featureKey)
+			continue
+		artifact_cache.removeStale(ms1File)
+		todo[str(f)] = (ms1File, featureKey)
+	if len(todo) == 0:
+		return
+
+	# pyOpenMS is only imported when a file needs feature detection. Files run
+	# in this process (one job or one file) use the OpenMP threads read once
+	# when pyOpenMS is loaded (ms1_feature_detection.processThreads), so
+	# feature_threads is set for that import
+	isSerial = jobs <= 1 or len(todo) <= 1
+	if feature_threads is not None and isSerial and \
+	   "pyopenms" not in sys.modules:
+		oldThreads = os.environ.get("OMP_NUM_THREADS")
+		os.environ["OMP_NUM_THREADS"] = str(feature_threads)
+		try:
+			from bin import ms1_feature_detection
+		finally:
+			if oldThreads is None:
+				del os.environ["OMP_NUM_THREADS"]
+			else:
+				os.environ["OMP_NUM_THREADS"] = oldThreads
+	from bin import ms1_feature_detection
+	for f, record in ms1_feature_detection.peakPickFiles(list(todo),
+			ms1_folder, top_n, jobs, feature_threads, memory_mb,
+			profile_stages, profile_folder):
+		trace.writeRecord(record, trace_file)
+		ms1File, featureKey = todo[f]
+		artifact_cache.recordArtifact(manifest, ms1File, featureKey)
+
+
+# log files of every pair, written to the output folder
+pairwiseLogFileName = "pairwise-edge.log.txt"
+solverLogFileName = "coopraize.log.txt"
+
+# options of ms1Connect, ms1ConnectAdd and ms1ConnectSearch that make up the
+# config of pipeline.runPair
+configNames = ["ms1_folder", "edge_folder", "matroid_folder",
+			   "edge_sim_folder", "mz_tol", "tic_tol", "lambda1", "lambda2",
+			   "lambda3", "lambda4", "alpha", "beta", "gamma", "edge_backend",
+			   "solver", "edge_format", "term_cache", "superset_tol",
+			   "trace_file", "profile_stages", "profile_folder",
+			   "pairwise_memory_mb", "solver_timeout", "solver_retries",
+			   "solver_concurrency"]
+
+
+def makeConfig(options):
+	"""
+	Config of pipeline.runPair from the arguments of ms1Connect,
+	ms1ConnectAdd or ms1ConnectSearch (see configNames). The edge, matroid
+	and edge similarity matrix folders are created if needed.
+	Input: dict of argument name to value
+	Output: config dict
+	"""
+	config = {name:options[name] for name in configNames}
+	if config["solver_concurrency"] is None:
+		config["solver_concurrency"] = options["jobs"]
+	for name in ["edge_folder", "matroid_folder", "edge_sim_folder"]:
+		if Path(config[name]).is_dir() == False:
+			Path(config[name]).mkdir()
+	return(config)
+
+
+def writePairOutputs(pairOutputs, manifest, manifest_file, results_file,
+					 trace_file, log_folder=None, log_mode='w'):
+	"""
+	Record the runPair output of every pair: its manifest entries are merged
+	into manifest (saved once every pair is done), its trace record is
+	appended to trace_file and its results are written to the results store.
+	If log_folder is given pairwise-edge.log.txt and coopraize.log.txt are
+	written (log_mode 'a' appends to them). The pairs the solver failed on
+	are reported.
+	Output: list of (edge file stem, post normalization value, SolverResult)
+	"""
+	pairResults = []
+	resultRows = []
+	failedList = []
+	with contextlib.ExitStack() as stack:
+		if log_folder is not None:
+			file1 = stack.enter_context(open(log_folder + "/" +
+											 pairwiseLogFileName, log_mode))
+			file2 = stack.enter_context(open(log_folder + "/" +
+											 solverLogFileName, log_mode))
+		for edgeStem, pairwiseLine, solverOutput, solverResult, cache, \
+			record in pairOutputs:
+			artifact_cache.mergeManifest(manifest, cache)
+			trace.writeRecord(record, trace_file)
+			if log_folder is not None:
+				file1.write(pairwiseLine)
+				file2.write("filename___" + edgeStem + "\n")
+				file2.write(solverOutput)
+			pairResults.append((edgeStem, record["postNormVal"], solverResult))
+			resultRows.append(results_store.pairRow(edgeStem,
+				record["numEdges"], record["numEntries"], record["postNormVal"],
+				solverResult))
+			if solverResult is None:
+				failedList.append(edgeStem)
+	artifact_cache.saveManifest(manifest, manifest_file)
+	printSolverFailures(failedList, None if log_folder is None else
+						log_folder + "/" + solverLogFileName)
+	conn = results_store.openResultsStore(results_file)
+	results_store.writePairResults(conn, resultRows)
+	conn.close()
+	return(pairResults)
+
+
+def updateSketchIndex(ms1FileList, output_folder, manifest):
+	"""
+	Add the sketch of every new or changed MS1 feature file to the sketch
+	index of output_folder (see sketch)
+	"""
+	indexFile = output_folder + "/" + sketch.indexFileName
+	index = sketch.loadIndex(indexFile)
+	if sketch.updateIndex(index, ms1FileList, manifest) > 0:
+		sketch.saveIndex(index, indexFile)
 
 
 def ms1Connect(mzml_folder, ms1_folder, edge_folder, matroid_folder,
 			   edge_sim_folder, output_folder, top_n, mz_tol, tic_tol,
 			   metadata_file, lambda1, lambda2, lambda3, lambda4, alpha, beta,
-			   gamma):
+			   gamma, jobs=1, edge_backend="numpy", solver="coopraiz",
+			   edge_format="txt", manifest_file="ms1connect.manifest.json",
+			   feature_threads=None, memory_mb=None, term_cache=False,
+			   superset_tol=None, trace_file="ms1connect.trace.jsonl",
+			   profile_stages=(), profile_folder="profile",
+			   results_file="ms1connect.results.sqlite", mds_method="auto",
+			   heatmap_mode="auto", pairwise_memory_mb=None,
+			   queue_folder=None, solver_timeout=solver_driver.solverTimeout,
+			   solver_retries=solver_driver.solverRetries,
+			   solver_concurrency=None):
 	'''Main script for MS1Connect.
 
 	Parameters
@@ -31,8 +194,9 @@ def ms1Connect(mzml_folder, ms1_folder, edge_folder, matroid_folder,
 		Path of folder to put sparse edge similarity matricies. These files will
 		be generated by MS1Connect. Folder will be created if it does not exist.
 	output_folder : str, path
-		Path of folder to put output files and plots. This folder wil be created
-		if it does not exist.
+		Path of folder to put output files, plots and the log files
+		(pairwise-edge.log.txt and coopraize.log.txt). This folder wil be
+		created if it does not exist.
 	top_n : int
 		Number of high intensity MS1 features to keep for use in edge generation.
 	mz_tol : float
@@ -41,83 +205,380 @@ def ms1Connect(mzml_folder, ms1_folder, edge_folder, matroid_folder,
 	tic_tol : float
 		The normalized retention time tolerance that two MS1 features need to be
 		within in order to generate an edge.
+	jobs : int
+		Number of mzML files and run pairs to process in parallel.
+	edge_backend : str
+		"numpy" generates edges in-process. "createEdge" calls the createEdge
+		binary.
+	solver : str
+		"coopraiz" runs the coopraiz singularity container. "greedy" runs the
+		native greedy solver in-process. "coopraiz-batch" sends every pair to
+		one long-lived coopraiz container and "greedy-batch" to a local
+		stand-in solver process (see solver_driver).
+	edge_format : str
+		"txt" writes tab delimited edge files. "bin" writes binary edge files
+		that later stages memory map.
+	manifest_file : str, path
+		Manifest of intermediate files and the inputs and parameters they
+		were created from.
+	feature_threads : int
+		Number of pyOpenMS threads per feature detection worker. Default
+		splits the cores evenly between the jobs workers.
+	memory_mb : float
+		Streams each mzML file and keeps at most about memory_mb megabytes of
+		peaks in memory per feature detection worker. Default loads every MS1
+		scan of a file.
+	term_cache : bool
+		Keep the hyperparameter free terms of each edge similarity matrix
+		(___terms.npz) so later runs with other lambda, alpha, beta or gamma
+		values only reweight them.
+	superset_tol : tuple
+		(m/z tolerance, TIC tolerance) of a superset edge file built once per
+		pair. Edge files for mz_tol and tic_tol (which must not be wider) are
+		filtered from it, so a tolerance sweep only runs the m/z join once.
+	trace_file : str, path
+		JSON-lines file that gets the wall time, CPU time and peak RSS of each
+		stage of every run and pair (see trace). None turns tracing off.
+	profile_stages : list
+		Stages (see trace.stageNames) to run under cProfile
+	profile_folder : str, path
+		Folder for the cProfile stats of profile_stages
+	results_file : str, path
+		SQLite store of the score, selected edges, nRow, nnz and post
+		normalization value of every pair (see results_store). The run
+		similarity matrix is built from it.
+	mds_method : str
+		MDS method (see plot_modes.mdsMethods). "auto" uses classical MDS for
+		large cohorts.
+	heatmap_mode : str
+		Heatmap mode (see plot_modes.heatmapModes). "auto" draws a rasterized
+		heatmap and a per label heatmap for large cohorts.
+	pairwise_memory_mb : float
+		Builds each sparse edge similarity matrix in chunks of rows that keep
+		at most about pairwise_memory_mb megabytes of matrix entries in memory
+		(see pairwise_edge_matrix.fillInMatrixChunked). Cannot be combined
+		with term_cache.
+	queue_folder : str, path
+		Instead of scoring the pairs, queue them in queue_folder on a shared
+		filesystem (see work_queue) for 'ms1connect.py worker' processes on
+		any host. 'ms1connect.py reduce' then writes the outputs.
+	solver_timeout : float
+		Seconds a batch solver gets for one pair before it is retried
+	solver_retries : int
+		Retries of a pair a batch solver timed out on or failed
+	solver_concurrency : int
+		Pairs a batch solver solves at the same time. Default=jobs
 
 	Returns
 	-------
 	'''
+	options = locals()
+	# Every intermediate file is recorded in the manifest with a key built
+	# from its inputs and parameters. Files are only recomputed when the key
+	# changes
+	manifest = artifact_cache.loadManifest(manifest_file)
+
 	# Perform MS1 feature detection on mzML files
 	# Keeps top N most intense MS1 features per file
 	# Writes each output file to disk
-	for f in Path(mzml_folder).glob("**/*mzML"):
-		if Path(ms1_folder + "/" + f.stem + "_ms1Peak.txt").is_file():
-			continue
-		ms1_feature_detection.peakPick(str(f), ms1_folder, top_n)
-
-	# Generate set of edges from each pair of runs
-	create_edge.create_edges(ms1_folder, edge_folder, 
-		str(Path(__file__).resolve().parent)+"/bin/createEdge", mz_tol, tic_tol)
-
-	# Generate matroid file for each edge file
-	if Path(matroid_folder).is_dir() == False:
-		Path(matroid_folder).mkdir()
-	for f in Path(edge_folder).glob("**/*___score.txt"):
-		edge_to_json_matroid.createJsonMatroid(f, matroid_folder)
-
-	# Generate sparse edge similarity matrix for each edge file
-	if Path(edge_sim_folder).is_dir() == False:
-		Path(edge_sim_folder).mkdir()
-	with open("pairwise-edge.log.txt", 'w') as file1, \
-		 open("coopraize.log.txt", 'w') as file2:
-		#for f in Path(edge_folder).glob("**/*___score.txt"):
-		a = Path(edge_folder).glob("**/*___score.txt")
-		b = list(a)
-		b.sort()
-		for f in b:
-			fileName, nRow, rowListSize, postNormVal = \
-				pairwise_edge_matrix.createEdgeSimMatrix(str(f), 
-				ms1_folder, edge_sim_folder, lambda1, lambda2, lambda3, lambda4,
-				alpha, beta, gamma)
-			file1.write(fileName + '\t' + str(nRow) + '\t' + str(rowListSize) +
-						'\t' + str(postNormVal) + '\n')
-
-			npz_file = fileName + "___pairwise.npz"
-			matroid_file = fileName + "___matroid.json"
-
-			# log file can be directly generated from coopraize using the below
-			# -flogfilename /output/coopraiz_log.txt
-			cmd = "singularity exec --bind ./:/input/ --bind " +\
-			"./:/output/ " + str(Path(__file__).resolve().parent) +\
-			"/bin/coopraiz-singularity " +\
-			"/submarine/build/opic-coopraiz -spssdfilename /input/" +\
-			edge_sim_folder + "/" + npz_file + " -imjson /input/" +\
-			matroid_folder + "/" + matroid_file + " -cloglevel info " +\
-			"-ctrl-logsolution -flogtruncate false"
-
-			#TODO fail gracefully if coopraize docker has expired
-		
-			file2.write("filename___" + f.stem + "\n")	
-			result = subprocess.run(cmd, shell=True, capture_output=True)
-			file2.write(result.stdout.decode())
+	detectFeatures(Path(mzml_folder).glob("**/*mzML"), ms1_folder, top_n,
+				   manifest, jobs, feature_threads, memory_mb, trace_file,
+				   profile_stages, profile_folder)
+	artifact_cache.saveManifest(manifest, manifest_file)
+
+	# Run the per-pair chain (edges, matroid, sparse edge similarity matrix and
+	# coopraiz) for each pair of runs. Pairs are distributed over jobs worker
+	# processes
+	config = makeConfig(options)
+	if queue_folder is not None:
+		# workers on other hosts or in other folders need absolute paths
+		for name in ["ms1_folder", "edge_folder", "matroid_folder",
+					 "edge_sim_folder", "profile_folder", "trace_file"]:
+			if config[name] is not None:
+				config[name] = os.path.abspath(config[name])
+		pairList = [(os.path.abspath(leftFile), os.path.abspath(rightFile))
+					for leftFile, rightFile in
+					create_edge.getPairList(ms1_folder)]
+		params = {"ms1_folder":ms1_folder, "metadata_file":metadata_file,
+				  "output_folder":output_folder, "manifest_file":manifest_file,
+				  "results_file":results_file, "trace_file":trace_file}
+		params = {name:None if value is None else os.path.abspath(value)
+				  for name, value in params.items()}
+		params.update({"mds_method":mds_method, "heatmap_mode":heatmap_mode})
+		numTasks = work_queue.createQueue(queue_folder, config, pairList,
+										  params)
+		print("Queued " + str(numTasks) + " pairs in " + str(queue_folder) +
+			  ". Run 'ms1connect.py worker' and then 'ms1connect.py reduce'")
+		return
+
+	writeRunOutputs(pipeline.runPairs(create_edge.getPairList(ms1_folder),
+									  config, jobs, manifest),
+					manifest, ms1_folder, metadata_file, output_folder,
+					manifest_file, results_file, trace_file, mds_method,
+					heatmap_mode)
 
+
+def printSolverFailures(failedList, solverLogName=None):
+	"""
+	Report the pairs the solver failed on. Their score is NULL in the results
+	store. The reason of each failure is in solverLogName if given (see
+	solver_driver.outcomeResult).
+	"""
+	if len(failedList) > 0:
+		logNote = "" if solverLogName is None else " (see " + solverLogName + ")"
+		print("The solver failed on " + str(len(failedList)) + " pairs" +
+			  logNote + ": " + ", ".join(failedList))
+
+
+def writeRunOutputs(pairOutputs, manifest, ms1_folder, metadata_file,
+					output_folder, manifest_file, results_file, trace_file,
+					mds_method="auto", heatmap_mode="auto"):
+	"""
+	Write the outputs of ms1Connect from the runPair output of every pair to
+	output_folder: pairwise-edge.log.txt and coopraize.log.txt, the run
+	matrix store, the sketch index and the run similarity matrix and its
+	plots. Trace records and the results store are written too. The manifest
+	entries of every pair are merged into manifest and saved.
+	"""
+	# plotting dependencies (seaborn, matplotlib, sklearn) are only imported
+	# by the commands that write plots
+	from bin import plots
 	if Path(output_folder).is_dir() == False:
 		Path(output_folder).mkdir()
-	plots.createRunSimMatrix(ms1_folder, "coopraize.log.txt", metadata_file,
-							 "pairwise-edge.log.txt", output_folder)
+	writePairOutputs(pairOutputs, manifest, manifest_file, results_file,
+					 trace_file, output_folder)
 
+	# persistent run similarity matrix that new runs can be added to (see
+	# ms1ConnectAdd). Runs are in metadata file order
+	store = run_matrix.buildRunMatrix(
+		plots.getFileList(ms1_folder, metadata_file)[0], results_file)
+	run_matrix.saveRunMatrix(store,
+							 output_folder + "/" + run_matrix.storeFileName)
+	# sketches of every run for 'ms1connect.py search'
+	updateSketchIndex([ms1_folder + "/" + name + "_ms1Peak.txt"
+					   for name in store["names"]], output_folder, manifest)
+	artifact_cache.saveManifest(manifest, manifest_file)
 
-if __name__ == "__main__":
-	parser = argparse.ArgumentParser(description="Runs MS1Connect on a set of \
-mzML files.")
-	parser.add_argument("mzml", help="Folder containing mzML files")
-	parser.add_argument("ms1", help="Folder containing MS1 feature files")
-	parser.add_argument("edge", help="Folder containing edge files")
-	parser.add_argument("matroid", help="Folder containing matroid files.\
-						Folder will be created if it does not exist.")
-	parser.add_argument("edgeSimMatrix", help='Folder containing sparse edge\
-						similarity matricies. Folder will be created if\
-						it does not exist.')
-	parser.add_argument("metadata",help='Metadata file')
-	parser.add_argument("output",help='Folder to place outputs')
+	plots.createRunSimMatrix(ms1_folder, metadata_file, results_file,
+							 output_folder, mdsMethod=mds_method,
+							 heatmapMode=heatmap_mode)
+
+
+def ms1ConnectReduce(queue_folder):
+	'''Write the outputs of a work queue (see ms1Connect queue_folder) once
+	every pair is done. Same outputs as ms1Connect.
+	'''
+	queue = work_queue.loadQueue(queue_folder)
+	params = queue["params"]
+	manifest = artifact_cache.loadManifest(params["manifest_file"])
+	writeRunOutputs(work_queue.collectResults(queue_folder, queue), manifest,
+					params["ms1_folder"], params["metadata_file"],
+					params["output_folder"], params["manifest_file"],
+					params["results_file"], params["trace_file"],
+					params["mds_method"], params["heatmap_mode"])
+
+
+def ms1ConnectAdd(mzml_files, ms1_folder, edge_folder, matroid_folder,
+				  edge_sim_folder, output_folder, top_n, mz_tol, tic_tol,
+				  lambda1, lambda2, lambda3, lambda4, alpha, beta, gamma,
+				  jobs=1, edge_backend="numpy", solver="coopraiz",
+				  edge_format="txt", manifest_file="ms1connect.manifest.json",
+				  feature_threads=None, memory_mb=None, term_cache=False,
+				  superset_tol=None, trace_file="ms1connect.trace.jsonl",
+				  profile_stages=(), profile_folder="profile",
+				  results_file="ms1connect.results.sqlite",
+				  pairwise_memory_mb=None,
+				  solver_timeout=solver_driver.solverTimeout,
+				  solver_retries=solver_driver.solverRetries,
+				  solver_concurrency=None):
+	'''Add new runs to the run similarity matrix of a previous MS1Connect
+	run. Only the pairs between each new run and every run already in the
+	matrix (and the new runs themselves) are scored.
+
+	Parameters
+	----------
+	mzml_files : list
+		mzML files of the new runs
+	output_folder : str, path
+		Output folder of the previous MS1Connect run. Contains the run matrix
+		store (see run_matrix). output_score_matrix.txt is rewritten from the
+		results store with the new runs appended in the order given and the
+		log lines of the new pairs are appended to its log files.
+	results_file : str, path
+		Results store of the previous MS1Connect run. The scores of the new
+		pairs are added to it.
+
+	See ms1Connect for the other parameters.
+
+	Returns
+	-------
+	'''
+	options = locals()
+	manifest = artifact_cache.loadManifest(manifest_file)
+	detectFeatures(mzml_files, ms1_folder, top_n, manifest, jobs,
+				   feature_threads, memory_mb, trace_file, profile_stages,
+				   profile_folder)
+	artifact_cache.saveManifest(manifest, manifest_file)
+
+	storeFile = output_folder + "/" + run_matrix.storeFileName
+	store = run_matrix.loadRunMatrix(storeFile)
+	oldNames = list(store["names"])
+	newNames = [Path(f).stem for f in mzml_files]
+	newNames = [name for name in newNames if name not in oldNames]
+
+	# new run against every run (left file is the first in sorted order, same
+	# as create_edge.getPairList)
+	pairList = []
+	for i, newName in enumerate(newNames):
+		for name in oldNames + newNames[:i+1]:
+			pair = sorted([ms1_folder + "/" + newName + "_ms1Peak.txt",
+						   ms1_folder + "/" + name + "_ms1Peak.txt"])
+			pairList.append(tuple(pair))
+
+	config = makeConfig(options)
+	writePairOutputs(pipeline.runPairs(pairList, config, jobs, manifest),
+					 manifest, manifest_file, results_file, trace_file,
+					 output_folder, 'a')
+
+	# only the rows and columns of the new runs are read from the results store
+	run_matrix.updateRuns(store, newNames, results_file)
+	run_matrix.saveRunMatrix(store, storeFile)
+	run_matrix.writeScoreMatrix(store, output_folder)
+	updateSketchIndex([ms1_folder + "/" + name + "_ms1Peak.txt"
+					   for name in newNames], output_folder, manifest)
+	artifact_cache.saveManifest(manifest, manifest_file)
+
+
+def ms1ConnectSearch(mzml_files, ms1_folder, edge_folder, matroid_folder,
+					 edge_sim_folder, output_folder, top_n, mz_tol, tic_tol,
+					 lambda1, lambda2, lambda3, lambda4, alpha, beta, gamma,
+					 top_k=10, jobs=1, edge_backend="numpy", solver="coopraiz",
+					 edge_format="txt",
+					 manifest_file="ms1connect.manifest.json",
+					 feature_threads=None, memory_mb=None, term_cache=False,
+					 superset_tol=None, trace_file="ms1connect.trace.jsonl",
+					 profile_stages=(), profile_folder="profile",
+					 results_file="ms1connect.results.sqlite",
+					 pairwise_memory_mb=None,
+					 solver_timeout=solver_driver.solverTimeout,
+					 solver_retries=solver_driver.solverRetries,
+					 solver_concurrency=None):
+	'''Find the runs of a previous MS1Connect run most similar to each query
+	run. The top_k candidates of each query are picked with the sketch index
+	(see sketch) and only the pairs between the query and its candidates are
+	scored. The query runs are not added to the run similarity matrix but
+	their MS1 feature files are kept in ms1_folder so 'ms1connect.py add' can
+	reuse them.
+
+	Parameters
+	----------
+	mzml_files : list
+		mzML files of the query runs
+	output_folder : str, path
+		Output folder of the previous MS1Connect run. Contains the sketch
+		index. The candidates of each query are written to
+		<query>_search.txt sorted by post-normalized score.
+	top_k : int
+		Number of candidates scored per query
+
+	See ms1Connect for the other parameters.
+
+	Returns
+	-------
+	searchDic : dict
+		Query run name to a list of (run name, sketch similarity, score,
+		post-normalized score) sorted by post-normalized score
+	'''
+	options = locals()
+	indexFile = output_folder + "/" + sketch.indexFileName
+	index = sketch.loadIndex(indexFile)
+	if len(index["names"]) == 0:
+		raise Exception("No sketch index found in " + output_folder +
+						". Run ms1connect.py on the library first")
+
+	manifest = artifact_cache.loadManifest(manifest_file)
+	detectFeatures(mzml_files, ms1_folder, top_n, manifest, jobs,
+				   feature_threads, memory_mb, trace_file, profile_stages,
+				   profile_folder)
+	artifact_cache.saveManifest(manifest, manifest_file)
+
+	# candidates of each query (left file is the first in sorted order, same
+	# as create_edge.getPairList)
+	candidateDic = {}
+	pairList = set()
+	for f in mzml_files:
+		queryName = Path(f).stem
+		queryFile = ms1_folder + "/" + queryName + "_ms1Peak.txt"
+		signature, numTokens = sketch.sketchFile(queryFile, index["params"])
+		candidateDic[queryName] = sketch.query(index, signature, top_k,
+											   [queryName])
+		for name, sketchSim in candidateDic[queryName]:
+			pairList.add(tuple(sorted([queryFile,
+									   ms1_folder + "/" + name + "_ms1Peak.txt"])))
+
+	config = makeConfig(options)
+	pairScore = {}
+	for edgeStem, postNormVal, solverResult in writePairOutputs(
+			pipeline.runPairs(list(pairList), config, jobs, manifest),
+			manifest, manifest_file, results_file, trace_file):
+		# nan if the solver failed
+		score = float("nan") if solverResult is None else solverResult.score
+		edgeStem_sp = edgeStem.split("___")
+		for key in [(edgeStem_sp[0], edgeStem_sp[1]),
+					(edgeStem_sp[1], edgeStem_sp[0])]:
+			pairScore[key] = (score, score * postNormVal)
+
+	searchDic = {}
+	for queryName, candidates in candidateDic.items():
+		rows = [(name, sketchSim) + pairScore[(queryName, name)]
+				for name, sketchSim in candidates]
+		# candidates the solver failed on (nan) are last
+		rows.sort(key=lambda x: (math.isnan(x[3]), -x[3]))
+		searchDic[queryName] = rows
+		with open(output_folder + "/" + queryName + "_search.txt", 'w') as \
+			 newFile:
+			newFile.write("run\tsketchSimilarity\tscore\tnormalizedScore\n")
+			for row in rows:
+				newFile.write("%s\t%f\t%f\t%f\n" % row)
+	return(searchDic)
+
+
+def ms1ConnectRecall(output_folder, top_k=10,
+					 results_file="ms1connect.results.sqlite"):
+	'''Recall of the sketch prefilter of 'ms1connect.py search' against the
+	exhaustive scores of a previous MS1Connect run (see sketch.measureRecall).
+	Run matrix stores that only kept the run names are rebuilt from the
+	results store results_file. The recall of each run is written to
+	sketch_recall.txt in output_folder.
+
+	Returns
+	-------
+	meanRecall : float
+		Mean recall over every run
+	'''
+	store = run_matrix.loadRunMatrix(output_folder + "/" +
+									 run_matrix.storeFileName)
+	index = sketch.loadIndex(output_folder + "/" + sketch.indexFileName)
+	if store["matrix"] is None:
+		store = run_matrix.buildRunMatrix(store["names"], results_file)
+	recallList = sketch.measureRecall(index, store, top_k)
+	if len(recallList) == 0:
+		raise Exception("No runs in both the run matrix and the sketch index "
+						"of " + output_folder)
+	with open(output_folder + "/sketch_recall.txt", 'w') as newFile:
+		newFile.write("run\trecall@" + str(top_k) + "\n")
+		for name, recall in recallList:
+			newFile.write(name + "\t" + "%f" % recall + "\n")
+	meanRecall = sum(x[1] for x in recallList) / len(recallList)
+	print("Mean recall@" + str(top_k) + " over " + str(len(recallList)) +
+		  " runs: " + "%.4f" % meanRecall)
+	return(meanRecall)
+
+
+def addCommonArguments(parser):
+	"""
+	Options shared by the default command and the add and search commands
+	"""
 	parser.add_argument("--topN", help="Keep top N most intense MS1 features.\
 	Default=4000", type=int, default=4000)
 	parser.add_argument("--mzTol", help='m/z tolerance in ppm to create an edge.\
@@ -138,8 +599,252 @@ mzML files.")
 						default=0.00001, type=float)
 	parser.add_argument("--gamma",help='gamma hyperparameter. Default=1.0',
 						default=1.0, type=float)
-	args = parser.parse_args()
+	parser.add_argument("--jobs",help='Number of mzML files and run pairs to \
+	process in parallel. Default=1', default=1, type=int)
+	parser.add_argument("--featureThreads",help='Number of pyOpenMS threads\
+	per feature detection worker, or of this process with one job or one file.\
+	Default=number of cores / jobs',
+						default=None, type=int)
+	parser.add_argument("--memoryMb",help='Stream mzML files and keep at most\
+	about this many MB of peaks in memory per feature detection worker.\
+	Default=load every MS1 scan', default=None, type=float)
+	parser.add_argument("--pairwiseMemoryMb",help='Build each sparse edge\
+	similarity matrix in chunks of rows that keep at most about this many MB\
+	of matrix entries in memory. Cannot be combined with --termCache.\
+	Default=build each matrix in memory', default=None, type=float)
+	parser.add_argument("--termCache",help='Cache the hyperparameter free\
+	terms of each sparse edge similarity matrix so runs with other lambda,\
+	alpha, beta or gamma values only reweight them', action="store_true")
+	parser.add_argument("--supersetTol",help='m/z (ppm) and TIC tolerance of\
+	superset edge files. Edges are generated once at this tolerance and\
+	filtered down to --mzTol and --ticTol', nargs=2, type=float, default=None,
+						metavar=("MZTOL","TICTOL"))
+	parser.add_argument("--trace",help='JSON-lines file (appended to) for the\
+	wall time, CPU time and peak memory of each stage of every run and pair.\
+	An empty value or none turns tracing off.\
+	Default=ms1connect.trace.jsonl', default="ms1connect.trace.jsonl",
+						type=trace.traceFileName)
+	parser.add_argument("--profile",help='Stages to run under cProfile. Stats\
+	are written to --profileFolder', nargs="+", default=[],
+						choices=trace.stageNames)
+	parser.add_argument("--profileFolder",help='Folder for cProfile stats.\
+	Default=profile', default="profile")
+	parser.add_argument("--resultsStore",help='SQLite store of the results of\
+	every pair. Default=ms1connect.results.sqlite',
+						default="ms1connect.results.sqlite")
+	parser.add_argument("--edgeBackend",help='Edge generation backend. numpy\
+	generates edges in-process, createEdge calls the createEdge binary.\
+	Default=numpy', default="numpy", choices=["numpy","createEdge"])
+	parser.add_argument("--solver",help='Solver backend. coopraiz runs the\
+	coopraiz singularity container, greedy runs a native greedy solver.\
+	coopraiz-batch sends every pair to one long-lived coopraiz container,\
+	greedy-batch to a local stand-in solver process. Default=coopraiz',
+						default="coopraiz",
+						choices=["coopraiz","greedy"] +
+								list(solver_driver.batchSolvers))
+	parser.add_argument("--solverTimeout",help='Seconds a batch solver gets\
+	for one pair before it is retried. Default=' +
+						str(solver_driver.solverTimeout),
+						default=solver_driver.solverTimeout, type=float)
+	parser.add_argument("--solverRetries",help='Retries of a pair a batch\
+	solver timed out on or failed. Default=' +
+						str(solver_driver.solverRetries),
+						default=solver_driver.solverRetries, type=int)
+	parser.add_argument("--solverConcurrency",help='Pairs a batch solver\
+	solves at the same time. Default=jobs', default=None, type=int)
+	parser.add_argument("--edgeFormat",help='Edge file format. txt is tab\
+	delimited, bin is a binary format that is memory mapped. Default=txt',
+						default="txt", choices=["txt","bin"])
+	parser.add_argument("--manifest",help='Manifest of intermediate files.\
+	Files are reused only if their inputs and parameters have not changed.\
+	Default=ms1connect.manifest.json', default="ms1connect.manifest.json")
+
+
+def addLibraryArguments(parser):
+	"""
+	Folder options of the commands that work on a previous MS1Connect run
+	"""
+	parser.add_argument("--ms1", help="Folder containing MS1 feature files",
+						required=True)
+	parser.add_argument("--edge", help="Folder containing edge files",
+						required=True)
+	parser.add_argument("--matroid", help="Folder containing matroid files",
+						required=True)
+	parser.add_argument("--edgeSimMatrix", help='Folder containing sparse\
+						edge similarity matricies', required=True)
+	parser.add_argument("--output", help='Output folder of the previous\
+						run', required=True)
+
+
+def runCommand(args):
 	ms1Connect(args.mzml, args.ms1, args.edge, args.matroid, args.edgeSimMatrix,
 			   args.output, args.topN, args.mzTol, args.ticTol, args.metadata,
 			   args.lambda1, args.lambda2, args.lambda3, args.lambda4,
-			   args.alpha, args.beta, args.gamma)
+			   args.alpha, args.beta, args.gamma, args.jobs, args.edgeBackend,
+			   args.solver, args.edgeFormat, args.manifest,
+			   args.featureThreads, args.memoryMb, args.termCache,
+			   args.supersetTol, args.trace, args.profile, args.profileFolder,
+			   args.resultsStore, args.mdsMethod, args.heatmapMode,
+			   args.pairwiseMemoryMb, args.queue, args.solverTimeout,
+			   args.solverRetries, args.solverConcurrency)
+
+
+def addCommand(args):
+	ms1ConnectAdd(args.mzml, args.ms1, args.edge, args.matroid,
+				  args.edgeSimMatrix, args.output, args.topN, args.mzTol,
+				  args.ticTol, args.lambda1, args.lambda2, args.lambda3,
+				  args.lambda4, args.alpha, args.beta, args.gamma, args.jobs,
+				  args.edgeBackend, args.solver, args.edgeFormat, args.manifest,
+				  args.featureThreads, args.memoryMb, args.termCache,
+				  args.supersetTol, args.trace, args.profile,
+				  args.profileFolder, args.resultsStore, args.pairwiseMemoryMb,
+				  args.solverTimeout, args.solverRetries,
+				  args.solverConcurrency)
+
+
+def searchCommand(args):
+	ms1ConnectSearch(args.mzml, args.ms1, args.edge, args.matroid,
+					 args.edgeSimMatrix, args.output, args.topN, args.mzTol,
+					 args.ticTol, args.lambda1, args.lambda2, args.lambda3,
+					 args.lambda4, args.alpha, args.beta, args.gamma,
+					 args.topK, args.jobs, args.edgeBackend, args.solver,
+					 args.edgeFormat, args.manifest, args.featureThreads,
+					 args.memoryMb, args.termCache, args.supersetTol,
+					 args.trace, args.profile, args.profileFolder,
+					 args.resultsStore, args.pairwiseMemoryMb,
+					 args.solverTimeout, args.solverRetries,
+					 args.solverConcurrency)
+
+
+def recallCommand(args):
+	ms1ConnectRecall(args.output, args.topK, args.resultsStore)
+
+
+def workerCommand(args):
+	numRun = work_queue.runWorker(args.queue, args.maxTasks, args.leaseSeconds,
+								  threads=args.threads)
+	print("Scored " + str(numRun) + " pairs. Queue status: " +
+		  str(work_queue.queueStatus(args.queue)))
+
+
+def reduceCommand(args):
+	ms1ConnectReduce(args.queue)
+
+
+# subcommand run when the first argument is not the name of a subcommand
+defaultCommand = "run"
+
+
+def buildParser():
+	"""
+	Command line parser with a subparser for each command. The command is run
+	by calling args.command(args).
+	Output1: argparse.ArgumentParser
+	Output2: list of command names
+	"""
+	parser = argparse.ArgumentParser(prog="ms1connect.py",
+		description="Runs MS1Connect on a set of mzML files. 'ms1connect.py \
+MZML MS1 ...' is the same as 'ms1connect.py run MZML MS1 ...'. Use \
+'ms1connect.py COMMAND -h' for the options of a command.")
+	subparsers = parser.add_subparsers(title="commands", dest="commandName",
+									   metavar="COMMAND", required=True)
+
+	runParser = subparsers.add_parser("run", help='Run MS1Connect on a set of\
+	mzML files (default)', description="Runs MS1Connect on a set of mzML \
+files.")
+	runParser.add_argument("mzml", help="Folder containing mzML files")
+	runParser.add_argument("ms1", help="Folder containing MS1 feature files")
+	runParser.add_argument("edge", help="Folder containing edge files")
+	runParser.add_argument("matroid", help="Folder containing matroid files.\
+						   Folder will be created if it does not exist.")
+	runParser.add_argument("edgeSimMatrix", help='Folder containing sparse\
+						   edge similarity matricies. Folder will be created\
+						   if it does not exist.')
+	runParser.add_argument("metadata",help='Metadata file')
+	runParser.add_argument("output",help='Folder to place outputs')
+	addCommonArguments(runParser)
+	runParser.add_argument("--mdsMethod",help='MDS method. smacof is sklearn\
+	MDS, classical and landmark scale to thousands of runs. auto uses\
+	classical for large cohorts. Default=auto', default="auto",
+						   choices=plot_modes.mdsMethods)
+	runParser.add_argument("--heatmapMode",help='Heatmap mode. cells draws\
+	every run with a tick label, raster draws the matrix as an image grouped\
+	by metadata label, label draws the mean similarity between labels. auto\
+	uses raster for large cohorts. Default=auto', default="auto",
+						   choices=plot_modes.heatmapModes)
+	runParser.add_argument("--queue",help='Queue the pairs in this folder on a\
+	shared filesystem instead of scoring them. Pairs are scored by\
+	ms1connect.py worker and the outputs written by ms1connect.py reduce.\
+	Default=score the pairs in this process', default=None)
+	runParser.set_defaults(command=runCommand)
+
+	addParser = subparsers.add_parser("add", help='Add new mzML files to a\
+	previous run', description="Adds new mzML files to the run similarity \
+matrix of a previous MS1Connect run. Only pairs that include a new run are \
+scored.")
+	addParser.add_argument("mzml", nargs="+", help="New mzML files")
+	addLibraryArguments(addParser)
+	addCommonArguments(addParser)
+	addParser.set_defaults(command=addCommand)
+
+	searchParser = subparsers.add_parser("search", help='Find the runs of a\
+	previous run most similar to new mzML files', description="Finds the runs \
+of a previous MS1Connect run most similar to each query mzML file. Candidates \
+are picked with the sketch index and only the pairs between a query and its \
+candidates are scored.")
+	searchParser.add_argument("mzml", nargs="+", help="Query mzML files")
+	searchParser.add_argument("--topK", help='Number of candidates scored per\
+							  query. Default=10', type=int, default=10)
+	addLibraryArguments(searchParser)
+	addCommonArguments(searchParser)
+	searchParser.set_defaults(command=searchCommand)
+
+	recallParser = subparsers.add_parser("recall", help='Check the search\
+	prefilter', description="Measures the recall of the sketch prefilter of \
+'ms1connect.py search' against the exhaustive scores of a previous MS1Connect \
+run.")
+	recallParser.add_argument("--output", help='Output folder of the previous\
+							  run', required=True)
+	recallParser.add_argument("--topK", help='Number of candidates per run.\
+							  Default=10', type=int, default=10)
+	recallParser.add_argument("--resultsStore", help='SQLite results store of\
+							  the previous run.\
+							  Default=ms1connect.results.sqlite',
+							  default="ms1connect.results.sqlite")
+	recallParser.set_defaults(command=recallCommand)
+
+	workerParser = subparsers.add_parser("worker", help='Score the pairs of a\
+	work queue', description="Scores the pairs of a work queue created with \
+'ms1connect.py ... --queue'. Start any number of workers on hosts that share \
+the queue folder. Each worker runs until every pair is done.")
+	workerParser.add_argument("--queue", help="Work queue folder",
+							  required=True)
+	workerParser.add_argument("--maxTasks", help='Stop after this many pairs.\
+							  Default=run until the queue is done', type=int,
+							  default=None)
+	workerParser.add_argument("--leaseSeconds", help='Seconds after which the\
+							  pair of a worker that stopped renewing its lease\
+							  is taken over. Default=' +
+							  str(work_queue.leaseSeconds), type=float,
+							  default=work_queue.leaseSeconds)
+	workerParser.add_argument("--threads", help='Number of numba threads.\
+							  Default=number of cores', type=int, default=None)
+	workerParser.set_defaults(command=workerCommand)
+
+	reduceParser = subparsers.add_parser("reduce", help='Write the outputs of\
+	a work queue', description="Writes the outputs of a work queue once every \
+pair is done.")
+	reduceParser.add_argument("--queue", help="Work queue folder",
+							  required=True)
+	reduceParser.set_defaults(command=reduceCommand)
+	return(parser, list(subparsers.choices))
+
+
+if __name__ == "__main__":
+	parser, commandNames = buildParser()
+	argv = sys.argv[1:]
+	# the bare positional form runs the default command
+	if len(argv) > 0 and argv[0] not in commandNames + ["-h", "--help"]:
+		argv = [defaultCommand] + argv
+	args = parser.parse_args(argv)
+	args.command(args)
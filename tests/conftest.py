@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# tests import the bin and benchmarks packages the same way ms1connect.py does
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,134 @@
+import os
+import shutil
+import subprocess
+import numpy as np
+import pytest
+from pathlib import Path
+from benchmarks import synthetic_features
+from bin import create_edge
+from bin import feature_store
+
+binFolder = Path(__file__).resolve().parent.parent / "bin"
+needsCreateEdge = pytest.mark.skipif(not (binFolder / "createEdge").is_file(),
+	reason="createEdge is not built (make bin/createEdge)")
+
+
+###############################################################################
+@pytest.fixture(scope="module")
+def ms1Folder(tmp_path_factory):
+	folder = tmp_path_factory.mktemp("ms1")
+	synthetic_features.generateCohort(folder, 2, 300, seed=0)
+	return(folder)
+
+
+def edgeColumns(edges):
+	return(np.column_stack([create_edge.getEdgeColumn(edges, col)
+							.astype(np.float64) for col in range(5)]))
+
+
+###############################################################################
+def test_featureStoreRoundTrip(ms1Folder, tmp_path):
+	textFile = tmp_path / "run0000_ms1Peak.txt"
+	shutil.copy(ms1Folder / "run0000_ms1Peak.txt", textFile)
+	features = np.loadtxt(textFile, delimiter='\t', skiprows=1, ndmin=2)
+	store = feature_store.loadFeatures(textFile)
+	assert Path(feature_store.getBinaryFileName(textFile)).is_file()
+
+	matrix = feature_store.featureMatrix(store)
+	assert matrix.shape == features.shape
+	# pTIC and charge are exact, m/z, intensity and RT are float32 and the
+	# intensity is normalized by its max value
+	intensCol = feature_store.intensCol
+	expected = features.copy()
+	expected[:,intensCol] /= features[:,intensCol].max()
+	for name, dtype in feature_store.columnList:
+		col = feature_store.columnOrder.index(name)
+		assert np.array_equal(matrix[:,col],
+							  expected[:,col].astype(dtype).astype(np.float64))
+
+
+def test_featureStoreFollowsTextFile(ms1Folder, tmp_path):
+	textFile = tmp_path / "run0000_ms1Peak.txt"
+	shutil.copy(ms1Folder / "run0000_ms1Peak.txt", textFile)
+	nRow = feature_store.loadFeatures(textFile)["mz"].size
+	# a text file newer than its binary feature file is converted again
+	lines = textFile.read_text().splitlines(keepends=True)
+	textFile.write_text("".join(lines[0:11]))
+	newTime = os.stat(feature_store.getBinaryFileName(textFile)).st_mtime + 10
+	os.utime(textFile, (newTime, newTime))
+	assert nRow > 10
+	assert feature_store.loadFeatures(textFile)["mz"].size == 10
+
+
+def test_emptyFeatureStore(tmp_path):
+	fileName = tmp_path / "empty_ms1Peak.bin"
+	feature_store.writeFeatureStore(np.zeros((0,5)), fileName)
+	store = feature_store.openFeatureStore(fileName)
+	assert feature_store.featureMatrix(store).shape == (0,5)
+
+
+###############################################################################
+def test_edgeRoundTrip(ms1Folder, tmp_path):
+	leftFile = str(ms1Folder / "run0000_ms1Peak.txt")
+	rightFile = str(ms1Folder / "run0001_ms1Peak.txt")
+	edges = create_edge.createEdgeInProcess(leftFile, rightFile,
+		str(tmp_path / "a.txt"), 10.0, 1.0)
+	create_edge.writeEdgeBinary(edges, tmp_path / "a.bin")
+	assert edges.shape[0] > 0
+
+	binaryEdges = create_edge.loadEdges(tmp_path / "a.bin")
+	assert binaryEdges.dtype == create_edge.edgeDtype
+	expected = np.column_stack([edges[:,col].astype(dtype)
+		for col, (name, dtype) in enumerate(create_edge.edgeDtype.descr)])
+	assert np.array_equal(edgeColumns(binaryEdges), expected)
+	# the text edge file keeps 6 significant digits (%g)
+	textEdges = create_edge.loadEdges(tmp_path / "a.txt")
+	assert np.array_equal(textEdges[:,0:2], edges[:,0:2])
+	assert np.allclose(textEdges, edges, rtol=1e-5, atol=0)
+
+
+@pytest.mark.filterwarnings("ignore:loadtxt")
+def test_emptyEdgeRoundTrip(tmp_path):
+	create_edge.writeEdgeBinary(np.zeros((0,5)), tmp_path / "a.bin")
+	create_edge.writeEdgeFile(np.zeros((0,5)), tmp_path / "a.txt")
+	assert create_edge.loadEdges(tmp_path / "a.bin").size == 0
+	assert create_edge.loadEdges(tmp_path / "a.txt").shape == (0,5)
+
+
+def test_binaryEdgeFileCheck(tmp_path):
+	fileName = tmp_path / "a.bin"
+	fileName.write_bytes(b"MS1F" + bytes(12))
+	with pytest.raises(Exception, match="not a binary edge file"):
+		create_edge.loadEdges(fileName)
+
+
+@needsCreateEdge
+@pytest.mark.parametrize("edgeFormat", ["txt", "bin"])
+def test_createEdgeMatchesInProcess(ms1Folder, tmp_path, edgeFormat):
+	leftFile = str(ms1Folder / "run0000_ms1Peak.txt")
+	rightFile = str(ms1Folder / "run0001_ms1Peak.txt")
+	for fileName in [leftFile, rightFile]:
+		feature_store.loadFeatures(fileName)
+	binaryFile = str(tmp_path / ("binary." + edgeFormat))
+	create_edge.createEdge(feature_store.getBinaryFileName(leftFile),
+						   feature_store.getBinaryFileName(rightFile),
+						   binaryFile, str(binFolder / "createEdge"), 10.0, 1.0)
+	edges = create_edge.createEdgeInProcess(leftFile, rightFile,
+		str(tmp_path / ("python." + edgeFormat)), 10.0, 1.0)
+	# createEdge leaves the order of ties unspecified
+	binaryEdges = edgeColumns(create_edge.loadEdges(binaryFile))
+	pythonEdges = edgeColumns(create_edge.loadEdges(
+		tmp_path / ("python." + edgeFormat)))
+	assert binaryEdges.shape[0] == edges.shape[0]
+	assert np.array_equal(binaryEdges[np.lexsort(binaryEdges[:,::-1].T)],
+						  pythonEdges[np.lexsort(pythonEdges[:,::-1].T)])
+
+
+@needsCreateEdge
+def test_createEdgeFailure(tmp_path):
+	with pytest.raises(Exception, match="createEdge failed"):
+		create_edge.createEdge(str(tmp_path / "missing_ms1Peak.txt"),
+							   str(tmp_path / "missing_ms1Peak.txt"),
+							   str(tmp_path / "a.txt"),
+							   str(binFolder / "createEdge"), 10.0, 1.0)
+	assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+import scipy.sparse
+from benchmarks import synthetic_features
+from bin import artifact_cache
+from bin import create_edge
+from bin import pairwise_edge_matrix
+
+# ms1connect.py defaults
+hyperparams = (0.0, 0.1, 0.0, 0.9, 0.0, 0.00001, 1.0)
+
+
+###############################################################################
+@pytest.fixture(scope="module")
+def pairFolder(tmp_path_factory):
+	"""
+	Folder with ms1 (synthetic runs) and in edge the edge file of two runs of
+	the same group
+	"""
+	folder = tmp_path_factory.mktemp("pair")
+	synthetic_features.generateCohort(folder / "ms1", 3, 400, seed=1)
+	(folder / "edge").mkdir()
+	leftFile, rightFile = [str(folder / "ms1" / (name + "_ms1Peak.txt"))
+						   for name in ["run0000", "run0002"]]
+	create_edge.createEdgeInProcess(leftFile, rightFile,
+		create_edge.getEdgeFileName(leftFile, rightFile, str(folder / "edge")),
+		10.0, 1.0)
+	return(folder)
+
+
+def getEdgeFileName(pairFolder):
+	return(str(next((pairFolder / "edge").iterdir())))
+
+
+def assertSameMatrix(matrix1, matrix2):
+	assert matrix1.shape == matrix2.shape
+	for name in ["indptr", "indices", "data"]:
+		assert np.array_equal(getattr(matrix1, name), getattr(matrix2, name))
+
+
+###############################################################################
+def test_fillInMatrixChunked(pairFolder, tmp_path):
+	edgeFileName = getEdgeFileName(pairFolder)
+	edgeFile, leftFile, rightFile = pairwise_edge_matrix.loadPairInputs(
+		edgeFileName, str(pairFolder / "ms1"))
+	nRow = edgeFile.shape[0]
+	assert nRow > 20
+	sparseMat, postNormVal, numEntries = pairwise_edge_matrix.fillInMatrix(
+		edgeFile, leftFile, rightFile, nRow, *hyperparams)
+	(tmp_path / "full").mkdir()
+	pairwise_edge_matrix.saveEdgeSimMatrix(sparseMat, edgeFileName,
+										   str(tmp_path / "full"))
+	fullFileName = pairwise_edge_matrix.getEdgeSimMatrixFileName(
+		edgeFileName, str(tmp_path / "full"))
+
+	# one chunk, a few rows per chunk and one row per chunk
+	for memory_mb in [100.0, 0.001, 1e-9]:
+		folder = tmp_path / str(memory_mb)
+		folder.mkdir()
+		chunkFileName = pairwise_edge_matrix.getEdgeSimMatrixFileName(
+			edgeFileName, str(folder))
+		chunkPostNormVal, chunkEntries = \
+			pairwise_edge_matrix.fillInMatrixChunked(edgeFile, leftFile,
+				rightFile, nRow, *hyperparams, chunkFileName, memory_mb)
+		assert chunkPostNormVal == postNormVal
+		assert chunkEntries == numEntries
+		# readable by scipy and memory-mapped the same
+		assertSameMatrix(scipy.sparse.load_npz(chunkFileName),
+						 scipy.sparse.load_npz(fullFileName))
+		assertSameMatrix(pairwise_edge_matrix.openEdgeSimMatrix(chunkFileName),
+						 scipy.sparse.load_npz(fullFileName))
+		# no temporary files are left next to the matrix
+		assert [f.name for f in folder.iterdir()] == \
+			   [chunkFileName.split("/")[-1]]
+
+
+def test_weightTermCache(pairFolder):
+	edgeFile, leftFile, rightFile = pairwise_edge_matrix.loadPairInputs(
+		getEdgeFileName(pairFolder), str(pairFolder / "ms1"))
+	nRow = edgeFile.shape[0]
+	termCache = pairwise_edge_matrix.buildTermCache(edgeFile, leftFile,
+													rightFile, nRow)
+	for params in [hyperparams, (0.2, 0.3, 0.1, 0.4, 0.5, 0.001, 2.0)]:
+		sparseMat, postNormVal, numEntries = \
+			pairwise_edge_matrix.fillInMatrix(edgeFile, leftFile, rightFile,
+											  nRow, *params)
+		termMat, termPostNormVal, termEntries = \
+			pairwise_edge_matrix.weightTermCache(termCache, *params)
+		assert termEntries == numEntries
+		assert np.isclose(termPostNormVal, postNormVal, rtol=1e-12)
+		assert np.array_equal(termMat.indptr, sparseMat.indptr)
+		assert np.array_equal(termMat.indices, sparseMat.indices)
+		assert np.allclose(termMat.data, sparseMat.data, rtol=1e-5)
+
+
+def test_termCacheKeyedByInputs(pairFolder, tmp_path):
+	edgeFileName = str(tmp_path / getEdgeFileName(pairFolder).split("/")[-1])
+	edges = create_edge.loadEdges(getEdgeFileName(pairFolder))
+	create_edge.writeEdgeFile(edges, edgeFileName)
+	ms1Folder = str(pairFolder / "ms1")
+	manifest = artifact_cache.emptyManifest()
+	termCache = pairwise_edge_matrix.getTermCache(edgeFileName, ms1Folder,
+												  str(tmp_path), manifest)
+	termFileName = pairwise_edge_matrix.getTermCacheFileName(edgeFileName,
+															 str(tmp_path))
+	assert not artifact_cache.isUnknown(manifest, termFileName)
+
+	# reused while the inputs are the same
+	mtime = (tmp_path / termFileName.split("/")[-1]).stat().st_mtime_ns
+	pairwise_edge_matrix.getTermCache(edgeFileName, ms1Folder, str(tmp_path),
+									  manifest)
+	assert (tmp_path / termFileName.split("/")[-1]).stat().st_mtime_ns == mtime
+
+	# rebuilt when the edge file changes
+	create_edge.writeEdgeFile(edges[0:10], edgeFileName)
+	newCache = pairwise_edge_matrix.getTermCache(edgeFileName, ms1Folder,
+												 str(tmp_path), manifest)
+	assert int(termCache["nRow"]) == edges.shape[0]
+	assert int(newCache["nRow"]) == 10
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from bin import results_store
+from bin import solver
+
+
+###############################################################################
+@pytest.fixture
+def resultsFile(tmp_path):
+	"""
+	Results store of runs a, b and c. The solver failed on b___c.
+	"""
+	rowList = [
+		results_store.pairRow("a___a___score", 10, 12, 2.0,
+							  solver.SolverResult(3.0, 5, 10, 7)),
+		results_store.pairRow("a___b___score", 8, 9, 0.5,
+							  solver.SolverResult(4.0, 4, 8, None)),
+		results_store.pairRow("b___b___score", 6, 6, 1.0,
+							  solver.SolverResult(2.0, 3, 6, 3)),
+		results_store.pairRow("b___c___score", 4, 5, 3.0, None),
+		results_store.pairRow("c___c___score", 5, 5, 1.5,
+							  solver.SolverResult(1.0, 2, 5, 2))]
+	fileName = tmp_path / "results.sqlite"
+	conn = results_store.openResultsStore(fileName)
+	results_store.writePairResults(conn, rowList)
+	conn.close()
+	return(fileName)
+
+
+def loadResults(fileName, runNames=None):
+	conn = results_store.openResultsStore(fileName)
+	results = results_store.loadPairResults(conn, runNames)
+	conn.close()
+	return(results)
+
+
+###############################################################################
+def test_pairRoundTrip(resultsFile):
+	results = loadResults(resultsFile)
+	pairs = list(zip(results["leftRun"], results["rightRun"]))
+	assert sorted(pairs) == [("a","a"), ("a","b"), ("b","b"), ("b","c"),
+							 ("c","c")]
+	byPair = dict(zip(pairs, zip(results["score"], results["numEdges"],
+								 results["postNormVal"])))
+	assert byPair[("a","b")] == (4.0, 8.0, 0.5)
+	# a failed solve is stored as NULL and loaded as nan
+	score, numEdges, postNormVal = byPair[("b","c")]
+	assert np.isnan(score) and np.isnan(numEdges) and postNormVal == 3.0
+
+
+def test_writeReplacesPair(resultsFile):
+	conn = results_store.openResultsStore(resultsFile)
+	results_store.writePairResults(conn, [results_store.pairRow(
+		"b___c___score", 4, 5, 3.0, solver.SolverResult(1.5, 2, 4, 2))])
+	conn.close()
+	results = loadResults(resultsFile)
+	assert results["score"].size == 5
+	isPair = (results["leftRun"] == "b") & (results["rightRun"] == "c")
+	assert results["score"][isPair].tolist() == [1.5]
+
+
+def test_loadPairResultsOfRuns(resultsFile, monkeypatch):
+	# one run per query so the batching is exercised
+	monkeypatch.setattr(results_store, "maxQueryRuns", 1)
+	results = loadResults(resultsFile, ["c", "a"])
+	pairs = set(zip(results["leftRun"], results["rightRun"]))
+	assert pairs == {("a","a"), ("a","b"), ("b","c"), ("c","c")}
+	assert loadResults(resultsFile, ["d"])["score"].size == 0
+
+
+def test_runIndicies():
+	index = results_store.runIndicies(["c", "a", "b"],
+									  np.array(["a", "d", "c", "b"]))
+	assert index.tolist() == [1, -1, 0, 2]
+	assert results_store.runIndicies([], np.array(["a"])).tolist() == [-1]
+
+
+def test_assembleRunMatrix(resultsFile):
+	results = loadResults(resultsFile)
+	# d has no results and b___c has no score
+	matrix = results_store.assembleRunMatrix(["c", "a", "b", "d"], results)
+	expected = np.array([[1.5, 0.0, 0.0, 0.0],
+						 [0.0, 6.0, 2.0, 0.0],
+						 [0.0, 2.0, 2.0, 0.0],
+						 [0.0, 0.0, 0.0, 0.0]])
+	assert np.array_equal(matrix, expected)
+	raw = results_store.assembleRunMatrix(["a", "b"], results,
+										  postNormalize=False)
+	assert np.array_equal(raw, [[3.0, 4.0], [4.0, 2.0]])
+
+
+def test_scatterRunMatrixKeepsOtherPairs(resultsFile):
+	matrix = np.full((3,3), -1.0)
+	results_store.scatterRunMatrix(matrix, ["a", "b", "c"],
+								   loadResults(resultsFile, ["a"]))
+	assert np.array_equal(matrix, [[6.0, 2.0, -1.0],
+								   [2.0, -1.0, -1.0],
+								   [-1.0, -1.0, -1.0]])
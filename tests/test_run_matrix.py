@@ -0,0 +1,81 @@
+import numpy as np
+from bin import results_store
+from bin import run_matrix
+from bin import solver
+
+
+###############################################################################
+def writeResults(fileName, runList):
+	"""
+	Results store with a score for every pair of runList. The score of a pair
+	is made from the run indicies so every entry of the matrix differs.
+	"""
+	rowList = []
+	for i, left in enumerate(runList):
+		for j in range(i, len(runList)):
+			score = 1.0 + i + 10 * j
+			rowList.append(results_store.pairRow(
+				left + "___" + runList[j] + "___score", 5, 5, 0.5 + i,
+				solver.SolverResult(score, 1, 5, 1)))
+	conn = results_store.openResultsStore(fileName)
+	results_store.writePairResults(conn, rowList)
+	conn.close()
+
+
+###############################################################################
+def test_loadMissingRunMatrix(tmp_path):
+	store = run_matrix.loadRunMatrix(tmp_path / run_matrix.storeFileName)
+	assert store["names"] == [] and store["matrix"].shape == (0,0)
+
+
+def test_runMatrixRoundTrip(tmp_path):
+	resultsFile = tmp_path / "results.sqlite"
+	writeResults(resultsFile, ["a", "b", "c"])
+	store = run_matrix.buildRunMatrix(["c", "a", "b"], resultsFile)
+	fileName = tmp_path / run_matrix.storeFileName
+	run_matrix.saveRunMatrix(store, fileName)
+	loaded = run_matrix.loadRunMatrix(fileName)
+	assert loaded["names"] == ["c", "a", "b"]
+	assert np.array_equal(loaded["matrix"], store["matrix"])
+	assert run_matrix.getRunIndex(loaded) == {"c":0, "a":1, "b":2}
+
+
+def test_updateRunsEqualsRebuild(tmp_path):
+	resultsFile = tmp_path / "results.sqlite"
+	writeResults(resultsFile, ["a", "b", "c"])
+	store = run_matrix.buildRunMatrix(["a", "b", "c"], resultsFile)
+
+	# add d and e. Only their pairs are read from the store
+	writeResults(resultsFile, ["a", "b", "c", "d", "e"])
+	run_matrix.updateRuns(store, ["d", "e"], resultsFile)
+	full = run_matrix.buildRunMatrix(["a", "b", "c", "d", "e"], resultsFile)
+	assert store["names"] == full["names"]
+	assert np.array_equal(store["matrix"], full["matrix"])
+	assert np.array_equal(store["matrix"], store["matrix"].T)
+
+
+def test_updateRunsRescoresExistingRun(tmp_path):
+	resultsFile = tmp_path / "results.sqlite"
+	writeResults(resultsFile, ["a", "b"])
+	store = run_matrix.buildRunMatrix(["a", "b"], resultsFile)
+	conn = results_store.openResultsStore(resultsFile)
+	results_store.writePairResults(conn, [results_store.pairRow(
+		"a___b___score", 5, 5, 2.0, solver.SolverResult(7.0, 1, 5, 1))])
+	conn.close()
+	run_matrix.updateRuns(store, ["b"], resultsFile)
+	assert store["names"] == ["a", "b"]
+	assert store["matrix"][0,1] == store["matrix"][1,0] == 14.0
+
+
+def test_updateRunsWithoutMatrix(tmp_path):
+	# run matrix files that only kept the run names are rebuilt
+	resultsFile = tmp_path / "results.sqlite"
+	writeResults(resultsFile, ["a", "b", "c"])
+	fileName = tmp_path / run_matrix.storeFileName
+	np.savez(fileName, names=np.array(["b", "a"]))
+	store = run_matrix.loadRunMatrix(fileName)
+	assert store["matrix"] is None
+	run_matrix.updateRuns(store, ["c"], resultsFile)
+	full = run_matrix.buildRunMatrix(["b", "a", "c"], resultsFile)
+	assert store["names"] == ["b", "a", "c"]
+	assert np.array_equal(store["matrix"], full["matrix"])
@@ -0,0 +1,40 @@
+import numpy as np
+from bin import sketch
+
+
+###############################################################################
+def test_topCandidatesOrder():
+	scores = [0.1, 0.9, 0.5, 0.7]
+	assert sketch.topCandidates(scores, 3).tolist() == [1, 3, 2]
+	assert sketch.topCandidates(scores, 10).tolist() == [1, 3, 2, 0]
+
+
+def test_topCandidatesTies():
+	# ties are broken by index, including ties with the k-th score
+	scores = [0.5, 0.8, 0.5, 0.8, 0.5]
+	assert sketch.topCandidates(scores, 3).tolist() == [1, 3, 0]
+	assert sketch.topCandidates(scores, 4).tolist() == [1, 3, 0, 2]
+
+
+def test_topCandidatesExclude():
+	scores = np.array([0.1, 0.9, 0.5, 0.7])
+	assert sketch.topCandidates(scores, 2, exclude=[1]).tolist() == [3, 2]
+	assert sketch.topCandidates(scores, 4, exclude=[1, 3]).tolist() == [2, 0]
+	# the scores of the caller are not changed
+	assert scores.tolist() == [0.1, 0.9, 0.5, 0.7]
+
+
+def test_topCandidatesEmpty():
+	assert sketch.topCandidates([], 3).size == 0
+	assert sketch.topCandidates([0.3], 0).size == 0
+	assert sketch.topCandidates([0.3], 2, exclude=[0]).size == 0
+
+
+def test_topCandidatesMatchesSort():
+	rng = np.random.default_rng(0)
+	# few distinct values so there are many ties
+	scores = rng.integers(0, 5, size=200) / 4
+	expected = sorted(range(scores.size), key=lambda i: (-scores[i], i))
+	for top_k in [1, 7, 50, 200]:
+		assert sketch.topCandidates(scores, top_k).tolist() == \
+			   expected[0:top_k]
@@ -0,0 +1,86 @@
+import numpy as np
+import scipy.sparse
+from pathlib import Path
+from bin import edge_to_json_matroid
+from bin import solver
+
+
+###############################################################################
+def makeEdges(pairList):
+	"""
+	Edges (see create_edge.buildEdges) between the (left, right) feature
+	indicies of pairList
+	"""
+	edges = np.zeros((len(pairList), 5))
+	edges[:,0:2] = pairList
+	return(edges)
+
+
+def test_blockLabelsFromMatroidMatchesJson(tmp_path):
+	rng = np.random.default_rng(0)
+	edges = makeEdges(rng.integers(0, 6, size=(40,2)))
+	matroid = edge_to_json_matroid.buildMatroid(edges)
+	jsonFile = tmp_path / "pair___matroid.json"
+	edge_to_json_matroid.writeMatroidJson(matroid, jsonFile)
+
+	blockLabelList, limitList = solver.blockLabelsFromMatroid(matroid, 40)
+	jsonLabelList, jsonLimitList = solver.readMatroidJson(jsonFile, 40)
+	for labels, jsonLabels in zip(blockLabelList, jsonLabelList):
+		assert np.array_equal(labels, jsonLabels)
+	for limit, jsonLimit in zip(limitList, jsonLimitList):
+		assert np.array_equal(limit, jsonLimit)
+	# edges of a block share the feature on that side
+	for side, labels in enumerate(blockLabelList):
+		for block in np.unique(labels):
+			assert np.unique(edges[labels == block, side]).size == 1
+
+
+def test_greedyMaximize():
+	# edges 0 and 1 share left feature 0, edges 1 and 2 share right feature 1
+	edges = makeEdges([(0,0), (0,1), (1,1)])
+	sparseMat = scipy.sparse.csr_matrix(np.array([[3.0, 0.0, 0.5],
+												  [0.0, 2.0, 0.0],
+												  [0.5, 0.0, 1.0]]))
+	blockLabelList, limitList = solver.blockLabelsFromMatroid(
+		edge_to_json_matroid.buildMatroid(edges), 3)
+	result, selected = solver.greedyMaximize(sparseMat, blockLabelList,
+											 limitList)
+	# edge 1 conflicts with edge 0. Edge 2 gains 1 + 2 * 0.5
+	assert selected.tolist() == [0, 2]
+	assert result == solver.SolverResult(5.0, 2, 3, result.numIterations)
+
+
+def test_greedyMaximizeRespectsMatroids():
+	rng = np.random.default_rng(1)
+	numEdges = 60
+	edges = makeEdges(rng.integers(0, 8, size=(numEdges,2)))
+	dense = rng.uniform(-0.2, 1.0, size=(numEdges,numEdges))
+	dense = (dense + dense.T) / 2
+	blockLabelList, limitList = solver.blockLabelsFromMatroid(
+		edge_to_json_matroid.buildMatroid(edges), numEdges)
+	result, selected = solver.greedyMaximize(scipy.sparse.csr_matrix(dense),
+											 blockLabelList, limitList)
+	assert result.numSelectedEdge == selected.size > 0
+	for labels, limit in zip(blockLabelList, limitList):
+		counts = np.bincount(labels[selected], minlength=limit.size)
+		assert np.all(counts <= limit)
+	# the score is the objective of the selected edges
+	assert np.isclose(result.score, dense[np.ix_(selected, selected)].sum())
+
+
+def test_solveGreedyReadsMatroidFiles(tmp_path):
+	edges = makeEdges([(0,0), (0,1), (1,1), (2,0)])
+	sparseMat = scipy.sparse.csr_matrix(np.diag([1.0, 4.0, 2.0, 3.0]))
+	npzFile = str(tmp_path / "a___b___score___pairwise.npz")
+	scipy.sparse.save_npz(npzFile, sparseMat, compressed=False)
+	edgeFile = Path(tmp_path / "a___b___score.txt")
+	edge_to_json_matroid.createJsonMatroid(edgeFile, str(tmp_path), edges,
+										   writeJson=True, writeBinary=True)
+	resultList = [solver.solveGreedy(npzFile, str(tmp_path /
+										 ("a___b___score___matroid" + ext)))
+				  for ext in [".json", ".npz"]]
+	resultList.append(solver.solveGreedy(npzFile, None,
+		edge_to_json_matroid.buildMatroid(edges)))
+	# edge 1, then edge 3 (edge 0 and 2 conflict with them)
+	for result in resultList:
+		assert result == solver.SolverResult(7.0, 2, 4, result.numIterations)
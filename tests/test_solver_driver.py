@@ -0,0 +1,85 @@
+import numpy as np
+import scipy.sparse
+import subprocess
+import time
+from pathlib import Path
+from bin import edge_to_json_matroid
+from bin import solver
+from bin import solver_driver
+
+
+###############################################################################
+def writeProblem(folder, name, diagonal):
+	"""
+	Edge similarity matrix and matroid of a pair with one edge per feature
+	pair in a chain (edges i and i+1 share a feature)
+	"""
+	numEdges = len(diagonal)
+	edges = np.zeros((numEdges, 5))
+	edges[:,0] = np.arange(numEdges) // 2
+	edges[:,1] = (np.arange(numEdges) + 1) // 2
+	npzFile = str(folder / (name + "___score___pairwise.npz"))
+	scipy.sparse.save_npz(npzFile, scipy.sparse.csr_matrix(np.diag(diagonal)),
+						  compressed=False)
+	edge_to_json_matroid.createJsonMatroid(
+		Path(folder / (name + "___score.txt")), str(folder), edges,
+		writeJson=False, writeBinary=True)
+	return(npzFile, str(folder / (name + "___score___matroid.npz")))
+
+
+def problemProcesses():
+	"""
+	Child processes solving one greedy problem (see solver_server)
+	"""
+	output = subprocess.run(["ps", "-eo", "args"], capture_output=True,
+							text=True).stdout
+	return([line for line in output.splitlines()
+			if "solver_server.py" in line and "--problem" in line])
+
+
+###############################################################################
+def test_greedyBatchMatchesGreedy(tmp_path):
+	problemList = [writeProblem(tmp_path, "a___" + str(i),
+								np.arange(1.0, 6.0 + i))
+				   for i in range(4)]
+	driver = solver_driver.SolverDriver("greedy", concurrency=2)
+	try:
+		futures = [driver.submit(npzFile, matroidFile)
+				   for npzFile, matroidFile in problemList]
+		outcomes = [future.result() for future in futures]
+	finally:
+		driver.close()
+	for (npzFile, matroidFile), outcome in zip(problemList, outcomes):
+		expected = solver.solveGreedy(npzFile, matroidFile)
+		assert outcome.status == "ok" and outcome.attempts == 1
+		assert outcome.result.score == expected.score
+		assert outcome.result.numSelectedEdge == expected.numSelectedEdge
+
+
+def test_timeoutKillsProblem(tmp_path):
+	npzFile, matroidFile = writeProblem(tmp_path, "a___b", [1.0, 2.0])
+	# every attempt takes longer than the timeout
+	driver = solver_driver.SolverDriver("greedy", timeout=0.5, retries=1,
+		command=solver_driver.serverCommand("greedy", 1, delay=30.0))
+	try:
+		outcome = driver.solve(npzFile, matroidFile)
+		assert outcome.status == "timeout" and outcome.attempts == 2
+		assert outcome.result is None
+		# the cancelled attempts were stopped, not left running next to the
+		# retry
+		for i in range(50):
+			if len(problemProcesses()) == 0:
+				break
+			time.sleep(0.1)
+		assert problemProcesses() == []
+	finally:
+		driver.close()
+
+
+def test_failedOutcomeOutput():
+	outcome = solver_driver.SolveOutcome("error", None, "partial", 2, 1.0,
+										 "return code 1:\n  bad  input")
+	result, output = solver_driver.outcomeResult(outcome)
+	assert result is None
+	assert output == "partial\nSolver failed: error after 2 attempts: " + \
+					 "return code 1: bad input\n"
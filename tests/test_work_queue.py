@@ -0,0 +1,76 @@
+import os
+import time
+import pytest
+from bin import work_queue
+
+
+###############################################################################
+@pytest.fixture
+def queueFolder(tmp_path):
+	(tmp_path / work_queue.leaseFolderName).mkdir()
+	return(str(tmp_path))
+
+
+def expireLease(queueFolder, taskId, seconds):
+	leaseFileName = work_queue.getLeaseFileName(queueFolder, taskId)
+	oldTime = time.time() - seconds
+	os.utime(leaseFileName, (oldTime, oldTime))
+
+
+###############################################################################
+def test_claimTask(queueFolder):
+	token = work_queue.claimTask(queueFolder, 0, leaseTime=60)
+	assert token is not None
+	assert work_queue.ownsLease(queueFolder, 0, token)
+	# the lease is held, so no other worker gets the task
+	assert work_queue.claimTask(queueFolder, 0, leaseTime=60) is None
+	# other tasks are independent
+	assert work_queue.claimTask(queueFolder, 1, leaseTime=60) is not None
+
+
+def test_releaseTask(queueFolder):
+	token = work_queue.claimTask(queueFolder, 0, leaseTime=60)
+	work_queue.releaseTask(queueFolder, 0, token)
+	assert not work_queue.ownsLease(queueFolder, 0, token)
+	newToken = work_queue.claimTask(queueFolder, 0, leaseTime=60)
+	assert newToken is not None and newToken != token
+
+
+def test_stealExpiredLease(queueFolder):
+	token = work_queue.claimTask(queueFolder, 0, leaseTime=60)
+	expireLease(queueFolder, 0, 120)
+	newToken = work_queue.claimTask(queueFolder, 0, leaseTime=60)
+	assert newToken is not None and newToken != token
+	assert work_queue.ownsLease(queueFolder, 0, newToken)
+	assert not work_queue.ownsLease(queueFolder, 0, token)
+	# the worker that lost the lease does not remove the new one
+	work_queue.releaseTask(queueFolder, 0, token)
+	assert work_queue.ownsLease(queueFolder, 0, newToken)
+	# no stale lease files are left behind
+	assert os.listdir(os.path.join(queueFolder,
+								   work_queue.leaseFolderName)) == \
+		   [os.path.basename(work_queue.getLeaseFileName(queueFolder, 0))]
+
+
+def test_heartbeatRenewsLease(queueFolder):
+	token = work_queue.claimTask(queueFolder, 0, leaseTime=0.4)
+	with work_queue.heartbeat(queueFolder, 0, token, 0.4) as lost:
+		time.sleep(1.0)
+		# renewed, so the lease has not expired and cannot be stolen
+		assert work_queue.claimTask(queueFolder, 0, leaseTime=0.4) is None
+	assert not lost.is_set()
+	assert work_queue.ownsLease(queueFolder, 0, token)
+
+
+def test_heartbeatStopsWhenLeaseIsStolen(queueFolder):
+	token = work_queue.claimTask(queueFolder, 0, leaseTime=60)
+	expireLease(queueFolder, 0, 120)
+	newToken = work_queue.claimTask(queueFolder, 0, leaseTime=60)
+	leaseFileName = work_queue.getLeaseFileName(queueFolder, 0)
+	expireLease(queueFolder, 0, 30)
+	mtime = os.stat(leaseFileName).st_mtime_ns
+	with work_queue.heartbeat(queueFolder, 0, token, 0.2) as lost:
+		assert lost.wait(5)
+	# the lease of the other worker was not renewed
+	assert os.stat(leaseFileName).st_mtime_ns == mtime
+	assert work_queue.ownsLease(queueFolder, 0, newToken)